@@ -0,0 +1,33 @@
+from schema import register_schema
+
+# The events the fraud pipeline produces and consumes, in the compact
+# binary encoding of schema.py. Producers pass a schema's encode as their
+# value_serializer and consumers pass schema.decode as their
+# value_deserializer; records then come back as lazily decoded, dict-like
+# events.
+
+TRANSACTION = register_schema(1, 'transaction', [
+    ("amount", "int64"),
+    ("timestamp", "int64"),
+    ("txn_type", "enum", ["debit", "credit", "cashout", "transfer"]),
+    ("customer_id", "string"),
+    ("beneficiary", "string"),
+])
+
+ACCOUNT_OPENING = register_schema(2, 'account-opening', [
+    ("initial_deposit", "int64"),
+    ("account_age_days", "int32"),
+    ("timestamp", "int64"),
+    ("account_type", "enum", ["savings", "checking", "business"]),
+    ("nationality", "enum", ["SA", "AE", "EG", "JO", "PK", "IN"]),
+    ("customer_id", "string"),
+])
+
+CARD_ISSUE = register_schema(3, 'card-issue', [
+    ("credit_limit", "int64"),
+    ("has_credit_card", "int32"),
+    ("timestamp", "int64"),
+    ("card_type", "enum", ["debit", "credit", "prepaid"]),
+    ("card_tier", "enum", ["standard", "gold", "platinum"]),
+    ("customer_id", "string"),
+])
@@ -25,6 +25,40 @@ class FraudEngine:
 
         return decision, fired_rules, features
 
+    def process_batch(self, transactions):
+        """
+        Process a fetched batch of transactions with the same results as
+        calling process on each in order, evaluating rules for many at once.
+
+        A transaction's features depend only on its own customer's earlier
+        transactions, so the batch runs in waves: the first transaction of
+        every customer, then the second, and so on. Within a wave every
+        customer appears once, so all features are read, all rules
+        evaluated in one pass, and only then the features updated.
+        Returns (decision, fired_rules, features) per transaction.
+        """
+        waves = []
+        seen = {}
+        for i, transaction in enumerate(transactions):
+            cid = transaction["customer_id"]
+            wave = seen.get(cid, 0)
+            seen[cid] = wave + 1
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(i)
+
+        results = [None] * len(transactions)
+        for wave in waves:
+            batch = [transactions[i] for i in wave]
+            features = [self.feature_store.read_features(t["customer_id"], t["timestamp"]) for t in batch]
+            fired = self.rule_engine.evaluate_batch(batch, features)
+
+            for i, transaction, transaction_features, fired_rules in zip(wave, batch, features, fired):
+                results[i] = ("BLOCK" if fired_rules else "APPROVE", fired_rules, transaction_features)
+                self.feature_store.update(transaction)
+
+        return results
+
     def update(self, event):
         """Update feature store from any event source."""
-        self.feature_store.update(event)
\ No newline at end of file
+        self.feature_store.update(event)
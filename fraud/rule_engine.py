@@ -1,42 +1,474 @@
+import operator
+import threading
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+# Condition operators; on NumPy columns they compare element-wise
+OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+# One evaluate call in SAMPLE_EVERY also evaluates every predicate, to
+# measure how often each holds. A sample interprets every condition, so
+# with hundreds of rules it costs as much as hundreds of calls.
+SAMPLE_EVERY = 1024
+
+# Conditions are reordered, if their measured selectivity says so, every
+# REORDER_EVERY samples
+REORDER_EVERY = 64
+
+# Most rule sets compiled for particular index keys that are kept; other
+# keys evaluate every rule
+MAX_SPECIALIZED = 1024
+
+EQUALITY_OPS = ("==", "!=")
+RANGE_OPS = (">", ">=", "<", "<=")
+
+# Index key component of a value no equality predicate tests for
+OTHER = object()
+
+# Python types whose values NumPy compares as Python would: numbers, as
+# int64 or float64 columns, or strings, as unicode columns. A column
+# mixing the two becomes unicode, and one holding None becomes object.
+NUMERIC_TYPES = {bool, int, float}
+
+
+def as_column(values: list):
+    """
+    values as a NumPy column, or None unless they are all numbers or all
+    strings. Comparisons on the column then give the same results as on
+    each value, and raise TypeError where those would.
+    """
+    types = set(map(type, values))
+    if types <= NUMERIC_TYPES:
+        column = np.array(values)
+        return column if column.dtype.kind in "biuf" else None  # ints beyond int64 make an object column
+    if types == {str}:
+        return np.array(values)
+    return None
+
+
+def predicate_key(condition) -> tuple:
+    """Conditions with the same key are the same predicate, whichever rule has them."""
+    return (condition["source"], condition["field"], condition["op"], condition["value"])
+
+
+def predicate_source(key, constant) -> str:
+    """
+    A predicate as a Python expression over fget/tget, the features' and
+    transaction's get. constant(value) gives the name the field and value
+    are bound to, since their reprs aren't always valid source (inf, nan).
+    """
+    source, field, op, value = key
+    if op not in OPS:
+        return "False"  # unknown operators never hold
+    if source == "features":
+        actual = f"fget({constant(field)}, 0)"
+    else:
+        actual = f"tget({constant(field)})"
+    return f"{actual} {op} {constant(value)}"
+
+
+def compile_rules(rules: dict):
+    """
+    Generate an evaluate(transaction, features) function for rules, whose
+    conditions are tested in the order given. Each rule becomes nested
+    ifs that append its name to the fired list. A predicate used by more
+    than one rule is computed once, by the first rule that reaches it,
+    into a local the others reuse. Rule names, fields and values are
+    bound as globals _c0, _c1, ... rather than written into the source.
+    Returns the function and its source.
+    """
+    uses = {}
+    for conditions in rules.values():
+        for condition in conditions:
+            key = predicate_key(condition)
+            uses[key] = uses.get(key, 0) + 1
+    shared = {key: f"p{i}" for i, key in enumerate(key for key, count in uses.items() if count > 1)}
+
+    namespace = {}
+
+    def constant(value):
+        name = f"_c{len(namespace)}"
+        namespace[name] = value
+        return name
+
+    lines = [
+        "def evaluate(transaction, features):",
+        "    fget = features.get",
+        "    tget = transaction.get",
+        "    fired = []",
+    ]
+    if shared:
+        lines.append("    " + " = ".join(shared.values()) + " = None")
+
+    for rule_name, conditions in rules.items():
+        indent = "    "
+        for condition in conditions:
+            key = predicate_key(condition)
+            name = shared.get(key)
+            if name is None:
+                lines.append(f"{indent}if {predicate_source(key, constant)}:")
+            else:
+                lines.append(f"{indent}if {name} is None:")
+                lines.append(f"{indent}    {name} = {predicate_source(key, constant)}")
+                lines.append(f"{indent}if {name}:")
+            indent += "    "
+        lines.append(f"{indent}fired.append({constant(rule_name)})")
+
+    lines.append("    return fired")
+    source = "\n".join(lines) + "\n"
+
+    exec(compile(source, "<rules>", "exec"), namespace)
+    return namespace["evaluate"], source
+
+
+def build_index(rules: dict) -> dict:
+    """
+    The predicate index: for each transaction field that conditions test
+    with an equality, or a range against a number, the values they test
+    for and the sorted range thresholds:
+        field -> (equality values, thresholds)
+    """
+    index = {}
+    for conditions in rules.values():
+        for condition in conditions:
+            if condition["source"] == "features":
+                continue
+            values, thresholds = index.setdefault(condition["field"], ({}, []))
+            value = condition["value"]
+            if condition["op"] in EQUALITY_OPS:
+                values[value] = value
+            elif condition["op"] in RANGE_OPS and isinstance(value, (int, float)) and value not in thresholds \
+                    and value == value:  # nan can't be sorted among the thresholds
+                thresholds.append(value)
+
+    return {field: (values, sorted(thresholds)) for field, (values, thresholds) in index.items() if values or thresholds}
+
+
+def compile_index_key(index: dict):
+    """
+    Generate an index_key(transaction) function for an index: per field,
+    the tested value it equals (or OTHER), and where it falls among the
+    thresholds as (number below it, number at or below it). That decides
+    every indexed predicate. Raises TypeError for values the index can't
+    hold, like None for a range field.
+    """
+    namespace = {"OTHER": OTHER, "bisect_left": bisect_left, "bisect_right": bisect_right}
+    lines = [
+        "def index_key(transaction):",
+        "    tget = transaction.get",
+    ]
+    parts = []
+    for i, (field, (values, thresholds)) in enumerate(index.items()):
+        namespace[f"F{i}"] = field
+        lines.append(f"    v{i} = tget(F{i})")
+        if values:
+            namespace[f"EQ{i}"] = values
+            parts.append(f"EQ{i}.get(v{i}, OTHER)")
+        if thresholds:
+            namespace[f"T{i}"] = thresholds
+            parts += [f"bisect_left(T{i}, v{i})", f"bisect_right(T{i}, v{i})"]
+    lines.append("    return (" + "".join(part + ", " for part in parts) + ")")
+
+    exec(compile("\n".join(lines) + "\n", "<index>", "exec"), namespace)
+    return namespace["index_key"]
+
+
+def resolve(index: dict, key: tuple, condition):
+    """Whether a condition holds for transactions with this index key, or None if the index can't tell."""
+    op = condition["op"]
+    if op not in OPS:
+        return False
+    if condition["source"] == "features" or condition["field"] not in index:
+        return None
+
+    position = 0
+    for field, (values, thresholds) in index.items():
+        if field == condition["field"]:
+            break
+        position += bool(values) + 2 * bool(thresholds)
+
+    values, thresholds = index[condition["field"]]
+    value = condition["value"]
+    if op in EQUALITY_OPS:
+        equal = key[position] is not OTHER and key[position] == value
+        return equal if op == "==" else not equal
+    if value not in thresholds:
+        return None
+    i = thresholds.index(value)
+    below, at_or_below = key[position + bool(values):position + bool(values) + 2]
+    if op == ">":
+        return i < below
+    if op == ">=":
+        return i < at_or_below
+    if op == "<":
+        return i >= at_or_below
+    return i >= below
+
+
+class CompiledRules:
+    """
+    One compilation of a rule set: the conditions in the order tested,
+    the compiled function for all of them, the predicate index and the
+    rule sets specialized per index key. The index key function and the
+    specializations belong together, so RuleEngine replaces a
+    CompiledRules whole instead of changing it; a call that read the old
+    one keeps using it consistently.
+    """
+
+    __slots__ = ("conditions", "compiled", "source", "all_rules", "index", "index_key", "specialized")
+
+    def __init__(self, conditions: dict):
+        self.conditions = conditions  # rule name -> conditions, in the order tested
+        self.compiled, self.source = compile_rules(conditions)
+        self.all_rules = (conditions, self.compiled, 0)
+
+        self.index = build_index(conditions)
+        self.index_key = compile_index_key(self.index)
+        self.specialized = {}  # index key -> (candidate rules' conditions, compiled, rules pruned)
+
+    def candidates(self, transaction) -> tuple:
+        """The rules that can fire for a transaction, as (conditions, compiled, rules pruned)."""
+        try:
+            key = self.index_key(transaction)
+        except TypeError:
+            return self.all_rules
+
+        candidates = self.specialized.get(key)
+        if candidates is None:
+            if len(self.specialized) >= MAX_SPECIALIZED:
+                return self.all_rules
+            candidates = self.specialized[key] = self.specialize(key)
+        return candidates
+
+    def specialize(self, key: tuple) -> tuple:
+        conditions = {}
+        for rule_name, rule_conditions in self.conditions.items():
+            remaining = []
+            for condition in rule_conditions:
+                held = resolve(self.index, key, condition)
+                if held is False:
+                    break
+                if held is None:
+                    remaining.append(condition)
+            else:
+                conditions[rule_name] = remaining
+
+        return conditions, compile_rules(conditions)[0], len(self.conditions) - len(conditions)
+
+
 class RuleEngine:
+    """
+    Evaluates rules, each a list of conditions that must all hold:
+        {"field": ..., "source": "features" | "transaction", "op": ..., "value": ...}
+
+    The rules are compiled into a Python function (see compile_rules), so
+    evaluating them is plain comparisons rather than interpreting the
+    condition dicts. A sample of calls measures how often each predicate
+    holds, and each rule's conditions are recompiled to test the most
+    selective first: conditions only read values, so their order doesn't
+    change which rules fire, and range tests stay behind the conditions
+    that guarded them (see _selective_order). Setting rules, or set_rule
+    and remove_rule, recompiles them.
+
+    A predicate index (see build_index) over the transaction fields that
+    conditions test for equality or a range prunes the rules that can't
+    fire: each transaction's index key decides those conditions, and the
+    rules left, without the conditions already known to hold, are
+    compiled once per key. stats() reports how many rules were pruned.
+
+    One engine may be shared by several threads: each call reads the
+    current CompiledRules once, and recompiling builds a new one before
+    swapping it in.
+    """
+
     def __init__(self, rules):
+        self.lock = threading.Lock()  # serializes recompiling
         self.rules = rules
 
-    def _check_condition(self, actual, op, expected):
-        if op == "==":
-            return actual == expected
-        elif op == "!=":
-            return actual != expected
-        elif op == ">":
-            return actual > expected
-        elif op == ">=":
-            return actual >= expected
-        elif op == "<":
-            return actual < expected
-        elif op == "<=":
-            return actual <= expected
-        return False
+    @property
+    def rules(self) -> dict:
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        rules = dict(rules)
+        compiled = CompiledRules(rules)
+        with self.lock:
+            self._rules = rules
+            self.calls = 0
+            self.samples = 0
+            self.passed = {}  # predicate key -> times it held in samples
+            self.pruned = 0   # rule evaluations the index skipped
+            self.compiled = compiled
+
+    def set_rule(self, rule_name, conditions):
+        """Add or replace a rule."""
+        rules = dict(self._rules)
+        rules[rule_name] = conditions
+        self.rules = rules
+
+    def remove_rule(self, rule_name):
+        rules = dict(self._rules)
+        del rules[rule_name]
+        self.rules = rules
+
+    def _candidates(self, compiled: CompiledRules, transaction) -> tuple:
+        candidates = compiled.candidates(transaction)
+        self.pruned += candidates[2]
+        return candidates
+
+    def stats(self) -> dict:
+        compiled = self.compiled
+        return {
+            "transactions": self.calls,
+            "rules": len(self._rules),
+            "rules_evaluated": self.calls * len(self._rules) - self.pruned,
+            "rules_pruned": self.pruned,
+            "index_fields": list(compiled.index),
+            "index_keys": len(compiled.specialized),
+        }
 
     def evaluate(self, transaction, features):
         """Evaluate all rules. Returns list of rule names that fired."""
-        fired = []
-
-        for rule_name, conditions in self.rules.items():
-            all_true = True
+        self.calls += 1
+        if self.calls % SAMPLE_EVERY == 0:
+            self._sample(transaction, features)
+        return self._candidates(self.compiled, transaction)[1](transaction, features)
 
+    def _sample(self, transaction, features):
+        """Count which predicates hold for this call, and reorder conditions every REORDER_EVERY samples."""
+        held = {}
+        rules = self._rules
+        for conditions in rules.values():
             for condition in conditions:
-                # Get the actual value from the right source
+                key = predicate_key(condition)
+                if key in held:
+                    continue
                 if condition["source"] == "features":
                     actual = features.get(condition["field"], 0)
                 else:
                     actual = transaction.get(condition["field"])
+                op = OPS.get(condition["op"])
+                try:
+                    held[key] = op is not None and bool(op(actual, condition["value"]))
+                except TypeError:
+                    # e.g. a missing field against a range; evaluate only gets
+                    # here when earlier conditions held
+                    held[key] = False
+
+        for key, value in held.items():
+            self.passed[key] = self.passed.get(key, 0) + value
+
+        self.samples += 1
+        if self.samples % REORDER_EVERY == 0:
+            self._reorder(rules)
+
+    def _reorder(self, rules: dict):
+        """
+        Recompile if ordering each rule's conditions by how rarely they
+        hold changes anything, unless the rules were replaced meanwhile.
+        """
+        with self.lock:
+            if rules is not self._rules:
+                return
+            ordered = {rule_name: self._selective_order(conditions) for rule_name, conditions in rules.items()}
+            if ordered != self.compiled.conditions:
+                self.compiled = CompiledRules(ordered)
+
+    def _selective_order(self, conditions: list) -> list:
+        """
+        A rule's conditions, the ones that held least often in samples
+        first. A range test raises TypeError on a missing field where an
+        earlier condition may have kept it from being reached, so range
+        tests never move ahead of a condition listed before them; equality
+        tests can't raise and move freely.
+        """
+        def pass_rate(condition):
+            return self.passed.get(predicate_key(condition), 0)
+
+        remaining = list(conditions)
+        ordered = []
+        while remaining:
+            movable = [condition for i, condition in enumerate(remaining) if i == 0 or condition["op"] not in RANGE_OPS]
+            condition = min(movable, key=pass_rate)
+            ordered.append(condition)
+            remaining.remove(condition)
+        return ordered
+
+    def evaluate_batch(self, transactions, features):
+        """
+        Evaluate all rules for many transactions at once, each with its
+        features. Rows are grouped by their candidate rules. In each group
+        every field a condition reads becomes one NumPy column, and each
+        condition one comparison over the rows where its rule is still
+        true, like evaluate's early exit. A group with a field whose values
+        NumPy wouldn't compare like Python, e.g. numbers mixed with strings
+        or None (see as_column), is evaluated a row at a time instead.
+        Returns a list of fired rule names per transaction.
+        """
+        for row in range((-self.calls - 1) % SAMPLE_EVERY, len(transactions), SAMPLE_EVERY):
+            self._sample(transactions[row], features[row])
+        self.calls += len(transactions)
 
-                # Check the condition
-                if not self._check_condition(actual, condition["op"], condition["value"]):
-                    all_true = False
+        compiled = self.compiled
+        groups = {}  # id of candidates -> (candidates, rows)
+        for row, transaction in enumerate(transactions):
+            candidates = self._candidates(compiled, transaction)
+            groups.setdefault(id(candidates), (candidates, []))[1].append(row)
+
+        fired = [[] for _ in transactions]
+        for (conditions, compiled, pruned), rows in groups.values():
+            group_transactions = [transactions[row] for row in rows]
+            group_features = [features[row] for row in rows]
+            group_fired = self._evaluate_columns(conditions, group_transactions, group_features)
+            if group_fired is None:
+                group_fired = [compiled(transaction, row_features)
+                               for transaction, row_features in zip(group_transactions, group_features)]
+            for row, rule_names in zip(rows, group_fired):
+                fired[row] = rule_names
+
+        return fired
+
+    def _evaluate_columns(self, conditions: dict, transactions, features):
+        """Fired rule names per row, or None once a field read turns out not to fit one column."""
+        columns = {}
+
+        def column(condition):
+            key = (condition["source"], condition["field"])
+            if key not in columns:
+                field = condition["field"]
+                if condition["source"] == "features":
+                    values = [row.get(field, 0) for row in features]
+                else:
+                    values = [row.get(field) for row in transactions]
+                columns[key] = as_column(values)
+            return columns[key]
+
+        fired = [[] for _ in transactions]
+        for rule_name, rule_conditions in conditions.items():
+            alive = np.ones(len(transactions), dtype=bool)
+            for condition in rule_conditions:
+                rows = np.flatnonzero(alive)
+                if not len(rows):
+                    break
+                op = OPS.get(condition["op"])
+                if op is None:
+                    alive[rows] = False
                     break
+                values = column(condition)
+                if values is None:
+                    return None
+                alive[rows] = op(values[rows], condition["value"])
 
-            if all_true:
-                fired.append(rule_name)
+            for row in np.flatnonzero(alive):
+                fired[row].append(rule_name)
 
         return fired
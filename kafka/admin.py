@@ -0,0 +1,94 @@
+from protocol import ByteWriter, API_METRICS, ERR_NONE
+from client import BrokerConnection
+
+
+# Escape sequences in quoted label values (see metrics.escape_label_value)
+LABEL_ESCAPES = {'\\': '\\', '"': '"', 'n': '\n'}
+
+
+def parse_labels(labels: str) -> tuple:
+    """
+    Parse the label pairs after a metric name's '{', up to the closing
+    '}', into ((label, value), ...). Values are quoted and may hold
+    commas, braces and escaped quotes, so they are scanned a character at
+    a time rather than split.
+    """
+    pairs = []
+    i = 0
+    while i < len(labels) and labels[i] != '}':
+        equals = labels.index('=', i)
+        label = labels[i:equals].strip(' ,')
+        if labels[equals + 1] != '"':
+            raise ValueError(f"Unquoted value for label {label!r}")
+        value = []
+        i = equals + 2
+        while labels[i] != '"':
+            if labels[i] == '\\':
+                i += 1
+                value.append(LABEL_ESCAPES.get(labels[i], '\\' + labels[i]))
+            else:
+                value.append(labels[i])
+            i += 1
+        pairs.append((label, ''.join(value)))
+        i += 1
+        if i < len(labels) and labels[i] == ',':
+            i += 1
+    return tuple(pairs)
+
+
+class Admin:
+    """Monitoring requests to one broker."""
+
+    def __init__(self, host='localhost', port=9092, client_id='admin'):
+        self.client_id = client_id
+        self.correlation_id = 0
+        self.connection = BrokerConnection(host, port)
+
+    def _build_header(self, api_key: int) -> ByteWriter:
+        self.correlation_id += 1
+        writer = ByteWriter()
+        writer.write_int16(api_key)
+        writer.write_int16(1)
+        writer.write_int32(self.correlation_id)
+        writer.write_string(self.client_id)
+        return writer
+
+    def metrics_text(self) -> str:
+        """The broker's metrics in Prometheus' plaintext format (see Broker.metrics_text)."""
+        buf = self.connection.roundtrip(self._build_header(API_METRICS).buffer())
+        error_code = buf.read_int16()
+        if error_code != ERR_NONE:
+            raise RuntimeError(f"Failed to read metrics: error {error_code}")
+        return buf.read_bytes().decode('utf-8')
+
+    def metrics(self) -> dict:
+        """The broker's metrics as {(name, ((label, value), ...)): number}."""
+        metrics = {}
+        for line in self.metrics_text().splitlines():
+            if not line or line.startswith('#'):
+                continue
+            series, value = line.rsplit(' ', 1)
+            name, _, labels = series.partition('{')
+            metrics[(name, parse_labels(labels))] = float(value)
+        return metrics
+
+    def consumer_lag(self, group: str) -> dict:
+        """How far a group's committed offsets are behind: {(topic, partition): records}."""
+        lag = {}
+        for (name, labels), value in self.metrics().items():
+            labels = dict(labels)
+            if name == "consumer_group_lag" and labels["group"] == group:
+                lag[(labels["topic"], int(labels["partition"]))] = int(value)
+        return lag
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else 'localhost:9092').partition(':')
+    admin = Admin(host, int(port or 9092))
+    print(admin.metrics_text(), end='')
+    admin.close()
@@ -0,0 +1,233 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from protocol import (
+    ByteBuffer, FileRegion, FRAME_SIZE, read_request_header, build_response,
+    API_FETCH, API_PRODUCE, API_PRODUCE_BATCH, API_JOIN_GROUP, ERR_NONE,
+)
+
+
+class AsyncServer:
+    """
+    Serves all broker connections from a single asyncio event loop.
+
+    The loop only does socket I/O. Request handlers touch the disk, so they
+    run on a bounded thread pool. Requests that wait wait on the loop itself
+    instead of holding a pool thread: long-poll fetches and acks=-1
+    produces (woken by partition listeners), and group joins until the
+    rebalance completes (woken by group listeners). Otherwise a handful of
+    them would fill the pool and stall every other request.
+
+    Each connection is pipelined: a reader task keeps pulling requests off
+    the socket, up to max_in_flight ahead, while requests are processed and
+    answered in order. Ordering matters since a producer may have several
+    requests for the same partition in flight.
+    """
+
+    def __init__(self, broker, io_threads: int = 8, max_in_flight: int = 32, replication_timeout: float = 10.0):
+        """replication_timeout bounds an acks=-1 produce's wait, as REPLICATION_TIMEOUT does for the broker."""
+        self.broker = broker
+        self.replication_timeout = replication_timeout
+        self.executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='broker-io')
+        self.max_in_flight = max_in_flight
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, self.broker.host, self.broker.port)
+
+        print(f"Broker listening on {self.broker.host}:{self.broker.port} (asyncio)")
+        print("=" * 50)
+
+        async with server:
+            await server.serve_forever()
+
+    # ──────────────────────────────────────────────
+    # Connections
+    # ──────────────────────────────────────────────
+
+    async def handle_connection(self, reader, writer):
+        requests = asyncio.Queue(maxsize=self.max_in_flight)
+        read_task = asyncio.create_task(self.read_requests(reader, requests))
+
+        try:
+            while True:
+                data = await requests.get()
+                if data is None:
+                    break
+
+                response = await self.handle_request(data)
+                if response is not None:
+                    await self.send_response(writer, response)
+        except ConnectionError:
+            pass
+        finally:
+            read_task.cancel()
+            writer.close()
+
+    async def read_requests(self, reader, requests: asyncio.Queue):
+        """Read length-prefixed requests ahead of processing. Queues None on disconnect."""
+        try:
+            while True:
+                size_bytes = await reader.readexactly(4)
+                data = await reader.readexactly(FRAME_SIZE.unpack(size_bytes)[0])
+                await requests.put(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            await requests.put(None)
+
+    async def send_response(self, writer, parts: list):
+        """Write a framed response. File regions go out via loop.sendfile."""
+        loop = asyncio.get_running_loop()
+        total = sum(len(part) for part in parts)
+        writer.write(FRAME_SIZE.pack(total))
+
+        try:
+            for part in parts:
+                if not isinstance(part, FileRegion):
+                    writer.write(part)
+                    continue
+
+                await writer.drain()
+                with open(part.fd, 'rb', closefd=False) as f:
+                    await loop.sendfile(writer.transport, f, part.offset, part.count)
+            await writer.drain()
+        finally:
+            for part in parts:
+                if isinstance(part, FileRegion):
+                    part.close()
+
+    # ──────────────────────────────────────────────
+    # Requests
+    # ──────────────────────────────────────────────
+
+    async def handle_request(self, data: bytes) -> list:
+        loop = asyncio.get_running_loop()
+        buf = ByteBuffer(data)
+        api_key, api_version, correlation_id, client_id = read_request_header(buf)
+
+        started = time.perf_counter()
+        if api_key == API_FETCH:
+            response_body = await self.handle_fetch(buf)
+        elif api_key in (API_PRODUCE, API_PRODUCE_BATCH):
+            response_body = await self.handle_produce(api_key, buf)
+        elif api_key == API_JOIN_GROUP and self.broker.is_coordinator():
+            response_body = await self.handle_join_group(buf)
+        else:
+            response_body = await loop.run_in_executor(self.executor, self.broker.dispatch, api_key, buf)
+        self.broker.record_latency(api_key, time.perf_counter() - started)
+
+        return build_response(correlation_id, response_body)
+
+    async def handle_fetch(self, buf: ByteBuffer) -> list:
+        loop = asyncio.get_running_loop()
+        request = self.broker.read_fetch_request(buf)
+        fetches = self.broker.fetch_partitions(request)
+
+        if request["max_wait_ms"] > 0 and request["min_bytes"] > 0:
+            await self.wait_for_data(fetches, request["min_bytes"], request["max_wait_ms"] / 1000)
+
+        return await loop.run_in_executor(self.executor, self.broker.fetch_response, request, fetches)
+
+    async def wait_for_data(self, fetches: list, min_bytes: int, timeout: float):
+        """Event-loop version of Broker.wait_for_data."""
+        loop = asyncio.get_running_loop()
+        partitions = [(partition, offset) for error_code, partition, offset, _ in fetches if error_code == ERR_NONE]
+        deadline = loop.time() + timeout
+        woken = asyncio.Event()
+
+        def on_append():
+            loop.call_soon_threadsafe(woken.set)
+
+        for partition, _ in partitions:
+            partition.listeners.add(on_append)
+        try:
+            baseline = sum(partition.bytes_appended for partition, _ in partitions)
+            available = await loop.run_in_executor(
+                self.executor,
+                lambda: sum(partition.bytes_available(offset, min_bytes) for partition, offset in partitions))
+
+            while available + sum(partition.bytes_appended for partition, _ in partitions) - baseline < min_bytes:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(woken.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                woken.clear()
+        finally:
+            for partition, _ in partitions:
+                partition.listeners.discard(on_append)
+
+    async def handle_produce(self, api_key: int, buf: ByteBuffer) -> bytes:
+        """Write on the pool, then wait for acks=-1 replication on the loop (see Broker.complete_produce)."""
+        loop = asyncio.get_running_loop()
+        produce = self.broker.produce if api_key == API_PRODUCE else self.broker.produce_batch
+        waits, respond = await loop.run_in_executor(self.executor, produce, buf)
+        replicated = await asyncio.gather(*(self.wait_for_replicas(partition, upto_offset)
+                                            for partition, upto_offset in waits))
+        return respond(list(replicated))
+
+    async def wait_for_replicas(self, partition, upto_offset: int) -> bool:
+        """Event-loop version of Broker.wait_for_replicas."""
+        if partition.high_watermark >= upto_offset:
+            return True
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.replication_timeout
+        woken = asyncio.Event()
+
+        def on_change():
+            loop.call_soon_threadsafe(woken.set)
+
+        partition.listeners.add(on_change)
+        try:
+            while partition.high_watermark < upto_offset:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(woken.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return partition.high_watermark >= upto_offset
+                woken.clear()
+            return True
+        finally:
+            partition.listeners.discard(on_change)
+
+    async def handle_join_group(self, buf: ByteBuffer) -> bytes:
+        """
+        Join on the pool, then wait for the rebalance on the loop, checking
+        again whenever the group completes one or its deadline passes
+        (see GroupCoordinator.finish_join).
+        """
+        loop = asyncio.get_running_loop()
+        coordinator = self.broker.coordinator
+        request = self.broker.read_join_request(buf)
+        consumer_id = request[1]
+
+        result, pending = await loop.run_in_executor(self.executor, coordinator.begin_join, *request)
+        if pending is not None:
+            group, generation = pending
+            woken = asyncio.Event()
+
+            def on_complete():
+                loop.call_soon_threadsafe(woken.set)
+
+            group.listeners.add(on_complete)
+            try:
+                while True:
+                    result = await loop.run_in_executor(
+                        self.executor, coordinator.finish_join, group, generation, consumer_id, False)
+                    if result is not None:
+                        break
+                    try:
+                        await asyncio.wait_for(woken.wait(), max(group.deadline - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        pass
+                    woken.clear()
+            finally:
+                group.listeners.discard(on_complete)
+
+        return self.broker.join_response(result)
@@ -1,190 +1,817 @@
 ## NEXT STEPS: add interfances because currently the payload details are only known to these functions
 
+import json
+import os
 import socket
 import threading
+import time
 from protocol import (
     ByteBuffer, ByteWriter,
-    recv_framed, send_framed,
-    API_PRODUCE, API_FETCH, API_JOIN_GROUP, API_CREATE_TOPIC,
-    ERR_NONE, ERR_UNKNOWN_TOPIC, ERR_UNKNOWN_PARTITION,
+    FrameReader, send_framed_parts, read_request_header, build_response,
+    encode_records, decode_records,
+    API_PRODUCE, API_FETCH, API_JOIN_GROUP, API_CREATE_TOPIC, API_PRODUCE_BATCH, API_METADATA,
+    API_OFFSET_COMMIT, API_OFFSET_FETCH, API_LIST_OFFSETS, API_HEARTBEAT, API_LEAVE_GROUP,
+    API_BROKER_HEARTBEAT, API_ALTER_ISR, API_METRICS, API_NAMES,
+    LATEST_TIMESTAMP, EARLIEST_TIMESTAMP,
+    ERR_NONE, ERR_UNKNOWN_TOPIC, ERR_UNKNOWN_PARTITION, ERR_UNSUPPORTED_CODEC,
+    ERR_NOT_LEADER, ERR_OFFSET_OUT_OF_RANGE, ERR_NOT_ENOUGH_REPLICAS, ERR_NOT_COORDINATOR,
+    ERR_INVALID_CONFIG, ERR_INTERNAL_TOPIC,
 )
-from partition import Partition
+from cleaner import LogCleaner
+from cluster import ClusterManager
+from compression import CODECS, get_codec
+from coordinator import GroupCoordinator
+from metrics import Histogram, MetricsWriter, MetricsServer
+from offsets import OffsetStore, OFFSETS_TOPIC
+from partition import LazyPartitions, parse_config_value
+from partitioner import default_partitioner
+
+# How often the background flusher applies time-based flush policies
+FLUSH_CHECK_INTERVAL = 0.1
+
+# How often partitions save their recovery point (see Partition.checkpoint)
+CHECKPOINT_INTERVAL = 10.0
+
+# How often the log cleaner applies retention and compaction
+CLEANER_INTERVAL = 15.0
+
+# Topic names, partition counts and configs, so topics survive a restart
+TOPICS_FILE = "topics.json"
+
+# Produce acks levels
+ACKS_NONE = 0    # no response at all
+ACKS_LEADER = 1  # record written to the leader's log (OS page cache)
+ACKS_ALL = -1    # record fsynced to disk, and in a cluster copied by every in-sync replica
+
+# How long an acks=-1 produce waits for the in-sync replicas
+REPLICATION_TIMEOUT = 10.0
+
+# Requests served by the group coordinator, which in a cluster is the controller
+GROUP_APIS = (API_JOIN_GROUP, API_HEARTBEAT, API_LEAVE_GROUP, API_OFFSET_COMMIT, API_OFFSET_FETCH)
 
 
 class Broker:
-    def __init__(self, host='localhost', port=9092, log_dir='./data', topics=None):
+    def __init__(self, host='localhost', port=9092, log_dir='./data', topics=None,
+                 broker_id=0, cluster=None, metrics_port=None):
+        """
+        cluster maps every broker's id to its (host, port), this one
+        included, to run as one broker of a cluster (see cluster.py).
+        Without it the broker runs alone and leads every partition.
+        metrics_port serves the broker's metrics over HTTP for scraping;
+        they are also available through the METRICS request.
+        """
         self.host = host
         self.port = port
         self.log_dir = log_dir
+        self.broker_id = broker_id
+        self.metrics_port = metrics_port
+        self.request_latency = {}  # api_key -> Histogram of microseconds
+        self.started_at = time.time()
         self.topics = {}
-        self.consumer_groups = {}
+        self.topic_configs = {}
+        self.coordinator = GroupCoordinator(self.topics)
+        self.offsets = OffsetStore(log_dir)
 
         self.lock = threading.Lock()
+        self.load_topics()
+        self.cluster = ClusterManager(self, broker_id, cluster) if cluster else None
         if topics:
             for name, num_partitions in topics.items():
                 self.create_topic(name, num_partitions)
 
 
 
-    def create_topic(self, name: str, num_partitions: int):
-        """Create a new topic with the given number of partitions."""
+    def load_topics(self):
+        """
+        Register the topics saved in TOPICS_FILE. Their partitions are only
+        opened when first used, so startup does not depend on log size.
+        """
+        path = os.path.join(self.log_dir, TOPICS_FILE)
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            self.topic_configs = json.load(f)
+
+        for name, topic in self.topic_configs.items():
+            topic["config"] = self.load_config(name, topic["config"])
+            self.topics[name] = LazyPartitions(self.log_dir, name, topic["partitions"], topic["config"])
+
+    def load_config(self, topic: str, config: dict) -> dict:
+        """
+        A saved topic config with each value as the type of its default.
+        Older versions saved some values as strings; invalid ones are
+        dropped, so the topic falls back to the defaults for them.
+        """
+        loaded = {}
+        for name, value in config.items():
+            try:
+                loaded[name] = parse_config_value(name, str(value))
+            except ValueError as e:
+                print(f"  Ignoring config of topic '{topic}': {e}")
+        return loaded
+
+    def save_topics(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        path = os.path.join(self.log_dir, TOPICS_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(self.topic_configs, f)
+        os.replace(path + ".tmp", path)
+
+    def create_topic(self, name: str, num_partitions: int, config: dict = None) -> int:
+        """
+        Create a new topic with the given number of partitions.
+        config overrides partition defaults (see partition.DEFAULT_CONFIG).
+        In a cluster the controller assigns its replicas and every broker
+        registers it. Returns an error code.
+        """
+        if name == OFFSETS_TOPIC:
+            print(f"  Rejected topic '{name}': internal")
+            return ERR_INTERNAL_TOPIC
+        try:
+            config = {key: parse_config_value(key, str(value)) for key, value in (config or {}).items()}
+        except ValueError as e:
+            print(f"  Rejected topic '{name}': {e}")
+            return ERR_INVALID_CONFIG
+
+        if self.cluster is not None:
+            return self.cluster.create_topic(name, num_partitions, config)
+        self.register_topic(name, num_partitions, config)
+        return ERR_NONE
+
+    def register_topic(self, name: str, num_partitions: int, config: dict = None):
+        """Add a topic to this broker, unless it already has it."""
         with self.lock:
             if name in self.topics:
                 return
 
-            partitions = []
-            for i in range(num_partitions):
-                partitions.append(Partition(self.log_dir, name, i))
-
-            self.topics[name] = partitions
+            self.topics[name] = LazyPartitions(self.log_dir, name, num_partitions, config)
+            self.topic_configs[name] = {"partitions": num_partitions, "config": config or {}}
+            self.save_topics()
             print(f"  Topic created: '{name}' ({num_partitions} partitions)")
 
 
-    def join_group(self, group: str, consumer_id: str, topic: str) -> int:
+    def handle_produce(self, buf: ByteBuffer) -> bytes:
         """
-        Add a consumer to a group and assign it a partition.
-        Returns the assigned partition index.
+        PRODUCE request payload:
+            [acks: 2][topic: string][partition: 4][key: string][value: bytes]
+            partition -1 means "pick a partition from the key".
+        Response (none when acks == 0):
+            [error_code: 2][partition: 4][offset: 8]
         """
-        with self.lock:
-            if topic not in self.topics:
-                return -1
+        return self.complete_produce(*self.produce(buf))
 
-            num_partitions = len(self.topics[topic])
+    def complete_produce(self, waits: list, respond):
+        """
+        Finish a produce started by produce or produce_batch: wait for each
+        (partition, upto_offset) in waits to be replicated (see
+        wait_for_replicas), then return respond(whether each was).
+        The asyncio server waits on its event loop instead.
+        """
+        return respond([self.wait_for_replicas(partition, upto_offset) for partition, upto_offset in waits])
+
+    def produce(self, buf: ByteBuffer) -> tuple:
+        """Write a PRODUCE request's record. Returns (waits, respond) for complete_produce."""
+        acks = buf.read_int16()
+        topic = buf.read_string()
+        partition_index = buf.read_int32()
+        key = buf.read_string()
+        value = buf.read_view()
 
-            if group not in self.consumer_groups:
-                self.consumer_groups[group] = {}
+        if partition_index < 0 and topic in self.topics:
+            partition_index = default_partitioner(key, len(self.topics[topic]))
+        error_code, partition = self.leader_partition(topic, partition_index)
+        if error_code == ERR_NONE and acks == ACKS_ALL and not self.enough_replicas(topic, partition_index, partition):
+            error_code = ERR_NOT_ENOUGH_REPLICAS
+        if error_code != ERR_NONE:
+            return [], lambda replicated: ByteWriter().write_int16(error_code).write_int32(0).write_int64(0).to_bytes()
 
-            group_members = self.consumer_groups[group]
+        offset = partition.append(key, value)
 
-            # Simple assignment: give the next available partition
-            assigned_partitions = set(group_members.values())
-            for i in range(num_partitions):
-                if i not in assigned_partitions:
-                    group_members[consumer_id] = i
-                    return i
+        if acks == ACKS_NONE:
+            return [], lambda replicated: None
+        waits = []
+        if acks == ACKS_ALL:
+            partition.flush(offset + 1)
+            waits.append((partition, offset + 1))
 
-            return -1
+        def respond(replicated: list) -> bytes:
+            return (ByteWriter()
+                    .write_int16(ERR_NONE if all(replicated) else ERR_NOT_ENOUGH_REPLICAS)
+                    .write_int32(partition_index)
+                    .write_int64(offset)
+                    .to_bytes())
 
+        return waits, respond
 
-    def handle_produce(self, buf: ByteBuffer) -> bytes:
+    def handle_produce_batch(self, buf: ByteBuffer) -> bytes:
         """
-        PRODUCE request payload:
-            [topic: string][key: string][value: bytes]
+        PRODUCE_BATCH request payload:
+            [acks: 2][num_topics: 4]
+            for each topic: [topic: string][num_partitions: 4]
+                for each partition: [partition: 4][codec: 1][num_records: 4][records: bytes]
+            records is the codec-compressed batch payload (see protocol.encode_records)
+            and is stored without decompressing when the partition is given.
+            partition -1 means "pick a partition per record from its key".
+        Response (none when acks == 0), one entry per requested partition in order:
+            [num_entries: 4]
+            for each entry: [error_code: 2][num_records: 4]
+                for each record: [partition: 4][offset: 8]
+            With acks == -1 in a cluster, an entry whose records were written
+            but not copied by the in-sync replicas in time has
+            ERR_NOT_ENOUGH_REPLICAS along with its offsets.
+        """
+        return self.complete_produce(*self.produce_batch(buf))
+
+    def produce_batch(self, buf: ByteBuffer) -> tuple:
+        """Write a PRODUCE_BATCH request's records. Returns (waits, respond) for complete_produce."""
+        acks = buf.read_int16()
+
+        entries = []
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            for _ in range(buf.read_int32()):
+                partition_index = buf.read_int32()
+                codec = buf.read_int8()
+                num_records = buf.read_int32()
+                payload = buf.read_view()
+                entries.append((topic, partition_index, codec, num_records, payload))
+
+        # Each entry's error code and (partition, offset) per record, and the
+        # partitions it wrote to with the offset every record is below
+        results = []
+        for topic, partition_index, codec, num_records, payload in entries:
+            if codec not in CODECS:
+                results.append((ERR_UNSUPPORTED_CODEC, [], {}))
+                continue
+
+            if partition_index >= 0:
+                # Whole batch goes to one partition, still compressed
+                error_code, partition = self.leader_partition(topic, partition_index)
+                if error_code == ERR_NONE and acks == ACKS_ALL \
+                        and not self.enough_replicas(topic, partition_index, partition):
+                    error_code = ERR_NOT_ENOUGH_REPLICAS
+                if error_code != ERR_NONE:
+                    results.append((error_code, [], {}))
+                    continue
+
+                base_offset = partition.append_encoded(codec, num_records, payload)
+                offsets = [(partition_index, base_offset + i) for i in range(num_records)]
+                results.append((ERR_NONE, offsets, {partition: base_offset + num_records}))
+                continue
+
+            # Split by key: group records by target partition, remembering request order
+            if topic not in self.topics:
+                results.append((ERR_INTERNAL_TOPIC if topic == OFFSETS_TOPIC else ERR_UNKNOWN_TOPIC, [], {}))
+                continue
+            records = decode_records(get_codec(codec).decompress(payload), num_records)
+            targets = [default_partitioner(key, len(self.topics[topic])) for key, _ in records]
+
+            groups = {}
+            for target, record in zip(targets, records):
+                groups.setdefault(target, []).append(record)
+
+            # Every target must be led here, with enough in-sync replicas
+            # for acks=-1, before anything is written
+            error_code = ERR_NONE
+            partitions = {}
+            for target in groups:
+                error_code, partitions[target] = self.leader_partition(topic, target)
+                if error_code == ERR_NONE and acks == ACKS_ALL \
+                        and not self.enough_replicas(topic, target, partitions[target]):
+                    error_code = ERR_NOT_ENOUGH_REPLICAS
+                if error_code != ERR_NONE:
+                    break
+            if error_code != ERR_NONE:
+                results.append((error_code, [], {}))
+                continue
+
+            # One write per partition; offsets follow request order within it
+            next_offsets = {}
+            upto = {}
+            for target, group in groups.items():
+                partition = partitions[target]
+                group_payload = get_codec(codec).compress(encode_records(group))
+                next_offsets[target] = partition.append_encoded(codec, len(group), group_payload)
+                upto[partition] = next_offsets[target] + len(group)
+
+            offsets = []
+            for target in targets:
+                offsets.append((target, next_offsets[target]))
+                next_offsets[target] += 1
+            results.append((ERR_NONE, offsets, upto))
+
+        if acks == ACKS_NONE:
+            return [], lambda replicated: None
+
+        # acks=-1 waits for every partition an entry wrote to, in entry order
+        waits = []
+        if acks == ACKS_ALL:
+            for error_code, offsets, upto in results:
+                for partition, upto_offset in upto.items():
+                    partition.flush(upto_offset)
+                    waits.append((partition, upto_offset))
+
+        def respond(replicated: list) -> bytes:
+            replicated = iter(replicated)
+            writer = ByteWriter()
+            writer.write_int32(len(results))
+            for error_code, offsets, upto in results:
+                if acks == ACKS_ALL and not all([next(replicated) for _ in upto]):
+                    error_code = ERR_NOT_ENOUGH_REPLICAS
+
+                writer.write_int16(error_code).write_int32(len(offsets))
+                for partition_index, offset in offsets:
+                    writer.write_int32(partition_index).write_int64(offset)
+            return writer.to_bytes()
+
+        return waits, respond
+
+    def enough_replicas(self, topic: str, partition_index: int, partition) -> bool:
+        """Whether a led partition has the in-sync replicas an acks=-1 produce needs."""
+        return self.cluster is None or self.cluster.enough_replicas(topic, partition_index, partition)
+
+    def wait_for_replicas(self, partition, upto_offset: int) -> bool:
+        """
+        Block until the in-sync replicas have every offset below upto_offset,
+        i.e. the high watermark has reached it, or REPLICATION_TIMEOUT
+        passes. Returns whether it did. A single broker's high watermark is
+        its log end, so it never waits.
+        """
+        if partition.high_watermark >= upto_offset:
+            return True
+
+        deadline = time.monotonic() + REPLICATION_TIMEOUT
+        woken = threading.Event()
+        partition.listeners.add(woken.set)
+        try:
+            while partition.high_watermark < upto_offset:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not woken.wait(remaining):
+                    return partition.high_watermark >= upto_offset
+                woken.clear()
+            return True
+        finally:
+            partition.listeners.discard(woken.set)
+
+    def handle_fetch(self, buf: ByteBuffer) -> list:
+        """
+        FETCH request payload:
+            [replica_id: 4][max_wait_ms: 4][min_bytes: 4][max_bytes: 4][num_topics: 4]
+            for each topic: [topic: string][num_partitions: 4]
+                for each partition: [partition: 4][offset: 8][partition_max_bytes: 4]
+            The broker holds the request until min_bytes are available past
+            the offsets of all requested partitions together, or max_wait_ms
+            has passed, whichever comes first.
+            replica_id is -1 for consumers, which read up to the high
+            watermark. Followers replicating the partition send their broker
+            id and read up to the log end (see cluster.py).
         Response:
-            [error_code: 2][partition: 4][offset: 8]
+            [num_topics: 4]
+            for each topic: [topic: string][num_partitions: 4]
+                for each partition: [partition: 4][error_code: 2][high_watermark: 8]
+                                    [records_size: 4][records]
+            records are record batches sent exactly as stored in the log (see
+            protocol.decode_batches), still compressed, streamed from the segment
+            file with sendfile. The first batch may start before offset and the
+            last one may be cut off by the byte limits; clients skip and drop those.
+            max_bytes is shared fairly between the partitions that have data
+            (see fetch_shares); each one still returns at least one whole batch.
+            Partitions this broker doesn't lead get ERR_NOT_LEADER. A replica
+            fetching past the log end gets ERR_OFFSET_OUT_OF_RANGE with the
+            log end offset as high_watermark.
         """
-        topic = buf.read_string()
-        key = buf.read_string()
-        value = buf.read_bytes()
+        request = self.read_fetch_request(buf)
+        fetches = self.fetch_partitions(request)
+
+        if request["max_wait_ms"] > 0 and request["min_bytes"] > 0:
+            self.wait_for_data(fetches, request["min_bytes"], request["max_wait_ms"] / 1000)
+
+        return self.fetch_response(request, fetches)
+
+    def read_fetch_request(self, buf: ByteBuffer) -> dict:
+        request = {
+            "replica_id": buf.read_int32(),
+            "max_wait_ms": buf.read_int32(),
+            "min_bytes": buf.read_int32(),
+            "max_bytes": buf.read_int32(),
+            "partitions": [],  # (topic, partition, offset, partition_max_bytes)
+        }
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            for _ in range(buf.read_int32()):
+                request["partitions"].append((topic, buf.read_int32(), buf.read_int64(), buf.read_int32()))
+        return request
+
+    def leader_partition(self, topic: str, partition_index: int, replica: bool = False):
+        """
+        Resolve a partition a request reads or writes, which must be led by
+        this broker. In a cluster the offsets log is led by the controller,
+        and only replica fetches may read it: clients get
+        ERR_INTERNAL_TOPIC, since the broker alone writes commits to it.
+        Returns (error_code, partition or None).
+        """
+        if topic == OFFSETS_TOPIC:
+            if not replica or self.cluster is None:
+                return ERR_INTERNAL_TOPIC, None
+            return (ERR_NONE, self.offsets.log) if self.cluster.is_controller() else (ERR_NOT_LEADER, None)
+
+        partitions = self.topics.get(topic)
+        if partitions is None:
+            return ERR_UNKNOWN_TOPIC, None
+        if partition_index < 0 or partition_index >= len(partitions):
+            return ERR_UNKNOWN_PARTITION, None
+        if self.cluster is not None and not self.cluster.is_leader(topic, partition_index):
+            return ERR_NOT_LEADER, None
+        return ERR_NONE, partitions[partition_index]
+
+    def fetch_partitions(self, request: dict) -> list:
+        """
+        A fetch request's partitions as (error_code, partition or None,
+        offset, partition_max_bytes). A follower's fetch offsets tell the
+        leader how far it has replicated.
+        """
+        replica_id = request["replica_id"]
+        fetches = []
+        for topic, partition_index, offset, partition_max_bytes in request["partitions"]:
+            error_code, partition = self.leader_partition(topic, partition_index, replica=replica_id >= 0)
+            if replica_id >= 0 and partition is not None:
+                if offset > partition.next_offset:
+                    error_code = ERR_OFFSET_OUT_OF_RANGE
+                elif topic != OFFSETS_TOPIC:
+                    self.cluster.follower_fetched(topic, partition_index, replica_id, offset, partition)
+            fetches.append((error_code, partition, offset, partition_max_bytes))
+        return fetches
+
+    def wait_for_data(self, fetches: list, min_bytes: int, timeout: float):
+        """
+        Block until the partitions together have at least min_bytes past
+        their fetch offsets, or until timeout seconds pass. Woken by append
+        listeners rather than polling the logs.
+        """
+        partitions = [(partition, offset) for error_code, partition, offset, _ in fetches if error_code == ERR_NONE]
+        deadline = time.monotonic() + timeout
+        woken = threading.Event()
+
+        for partition, _ in partitions:
+            partition.listeners.add(woken.set)
+        try:
+            baseline = sum(partition.bytes_appended for partition, _ in partitions)
+            available = sum(partition.bytes_available(offset, min_bytes) for partition, offset in partitions)
+
+            while available + sum(partition.bytes_appended for partition, _ in partitions) - baseline < min_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not woken.wait(remaining):
+                    break
+                woken.clear()
+        finally:
+            for partition, _ in partitions:
+                partition.listeners.discard(woken.set)
 
-        if topic not in self.topics:
-            return ByteWriter().write_int16(ERR_UNKNOWN_TOPIC).write_int32(0).write_int64(0).to_bytes()
+    def fetch_shares(self, fetches: list, max_bytes: int) -> list:
+        """
+        Split max_bytes between the partitions of a fetch. Each partition
+        with data gets an equal share of what is left, capped at its own
+        partition_max_bytes and at what it has; smaller partitions go first
+        so what they leave over is shared by the rest. A partition can't
+        starve the others however far behind it is.
+        """
+        wants = {}
+        for i, (error_code, partition, offset, partition_max_bytes) in enumerate(fetches):
+            if error_code == ERR_NONE:
+                available = partition.bytes_available(offset, partition_max_bytes)
+                if available:
+                    wants[i] = min(available, partition_max_bytes)
+
+        shares = [0] * len(fetches)
+        remaining = max_bytes
+        for n, i in enumerate(sorted(wants, key=wants.get)):
+            shares[i] = min(wants[i], remaining // (len(wants) - n))
+            remaining -= shares[i]
+        return shares
+
+    def fetch_response(self, request: dict, fetches: list) -> list:
+        """Build a FETCH response body once any long-poll wait is over."""
+        shares = self.fetch_shares(fetches, request["max_bytes"])
+
+        topics = {}
+        for (topic, partition_index, _, _), fetch, share in zip(request["partitions"], fetches, shares):
+            topics.setdefault(topic, []).append((partition_index, fetch, share))
+
+        parts = []
+        writer = ByteWriter()
+        writer.write_int32(len(topics))
+        for topic, entries in topics.items():
+            writer.write_string(topic).write_int32(len(entries))
+            for partition_index, (error_code, partition, offset, _), share in entries:
+                writer.write_int32(partition_index).write_int16(error_code)
+                if error_code == ERR_OFFSET_OUT_OF_RANGE:
+                    writer.write_int64(partition.next_offset).write_int32(0)
+                    continue
+                if error_code != ERR_NONE:
+                    writer.write_int64(0).write_int32(0)
+                    continue
+
+                # Followers read up to the log end, consumers up to the high watermark
+                high_watermark = partition.high_watermark
+                end_offset = None if request["replica_id"] >= 0 else high_watermark
+                region = partition.read_region(offset, share, end_offset) if share else None
+                writer.write_int64(high_watermark).write_int32(len(region) if region else 0)
+                if region:
+                    parts.append(writer.buffer())
+                    parts.append(region)
+                    writer = ByteWriter()
+
+        parts.append(writer.buffer())
+        return parts
 
-        partitions = self.topics[topic]
-        partition_index = hash(key) % len(partitions)
-        partition = partitions[partition_index]
+    def handle_join_group(self, buf: ByteBuffer) -> bytes:
+        """
+        JOIN_GROUP request payload:
+            [group: string][consumer_id: string][session_timeout_ms: 4]
+            [assignor: string][num_topics: 4] then for each: [topic: string]
+            assignor is "range" or "roundrobin" (see coordinator.py); every
+            member of a group must use the same one.
+        Response:
+            [error_code: 2][generation: 4][num_topics: 4]
+            for each topic: [topic: string][num_partitions: 4]
+                for each partition: [partition: 4]
+        """
+        return self.join_response(self.coordinator.join(*self.read_join_request(buf)))
 
-        offset = partition.append(key, value)
+    def read_join_request(self, buf: ByteBuffer) -> tuple:
+        """A JOIN_GROUP request's (group, consumer_id, topics, session_timeout_ms, assignor)."""
+        group = buf.read_string()
+        consumer_id = buf.read_string()
+        session_timeout_ms = buf.read_int32()
+        assignor = buf.read_string()
+        topics = [buf.read_string() for _ in range(buf.read_int32())]
+        return group, consumer_id, topics, session_timeout_ms, assignor
+
+    def join_response(self, result: tuple) -> bytes:
+        """The JOIN_GROUP response for the coordinator's (error_code, generation, assignment)."""
+        error_code, generation, assignment = result
+        writer = ByteWriter()
+        writer.write_int16(error_code).write_int32(generation)
+        assigned = {}
+        for topic, partition in assignment:
+            assigned.setdefault(topic, []).append(partition)
+        writer.write_int32(len(assigned))
+        for topic, partitions in assigned.items():
+            writer.write_string(topic).write_int32(len(partitions))
+            for partition in partitions:
+                writer.write_int32(partition)
 
-        return (ByteWriter()
-                .write_int16(ERR_NONE)
-                .write_int32(partition_index)
-                .write_int64(offset)
-                .to_bytes())
+        return writer.to_bytes()
 
-    def handle_fetch(self, buf: ByteBuffer) -> bytes:
+    def handle_heartbeat(self, buf: ByteBuffer) -> bytes:
         """
-        FETCH request payload:
-            [topic: string][partition: 4][offset: 8][max_records: 4]
+        HEARTBEAT request payload:
+            [group: string][consumer_id: string][generation: 4]
         Response:
-            [error_code: 2][num_records: 4]
-            then for each record: [offset: 8][key: string][value: bytes]
+            [error_code: 2]
+            ERR_ILLEGAL_GENERATION or ERR_UNKNOWN_MEMBER mean the group has
+            rebalanced and the member must join again.
         """
-        topic = buf.read_string()
-        partition_index = buf.read_int32()
-        start_offset = buf.read_int64()
-        max_records = buf.read_int32()
+        group = buf.read_string()
+        consumer_id = buf.read_string()
+        generation = buf.read_int32()
 
-        if topic not in self.topics:
-            return ByteWriter().write_int16(ERR_UNKNOWN_TOPIC).write_int32(0).to_bytes()
+        error_code = self.coordinator.heartbeat(group, consumer_id, generation)
+        return ByteWriter().write_int16(error_code).to_bytes()
 
-        partitions = self.topics[topic]
-        if partition_index >= len(partitions):
-            return ByteWriter().write_int16(ERR_UNKNOWN_PARTITION).write_int32(0).to_bytes()
+    def handle_leave_group(self, buf: ByteBuffer) -> bytes:
+        """
+        LEAVE_GROUP request payload:
+            [group: string][consumer_id: string]
+        Response:
+            [error_code: 2]
+        """
+        group = buf.read_string()
+        consumer_id = buf.read_string()
 
-        partition = partitions[partition_index]
-        records = partition.read(start_offset, max_records)
+        error_code = self.coordinator.leave(group, consumer_id)
+        return ByteWriter().write_int16(error_code).to_bytes()
 
-        writer = ByteWriter()
-        writer.write_int16(ERR_NONE)
-        writer.write_int32(len(records))
+    def handle_metadata(self, buf: ByteBuffer) -> bytes:
+        """
+        METADATA request payload:
+            [num_topics: 4] then for each: [topic: string]
+            num_topics 0 asks for every topic.
+        Response:
+            [controller_id: 4][num_brokers: 4]
+            for each broker: [broker_id: 4][host: string][port: 4]
+            [num_topics: 4]
+            for each topic: [error_code: 2][topic: string][num_partitions: 4]
+                for each partition: [leader: 4]
+            Group requests go to the controller, produce and fetch requests to
+            each partition's leader; leader is -1 while a partition has none.
+            A single broker is broker 0, controller and leader of everything.
+        """
+        topics = [buf.read_string() for _ in range(buf.read_int32())]
+        if not topics:
+            topics = list(self.topics)
 
-        for offset, key, value in records:
-            writer.write_int64(offset)
-            writer.write_string(key)
-            writer.write_bytes(value)
+        writer = ByteWriter()
+        if self.cluster is not None:
+            self.cluster.write_brokers(writer)
+        else:
+            writer.write_int32(self.broker_id).write_int32(1)
+            writer.write_int32(self.broker_id).write_string(self.host).write_int32(self.port)
+
+        writer.write_int32(len(topics))
+        for topic in topics:
+            partitions = self.topics.get(topic)
+            if partitions is None:
+                writer.write_int16(ERR_UNKNOWN_TOPIC).write_string(topic).write_int32(0)
+                continue
+
+            writer.write_int16(ERR_NONE).write_string(topic).write_int32(len(partitions))
+            for partition_index in range(len(partitions)):
+                if self.cluster is not None:
+                    writer.write_int32(self.cluster.leader(topic, partition_index))
+                else:
+                    writer.write_int32(self.broker_id)
 
         return writer.to_bytes()
 
-    def handle_join_group(self, buf: ByteBuffer) -> bytes:
+    def handle_offset_commit(self, buf: ByteBuffer) -> bytes:
         """
-        JOIN_GROUP request payload:
-            [group: string][consumer_id: string][topic: string]
+        OFFSET_COMMIT request payload:
+            [group: string][consumer_id: string][generation: 4][num_topics: 4]
+            for each topic: [topic: string][num_partitions: 4]
+                for each partition: [partition: 4][offset: 8]
+            generation -1 commits without group membership; otherwise it must
+            be the group's current generation.
         Response:
-            [error_code: 2][assigned_partition: 4]
+            [error_code: 2]
+        All offsets are written to the offsets log and fsynced together.
         """
         group = buf.read_string()
         consumer_id = buf.read_string()
+        generation = buf.read_int32()
+
+        offsets = {}
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            for _ in range(buf.read_int32()):
+                partition = buf.read_int32()
+                offsets[(topic, partition)] = buf.read_int64()
+
+        error_code = self.coordinator.check_commit(group, consumer_id, generation)
+        if error_code == ERR_NONE:
+            self.offsets.commit(group, offsets)
+
+        return ByteWriter().write_int16(error_code).to_bytes()
+
+    def handle_offset_fetch(self, buf: ByteBuffer) -> bytes:
+        """
+        OFFSET_FETCH request payload:
+            [group: string][num_topics: 4]
+            for each topic: [topic: string][num_partitions: 4]
+                for each partition: [partition: 4]
+        Response:
+            [error_code: 2][num_entries: 4]
+            for each: [topic: string][partition: 4][offset: 8]
+            offset is -1 when the group has never committed that partition.
+        """
+        group = buf.read_string()
+
+        entries = []
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            for _ in range(buf.read_int32()):
+                partition = buf.read_int32()
+                entries.append((topic, partition, self.offsets.fetch(group, topic, partition)))
+
+        writer = ByteWriter()
+        writer.write_int16(ERR_NONE).write_int32(len(entries))
+        for topic, partition, offset in entries:
+            writer.write_string(topic).write_int32(partition).write_int64(offset)
+
+        return writer.to_bytes()
+
+    def handle_list_offsets(self, buf: ByteBuffer) -> bytes:
+        """
+        LIST_OFFSETS request payload:
+            [topic: string][partition: 4][timestamp: 8]
+            timestamp is in ms; LATEST_TIMESTAMP (-1) asks for the high
+            watermark (the log end on a single broker) and EARLIEST_TIMESTAMP
+            (-2) for the log start offset.
+        Response:
+            [error_code: 2][offset: 8]
+            offset is the first one appended at or after timestamp, or the log
+            end offset if every record is older.
+        """
         topic = buf.read_string()
+        partition_index = buf.read_int32()
+        timestamp = buf.read_int64()
 
-        partition = self.join_group(group, consumer_id, topic)
+        error_code, partition = self.leader_partition(topic, partition_index)
+        if partition is None:
+            return ByteWriter().write_int16(error_code).write_int64(-1).to_bytes()
 
-        if partition == -1:
-            return ByteWriter().write_int16(ERR_UNKNOWN_TOPIC).write_int32(-1).to_bytes()
+        if timestamp == LATEST_TIMESTAMP:
+            offset = partition.high_watermark
+        elif timestamp == EARLIEST_TIMESTAMP:
+            offset = partition.log_start_offset()
+        else:
+            offset = partition.offset_for_timestamp(timestamp)
 
-        return ByteWriter().write_int16(ERR_NONE).write_int32(partition).to_bytes()
+        return ByteWriter().write_int16(ERR_NONE).write_int64(offset).to_bytes()
 
     def handle_create_topic(self, buf: ByteBuffer) -> bytes:
         """
         CREATE_TOPIC request payload:
             [topic: string][num_partitions: 4]
+            [num_configs: 4] then for each: [name: string][value: string]
         Response:
             [error_code: 2]
+            A broker that isn't the controller of a cluster passes the request on to it.
+            Values take the type of their partition.DEFAULT_CONFIG entry;
+            unknown configs and values of the wrong type get ERR_INVALID_CONFIG.
         """
         topic = buf.read_string()
         num_partitions = buf.read_int32()
 
-        self.create_topic(topic, num_partitions)
+        config = {}
+        for _ in range(buf.read_int32()):
+            name = buf.read_string()
+            config[name] = buf.read_string()  # parsed by create_topic
+
+        error_code = self.create_topic(topic, num_partitions, config)
 
-        return ByteWriter().write_int16(ERR_NONE).to_bytes()
+        return ByteWriter().write_int16(error_code).to_bytes()
+
+    def handle_metrics(self, buf: ByteBuffer) -> bytes:
+        """
+        METRICS request payload: empty
+        Response:
+            [error_code: 2][metrics: bytes]
+            metrics is the plaintext the HTTP endpoint serves (see metrics_text).
+        """
+        return ByteWriter().write_int16(ERR_NONE).write_bytes(self.metrics_text().encode('utf-8')).to_bytes()
 
-    def handle_request(self, data: bytes) -> bytes:
-        """Parse request header and route to the right handler."""
+    def handle_request(self, data: bytes) -> list:
+        """
+        Parse request header and route to the right handler.
+        Returns the response as a list of parts (bytes or FileRegion), or None
+        if the request expects no response.
+        """
         buf = ByteBuffer(data)
+        api_key, api_version, correlation_id, client_id = read_request_header(buf)
 
-        # Parse header
-        api_key = buf.read_int16()
-        api_version = buf.read_int16()
-        correlation_id = buf.read_int32()
-        client_id = buf.read_string()
+        started = time.perf_counter()
+        response_body = self.dispatch(api_key, buf)
+        self.record_latency(api_key, time.perf_counter() - started)
+        return build_response(correlation_id, response_body)
+
+    def record_latency(self, api_key: int, seconds: float):
+        """Count a handled request in its API's latency histogram."""
+        histogram = self.request_latency.get(api_key)
+        if histogram is None:
+            histogram = self.request_latency.setdefault(api_key, Histogram())
+        histogram.record(int(seconds * 1_000_000))
+
+    def is_coordinator(self) -> bool:
+        """Whether group requests are served here: by the controller of a cluster."""
+        return self.cluster is None or self.cluster.is_controller()
+
+    def dispatch(self, api_key: int, buf: ByteBuffer):
+        """Route a request body to its handler."""
+        if api_key in GROUP_APIS and not self.is_coordinator():
+            return ByteWriter().write_int16(ERR_NOT_COORDINATOR).to_bytes()
 
-        # Route to handler
         if api_key == API_PRODUCE:
-            response_body = self.handle_produce(buf)
+            return self.handle_produce(buf)
+        elif api_key == API_PRODUCE_BATCH:
+            return self.handle_produce_batch(buf)
         elif api_key == API_FETCH:
-            response_body = self.handle_fetch(buf)
+            return self.handle_fetch(buf)
         elif api_key == API_JOIN_GROUP:
-            response_body = self.handle_join_group(buf)
+            return self.handle_join_group(buf)
         elif api_key == API_CREATE_TOPIC:
-            response_body = self.handle_create_topic(buf)
+            return self.handle_create_topic(buf)
+        elif api_key == API_METADATA:
+            return self.handle_metadata(buf)
+        elif api_key == API_OFFSET_COMMIT:
+            return self.handle_offset_commit(buf)
+        elif api_key == API_OFFSET_FETCH:
+            return self.handle_offset_fetch(buf)
+        elif api_key == API_LIST_OFFSETS:
+            return self.handle_list_offsets(buf)
+        elif api_key == API_HEARTBEAT:
+            return self.handle_heartbeat(buf)
+        elif api_key == API_LEAVE_GROUP:
+            return self.handle_leave_group(buf)
+        elif api_key == API_BROKER_HEARTBEAT and self.cluster is not None:
+            return self.cluster.handle_heartbeat(buf)
+        elif api_key == API_ALTER_ISR and self.cluster is not None:
+            return self.cluster.handle_alter_isr(buf)
+        elif api_key == API_METRICS:
+            return self.handle_metrics(buf)
         else:
-            response_body = ByteWriter().write_int16(99).to_bytes()  # unknown api
-
-        # Build response: [correlation_id][body]
-        response = ByteWriter()
-        response.write_int32(correlation_id)
-        response.data.extend(response_body)
-        return response.to_bytes()
+            return ByteWriter().write_int16(99).to_bytes()  # unknown api
 
     # ──────────────────────────────────────────────
     # Network layer
@@ -192,22 +819,139 @@ class Broker:
 
     def handle_connection(self, client_socket, address):
         """Runs in a separate thread for each connected client."""
+        # Each request is handled and answered before the next is read,
+        # so one buffer serves the whole connection
+        frames = FrameReader()
         try:
             while True:
                 # Read one length-prefixed request
-                data = recv_framed(client_socket)
+                data = frames.read(client_socket)
 
                 # Handle it and send response
                 response = self.handle_request(data)
-                send_framed(client_socket, response)
+                if response is not None:
+                    send_framed_parts(client_socket, response)
 
         except ConnectionError:
             pass
         finally:
             client_socket.close()
 
-    def start(self):
-        """Start the broker TCP server."""
+    def open_partitions(self) -> list:
+        """Every partition opened so far, including the internal offsets log."""
+        partitions = [self.offsets.log]
+        for topic_partitions in list(self.topics.values()):
+            partitions.extend(topic_partitions.loaded())
+        return partitions
+
+    def cache_stats(self) -> dict:
+        """Tail cache counters of every open partition, by "topic-partition"."""
+        return {f"{partition.topic}-{partition.partition_id}": partition.cache.stats()
+                for partition in self.open_partitions()}
+
+    def metrics_text(self) -> str:
+        """
+        The broker's metrics in Prometheus' plaintext format: request
+        latency per API, traffic and offsets per partition and topic, and
+        the lag of every consumer group's committed offsets behind the high
+        watermark. Lag is only known to the broker holding the group's
+        offsets (the controller, in a cluster).
+        """
+        out = MetricsWriter()
+        out.gauge("broker_uptime_seconds", round(time.time() - self.started_at, 3))
+
+        for api_key, histogram in sorted(self.request_latency.items()):
+            api = API_NAMES.get(api_key, str(api_key))
+            out.summary("broker_request_latency_seconds", histogram, 1e-6, api=api)
+
+        topics = {}
+        partitions = {}
+        for partition in self.open_partitions():
+            partitions[(partition.topic, partition.partition_id)] = partition
+            labels = {"topic": partition.topic, "partition": partition.partition_id}
+            out.gauge("partition_log_start_offset", partition.log_start_offset(), **labels)
+            out.gauge("partition_log_end_offset", partition.next_offset, **labels)
+            out.gauge("partition_high_watermark", partition.high_watermark, **labels)
+            out.gauge("partition_size_bytes", partition.size(), **labels)
+            out.counter("partition_records_in_total", partition.records_appended, **labels)
+            out.counter("partition_bytes_in_total", partition.bytes_appended, **labels)
+            out.counter("partition_bytes_out_total", partition.bytes_read, **labels)
+            cache = partition.cache.stats()
+            out.counter("partition_cache_hits_total", cache["hits"], **labels)
+            out.counter("partition_cache_misses_total", cache["misses"], **labels)
+
+            totals = topics.setdefault(partition.topic, [0, 0, 0])
+            totals[0] += partition.records_appended
+            totals[1] += partition.bytes_appended
+            totals[2] += partition.bytes_read
+
+        for topic, (records_in, bytes_in, bytes_out) in sorted(topics.items()):
+            out.counter("topic_records_in_total", records_in, topic=topic)
+            out.counter("topic_bytes_in_total", bytes_in, topic=topic)
+            out.counter("topic_bytes_out_total", bytes_out, topic=topic)
+
+        for (group, topic, partition_id), offset in sorted(self.offsets.committed().items()):
+            partition = partitions.get((topic, partition_id))
+            labels = {"group": group, "topic": topic, "partition": partition_id}
+            out.gauge("consumer_group_committed_offset", offset, **labels)
+            if partition is not None:
+                out.gauge("consumer_group_lag", max(partition.high_watermark - offset, 0), **labels)
+
+        return out.text()
+
+    def flush_loop(self):
+        """
+        Background thread applying each partition's time-based flush policy
+        and periodically saving recovery points.
+        """
+        last_checkpoint = time.time()
+        while True:
+            time.sleep(FLUSH_CHECK_INTERVAL)
+            partitions = self.open_partitions()
+            for partition in partitions:
+                partition.maybe_flush()
+
+            if time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                for partition in partitions:
+                    partition.checkpoint()
+                last_checkpoint = time.time()
+
+    def cleaner_loop(self):
+        """Background thread applying each partition's retention or compaction policy."""
+        cleaner = LogCleaner()
+        while True:
+            time.sleep(CLEANER_INTERVAL)
+            for partition in self.open_partitions():
+                try:
+                    cleaner.clean(partition)
+                except Exception as e:  # one partition's failure must not stop cleaning the rest
+                    print(f"  Cleaner failed on {partition.topic}-{partition.partition_id}: {e!r}")
+
+    def close(self):
+        """Flush and checkpoint every open partition, so the next start has nothing to scan."""
+        for partition in self.open_partitions():
+            partition.close()
+
+    def start(self, mode: str = 'threaded', io_threads: int = 8):
+        """
+        Start the broker TCP server.
+
+        mode='threaded' serves each connection from its own OS thread.
+        mode='asyncio' serves every connection from one event loop and runs
+        request handlers on a pool of io_threads (see async_server.py).
+        """
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+        threading.Thread(target=self.cleaner_loop, daemon=True).start()
+        if self.cluster is not None:
+            self.cluster.start()
+        if self.metrics_port is not None:
+            MetricsServer(self.host, self.metrics_port, self.metrics_text).start()
+
+        if mode == 'asyncio':
+            from async_server import AsyncServer
+            AsyncServer(self, io_threads, replication_timeout=REPLICATION_TIMEOUT).run()
+            return
+
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((self.host, self.port))
@@ -228,4 +972,7 @@ class Broker:
 
 if __name__ == '__main__':
     broker = Broker()
-    broker.start()
+    try:
+        broker.start()
+    except KeyboardInterrupt:
+        broker.close()
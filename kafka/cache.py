@@ -0,0 +1,118 @@
+import bisect
+import threading
+
+
+class TailCache:
+    """
+    The most recently appended batches of a partition, kept in memory up to
+    max_bytes so fetches from consumers that keep up are answered without
+    touching the log files; only lagging consumers go to disk.
+
+    The cache always holds a contiguous run of batches ending at the log
+    end. Batches are added as they are appended and evicted oldest first,
+    like a ring buffer: evicted slots are dropped in bulk once they make up
+    half the list, so eviction stays O(1) on average.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.base_offsets = []  # base offset of each cached batch
+        self.batches = []
+        self.start = 0          # first live entry
+        self.end_offset = 0     # offset after the last cached record
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # Reads answered from memory vs. sent to the log files
+        self.hits = 0
+        self.misses = 0
+
+    def append(self, base_offset: int, record_count: int, batch: bytes):
+        with self.lock:
+            if len(batch) > self.max_bytes or (self.size and base_offset != self.end_offset):
+                # The cache can't hold the new tail, or would have a gap in it
+                self._clear()
+                if len(batch) > self.max_bytes:
+                    return
+
+            self.base_offsets.append(base_offset)
+            self.batches.append(batch)
+            self.size += len(batch)
+            self.end_offset = base_offset + record_count
+
+            while self.size > self.max_bytes:
+                self.size -= len(self.batches[self.start])
+                self.batches[self.start] = None
+                self.start += 1
+
+            if self.start > len(self.batches) // 2:
+                del self.base_offsets[:self.start]
+                del self.batches[:self.start]
+                self.start = 0
+
+    def first_offset(self):
+        """The first cached offset, or None when the cache is empty."""
+        return self.base_offsets[self.start] if self.start < len(self.batches) else None
+
+    def read(self, start_offset: int, max_bytes: int, end_offset: int = None):
+        """
+        Whole batches from the one holding start_offset, up to max_bytes
+        (but at least that batch) and stopping before end_offset. Returns
+        None on a miss: when start_offset is outside the cached range.
+        """
+        with self.lock:
+            first_offset = self.first_offset()
+            if first_offset is None or not first_offset <= start_offset < self.end_offset:
+                self.misses += 1
+                return None
+
+            i = bisect.bisect_right(self.base_offsets, start_offset, lo=self.start) - 1
+            batches = [self.batches[i]]
+            total = len(batches[0])
+            for i in range(i + 1, len(self.batches)):
+                if end_offset is not None and self.base_offsets[i] >= end_offset:
+                    break
+                total += len(self.batches[i])
+                if total > max_bytes:
+                    break
+                batches.append(self.batches[i])
+
+            self.hits += 1
+            return batches
+
+    def bytes_from(self, start_offset: int):
+        """Cached bytes from the batch holding start_offset to the end, or None if it isn't cached."""
+        with self.lock:
+            first_offset = self.first_offset()
+            if first_offset is None or not first_offset <= start_offset < self.end_offset:
+                return None
+
+            i = bisect.bisect_right(self.base_offsets, start_offset, lo=self.start) - 1
+            return sum(len(batch) for batch in self.batches[i:])
+
+    def discard_before(self, offset: int):
+        """Drop cached batches below offset, e.g. once the segments holding them were cleaned."""
+        with self.lock:
+            while self.start < len(self.batches) and self.base_offsets[self.start] < offset:
+                self.size -= len(self.batches[self.start])
+                self.batches[self.start] = None
+                self.start += 1
+
+    def clear(self):
+        """Drop everything, e.g. after the log was truncated."""
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.base_offsets = []
+        self.batches = []
+        self.start = 0
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes": self.size,
+            "batches": len(self.batches) - self.start,
+        }
@@ -0,0 +1,165 @@
+import os
+import shutil
+import time
+from compression import get_codec
+from partition import Partition, CLEANING_DIR
+from protocol import BATCH_HEADER_SIZE, build_batch, decode_records, encode_records, read_batch_header
+from segment import LogSegment
+
+
+# Removed segment files are kept this long so in-flight fetches can finish
+FILE_DELETE_DELAY = 60.0
+
+
+class LogCleaner:
+    """
+    Background housekeeping for partition logs, run by the broker's cleaner
+    thread. Only sealed segments are touched; the active one is never
+    rewritten or removed.
+
+    cleanup_policy "delete": whole segments are dropped from the start of the
+    log once their newest record is older than retention_ms, or while the
+    log is larger than retention_bytes.
+
+    cleanup_policy "compact": only the latest record for each key is kept.
+    A pass builds a key -> latest offset map over the whole log, then
+    rewrites runs of sealed segments (up to segment_bytes each) keeping only
+    records that are still the latest for their key. Offsets never change,
+    so consumers and committed offsets stay valid; the log just has gaps.
+    """
+
+    def __init__(self):
+        # Offset up to which each partition was last compacted
+        self.cleaned_offsets = {}
+
+    def clean(self, partition: Partition):
+        if partition.config["cleanup_policy"] == "compact":
+            if self.needs_compaction(partition):
+                self.compact(partition)
+        else:
+            self.enforce_retention(partition)
+
+        partition.delete_old_files(FILE_DELETE_DELAY)
+
+    # ──────────────────────────────────────────────
+    # Retention
+    # ──────────────────────────────────────────────
+
+    def enforce_retention(self, partition: Partition):
+        sealed = partition.sealed_segments()
+        expired = 0
+
+        retention_ms = partition.config["retention_ms"]
+        if retention_ms is not None:
+            cutoff = time.time() * 1000 - retention_ms
+            while expired < len(sealed) and sealed[expired].max_timestamp < cutoff:
+                expired += 1
+
+        retention_bytes = partition.config["retention_bytes"]
+        if retention_bytes is not None:
+            excess = partition.size() - retention_bytes
+            for segment in sealed[:expired]:
+                excess -= segment.size
+            while expired < len(sealed) and excess >= sealed[expired].size:
+                excess -= sealed[expired].size
+                expired += 1
+
+        if expired:
+            partition.delete_segments(sealed[:expired])
+            print(f"  Retention deleted {expired} segments of {partition.topic}-{partition.partition_id}")
+
+    # ──────────────────────────────────────────────
+    # Compaction
+    # ──────────────────────────────────────────────
+
+    def needs_compaction(self, partition: Partition) -> bool:
+        """True once at least min_cleanable_dirty_ratio of the sealed log was written since the last pass."""
+        sealed = partition.sealed_segments()
+        cleaned_offset = self.cleaned_offsets.get(partition, 0)
+
+        total = sum(segment.size for segment in sealed)
+        dirty = sum(segment.size for segment in sealed if segment.base_offset >= cleaned_offset)
+        return dirty > 0 and dirty >= partition.config["min_cleanable_dirty_ratio"] * total
+
+    def compact(self, partition: Partition):
+        sealed = partition.sealed_segments()
+        latest = self.build_offset_map(partition)
+
+        cleaning_dir = os.path.join(partition.path, CLEANING_DIR)
+        os.makedirs(cleaning_dir, exist_ok=True)
+
+        before, after = 0, 0
+        for group in self.group_segments(sealed, partition.config["segment_bytes"]):
+            cleaned = self.clean_segments(group, latest, cleaning_dir, partition.config)
+            before += sum(segment.size for segment in group)
+
+            if cleaned.size == 0:
+                cleaned.delete()
+                partition.delete_segments(group)
+            else:
+                after += cleaned.size
+                cleaned.close()
+                partition.replace_segments(group, cleaning_dir)
+
+        shutil.rmtree(cleaning_dir)
+        self.cleaned_offsets[partition] = partition.segments[-1].base_offset
+        print(f"  Compacted {partition.topic}-{partition.partition_id}: {before} -> {after} bytes")
+
+    def build_offset_map(self, partition: Partition) -> dict:
+        """key -> offset of its latest record, over every segment including the active one."""
+        latest = {}
+        for segment in partition.segments:
+            for batch in segment.batches():
+                _, base_offset, record_count, codec, _ = read_batch_header(batch)
+                payload = get_codec(codec).decompress(batch[BATCH_HEADER_SIZE:])
+                for i, (key, _) in enumerate(decode_records(payload, record_count)):
+                    latest[key] = base_offset + i
+        return latest
+
+    def group_segments(self, segments: list, max_bytes: int) -> list:
+        """Split consecutive segments into runs whose combined size fits in one segment."""
+        groups = []
+        for segment in segments:
+            if groups and sum(s.size for s in groups[-1]) + segment.size <= max_bytes:
+                groups[-1].append(segment)
+            else:
+                groups.append([segment])
+        return groups
+
+    def clean_segments(self, segments: list, latest: dict, cleaning_dir: str, config: dict) -> LogSegment:
+        """
+        Write the surviving records of a run of segments into one new segment
+        in cleaning_dir, named after the run's first base offset. Batches
+        need consecutive offsets, so each batch's survivors are split into
+        runs of consecutive offsets, keeping the batch's codec.
+        """
+        cleaned = LogSegment(cleaning_dir, segments[0].base_offset, config, active=True)
+
+        for segment in segments:
+            for batch in segment.batches():
+                _, base_offset, record_count, codec, timestamp = read_batch_header(batch)
+                payload = get_codec(codec).decompress(batch[BATCH_HEADER_SIZE:])
+                records = decode_records(payload, record_count)
+
+                keep = [latest.get(key) == base_offset + i for i, (key, _) in enumerate(records)]
+                if all(keep):
+                    # Nothing superseded: copy the batch as it is
+                    cleaned.append(base_offset, record_count, timestamp, batch)
+                    continue
+
+                run_start = None
+                for i in range(record_count + 1):
+                    if i < record_count and keep[i]:
+                        if run_start is None:
+                            run_start = i
+                    elif run_start is not None:
+                        self.write_run(cleaned, base_offset + run_start, codec, timestamp, records[run_start:i])
+                        run_start = None
+
+        cleaned.close_active()
+        return cleaned
+
+    def write_run(self, segment: LogSegment, base_offset: int, codec: int, timestamp: int, records: list):
+        payload = get_codec(codec).compress(encode_records(records))
+        batch = build_batch(base_offset, len(records), codec, payload, timestamp)
+        segment.append(base_offset, len(records), timestamp, batch)
@@ -0,0 +1,158 @@
+import socket
+import threading
+import time
+from protocol import (
+    ByteBuffer, ByteWriter, FrameReader, send_framed, INT16,
+    ERR_NONE, ERR_NOT_LEADER, ERR_NOT_COORDINATOR,
+)
+
+# Pause before retrying a request after a leader change or a lost broker
+RETRY_BACKOFF = 0.2
+
+# Response errors that mean the request went to the wrong broker
+RETRIABLE_ERRORS = (ERR_NOT_LEADER, ERR_NOT_COORDINATOR)
+
+
+class BrokerConnection:
+    """A client's connection to one broker. Requests on it are answered in order."""
+
+    def __init__(self, host: str, port: int):
+        self.sock = socket.create_connection((host, port))
+        self.frames = FrameReader()  # responses are parsed before the next request
+
+    def send(self, data):
+        send_framed(self.sock, data)
+
+    def receive(self) -> ByteBuffer:
+        """The next response, positioned after the correlation id."""
+        buf = ByteBuffer(self.frames.read(self.sock))
+        correlation_id = buf.read_int32()
+        return buf
+
+    def roundtrip(self, data) -> ByteBuffer:
+        self.send(data)
+        return self.receive()
+
+    def close(self):
+        self.sock.close()
+
+
+class ClusterMetadata:
+    """
+    What a client knows about the brokers, from METADATA responses: their
+    addresses, the controller (which coordinates consumer groups) and each
+    partition's leader. A single broker describes itself as broker 0,
+    controller and leader of everything.
+
+    Connections are opened per broker on first use. Clients refresh the
+    metadata and retry when a request fails with ERR_NOT_LEADER or
+    ERR_NOT_COORDINATOR, or the broker can't be reached.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.bootstrap = (host, port)
+        self.brokers = {}      # broker_id -> (host, port)
+        self.controller = -1
+        self.leaders = {}      # topic -> leader broker id of each partition (-1: none)
+        self.connections = {}  # broker_id -> BrokerConnection
+        self.lock = threading.Lock()
+
+    def leader(self, topic: str, partition: int) -> int:
+        """
+        The partition's leader, or -1 if it has none. Partitions of topics
+        we know nothing about go to the controller, which rejects them.
+        """
+        leaders = self.leaders.get(topic)
+        if leaders is None or not 0 <= partition < len(leaders):
+            return self.controller
+        return leaders[partition]
+
+    def connect(self, broker_id: int) -> BrokerConnection:
+        """A new connection to a broker, for threads that need one of their own."""
+        address = self.brokers.get(broker_id)
+        if address is None:
+            raise ConnectionError(f"No known broker {broker_id}")
+        return BrokerConnection(*address)
+
+    def connection(self, broker_id: int) -> BrokerConnection:
+        """The shared connection to a broker, opened on first use."""
+        connection = self.connections.get(broker_id)
+        if connection is None:
+            connection = self.connections[broker_id] = self.connect(broker_id)
+        return connection
+
+    def drop(self, broker_id: int):
+        """Close a broker's connection after a failure; the next request reconnects."""
+        connection = self.connections.pop(broker_id, None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, data, route, refresh, timeout: float) -> ByteBuffer:
+        """
+        Send a request to the broker route() names and return its response.
+        Lost connections, and responses whose error code says the request
+        went to the wrong broker, are retried after refresh() until timeout
+        seconds have passed; then the last response is returned, or the
+        connection error raised.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            broker_id = route()
+            try:
+                buf = self.connection(broker_id).roundtrip(data)
+                error_code, = INT16.unpack_from(buf.data, buf.position)
+                if error_code not in RETRIABLE_ERRORS or time.monotonic() >= deadline:
+                    return buf
+            except OSError:
+                self.drop(broker_id)
+                if time.monotonic() >= deadline:
+                    raise
+            time.sleep(RETRY_BACKOFF)
+            refresh()
+
+    def refresh(self, writer: ByteWriter, topics: list) -> bool:
+        """
+        Send METADATA for topics (all of them when empty) to the first
+        broker that answers, known ones before the bootstrap address, over a
+        connection of its own. writer holds the request header. Returns
+        False if no broker answered.
+        """
+        writer.write_int32(len(topics))
+        for topic in topics:
+            writer.write_string(topic)
+
+        with self.lock:
+            for address in list(self.brokers.values()) + [self.bootstrap]:
+                try:
+                    connection = BrokerConnection(*address)
+                except OSError:
+                    continue
+                try:
+                    self._read(connection.roundtrip(writer.buffer()))
+                    return True
+                except OSError:
+                    continue
+                finally:
+                    connection.close()
+        return False
+
+    def _read(self, buf: ByteBuffer):
+        controller = buf.read_int32()
+        brokers = {}
+        for _ in range(buf.read_int32()):
+            broker_id = buf.read_int32()
+            brokers[broker_id] = (buf.read_string(), buf.read_int32())
+
+        leaders = dict(self.leaders)
+        for _ in range(buf.read_int32()):
+            error_code = buf.read_int16()
+            topic = buf.read_string()
+            partition_leaders = [buf.read_int32() for _ in range(buf.read_int32())]
+            if error_code == ERR_NONE:
+                leaders[topic] = partition_leaders
+
+        self.brokers, self.controller, self.leaders = brokers, controller, leaders
+
+    def close(self):
+        for broker_id in list(self.connections):
+            self.drop(broker_id)
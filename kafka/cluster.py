@@ -0,0 +1,718 @@
+import copy
+import json
+import os
+import socket
+import threading
+import time
+from protocol import (
+    ByteBuffer, ByteWriter, FrameReader, send_framed,
+    API_FETCH, API_CREATE_TOPIC, API_BROKER_HEARTBEAT, API_ALTER_ISR,
+    ERR_NONE, ERR_UNKNOWN_TOPIC, ERR_UNKNOWN_PARTITION, ERR_NOT_LEADER, ERR_OFFSET_OUT_OF_RANGE,
+    ERR_NOT_COORDINATOR,
+)
+from offsets import OFFSETS_TOPIC
+from partition import parse_config_value
+
+# How often brokers heartbeat the controller and leaders check their followers
+CLUSTER_INTERVAL = 0.5
+
+# The controller moves leadership away from brokers silent for this long
+BROKER_SESSION_TIMEOUT = 3.0
+
+# Followers that haven't caught up with their leader for this long leave the ISR
+REPLICA_LAG_TIME_MAX = 5.0
+
+# Replica fetches long-poll the leader like consumers do
+REPLICA_FETCH_WAIT_MS = 500
+REPLICA_FETCH_MAX_BYTES = 4 * 1024 * 1024
+REPLICA_FETCH_PARTITION_BYTES = 1024 * 1024
+
+# Socket timeout for broker-to-broker requests (on top of any long poll)
+PEER_TIMEOUT = 5.0
+
+# Replicas per partition when a topic's config doesn't set replication_factor
+DEFAULT_REPLICATION_FACTOR = 3
+
+# Metadata version, replicas, leaders and ISRs of every partition
+CLUSTER_FILE = "cluster.json"
+
+
+def write_config(writer: ByteWriter, config: dict):
+    """[num_configs: 4] then for each: [name: string][value: string], as in CREATE_TOPIC."""
+    writer.write_int32(len(config))
+    for name, value in config.items():
+        writer.write_string(name)
+        writer.write_string(str(value))
+
+
+def read_config(buf: ByteBuffer) -> dict:
+    """
+    Parse write_config's format, each value as the type of its default
+    (see partition.parse_config_value). Raises ValueError for invalid
+    configs; the whole config is read first, so buf stays in step.
+    """
+    values = [(buf.read_string(), buf.read_string()) for _ in range(buf.read_int32())]
+    return {name: parse_config_value(name, value) for name, value in values}
+
+
+class PeerClient:
+    """
+    A broker's connection to another broker. Connects on first use and
+    again on the next request after a failure, which surfaces as
+    ConnectionError.
+    """
+
+    def __init__(self, host: str, port: int, client_id: str):
+        self.address = (host, port)
+        self.client_id = client_id
+        self.correlation_id = 0
+        self.sock = None
+        self.frames = None
+        self.lock = threading.Lock()  # one request at a time on the connection
+
+    def request(self, api_key: int) -> ByteWriter:
+        """Start a request with the standard header."""
+        self.correlation_id += 1
+        writer = ByteWriter()
+        writer.write_int16(api_key)
+        writer.write_int16(1)
+        writer.write_int32(self.correlation_id)
+        writer.write_string(self.client_id)
+        return writer
+
+    def roundtrip(self, writer: ByteWriter, timeout: float = PEER_TIMEOUT) -> ByteBuffer:
+        """
+        Send a request and return its response, positioned after the
+        correlation id. The response is copied out of the read buffer, as
+        another thread may send the next request before it is parsed.
+        """
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address, timeout=PEER_TIMEOUT)
+                    self.frames = FrameReader()
+                self.sock.settimeout(timeout)
+                send_framed(self.sock, writer.buffer())
+                response = bytes(self.frames.read(self.sock))
+            except OSError as e:
+                self.close()
+                raise ConnectionError(f"Broker at {self.address[0]}:{self.address[1]}: {e}") from e
+
+        buf = ByteBuffer(response)
+        correlation_id = buf.read_int32()
+        return buf
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ClusterManager:
+    """
+    A broker's part in a cluster of brokers sharing the same topics.
+
+    Each partition has replicas on replication_factor brokers. One of them,
+    the leader, takes produce and consumer fetch requests; the followers
+    copy its log by fetching from it much like consumers do, with their
+    broker id as replica_id. The leader tracks how far each follower has
+    got. Followers that keep up form the in-sync replica set (ISR), and the
+    high watermark is the offset every ISR member has reached: consumers
+    only see records below it, and acks=-1 produces wait for it, so an
+    acked record survives as long as one in-sync replica does.
+
+    The live broker with the lowest id acts as controller, and keeps the
+    role until it stops answering. Every broker heartbeats it each
+    CLUSTER_INTERVAL and gets the cluster metadata back whenever the
+    controller has a newer version. The controller assigns replicas to new
+    topics, applies the ISR changes leaders send it, and hands leadership
+    to another in-sync replica when a leader's broker stops heartbeating.
+    It also coordinates consumer groups and leads the offsets log, which
+    every other broker replicates so a new controller can take over the
+    committed offsets.
+
+    A replica that starts following a new leader first truncates its log to
+    its high watermark, dropping records the new leader may not have.
+    """
+
+    def __init__(self, broker, broker_id: int, brokers: dict):
+        self.broker = broker
+        self.broker_id = broker_id
+        self.brokers = brokers  # broker_id -> (host, port)
+        self.peers = {peer_id: PeerClient(host, port, f"broker-{broker_id}")
+                      for peer_id, (host, port) in brokers.items() if peer_id != broker_id}
+
+        # Cluster metadata, as of version
+        self.version = 0
+        self.controller_id = -1
+        self.partitions = {}  # topic -> [{"leader", "leader_epoch", "replicas", "isr"}]
+        self.lock = threading.Lock()
+
+        # This broker's roles: (topic, partition) -> (leader, leader_epoch) last acted on
+        self.roles = {}
+        self.leading = set()
+        self.synced = False
+
+        # As a leader: (topic, partition) -> follower -> {"offset", "caught_up", "fetch_end"}
+        self.followers = {}
+
+        # As the controller: when each broker last heartbeated
+        self.last_seen = {}
+        self.controller_lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+        path = os.path.join(self.broker.log_dir, CLUSTER_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            state = json.load(f)
+        self.version = state["version"]
+        self.partitions = state["partitions"]
+
+    def save(self):
+        os.makedirs(self.broker.log_dir, exist_ok=True)
+        path = os.path.join(self.broker.log_dir, CLUSTER_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({"version": self.version, "partitions": self.partitions}, f)
+        os.replace(path + ".tmp", path)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        for leader_id in self.peers:
+            threading.Thread(target=self.fetch_loop, args=(leader_id,), daemon=True).start()
+
+    def run(self):
+        """Background thread: keep in touch with the controller, or be it, and watch our followers."""
+        while True:
+            self.find_controller()
+            if self.is_controller():
+                self.elect_leaders()
+            self.check_followers()
+            time.sleep(CLUSTER_INTERVAL)
+
+    # ──────────────────────────────────────────────
+    # Lookups
+    # ──────────────────────────────────────────────
+
+    def is_controller(self) -> bool:
+        return self.controller_id == self.broker_id
+
+    def is_leader(self, topic: str, partition_id: int) -> bool:
+        return (topic, partition_id) in self.leading
+
+    def leader(self, topic: str, partition_id: int) -> int:
+        states = self.partitions.get(topic)
+        if states is None or partition_id >= len(states):
+            return -1
+        return states[partition_id]["leader"]
+
+    def enough_replicas(self, topic: str, partition_id: int, partition) -> bool:
+        """Whether the ISR is big enough for an acks=-1 produce."""
+        isr = self.partitions[topic][partition_id]["isr"]
+        return len(isr) >= partition.config["min_insync_replicas"]
+
+    def write_brokers(self, writer: ByteWriter):
+        """[controller_id: 4][num_brokers: 4] then for each: [broker_id: 4][host: string][port: 4]"""
+        writer.write_int32(self.controller_id).write_int32(len(self.brokers))
+        for broker_id, (host, port) in sorted(self.brokers.items()):
+            writer.write_int32(broker_id).write_string(host).write_int32(port)
+
+    # ──────────────────────────────────────────────
+    # Metadata
+    # ──────────────────────────────────────────────
+
+    def write_metadata(self, writer: ByteWriter):
+        """
+        [version: 8][num_topics: 4]
+        for each topic: [topic: string][num_configs: 4]{[name: string][value: string]}
+                        [num_partitions: 4]
+            for each partition: [leader: 4][leader_epoch: 4]
+                                [num_replicas: 4]{[broker_id: 4]}[num_isr: 4]{[broker_id: 4]}
+        """
+        with self.lock:
+            writer.write_int64(self.version).write_int32(len(self.partitions))
+            for topic, states in self.partitions.items():
+                writer.write_string(topic)
+                write_config(writer, self.broker.topic_configs[topic]["config"])
+                writer.write_int32(len(states))
+                for state in states:
+                    writer.write_int32(state["leader"]).write_int32(state["leader_epoch"])
+                    for field in ("replicas", "isr"):
+                        writer.write_int32(len(state[field]))
+                        for broker_id in state[field]:
+                            writer.write_int32(broker_id)
+
+    def read_metadata(self, buf: ByteBuffer):
+        """Parse write_metadata's format. Returns (version, configs, partitions)."""
+        version = buf.read_int64()
+        configs, partitions = {}, {}
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            configs[topic] = read_config(buf)
+            states = partitions[topic] = []
+            for _ in range(buf.read_int32()):
+                state = {"leader": buf.read_int32(), "leader_epoch": buf.read_int32()}
+                for field in ("replicas", "isr"):
+                    state[field] = [buf.read_int32() for _ in range(buf.read_int32())]
+                states.append(state)
+        return version, configs, partitions
+
+    def apply_metadata(self, version: int, configs: dict, partitions: dict):
+        """
+        Adopt a newer metadata version: register topics we haven't seen and
+        take up any new leader or follower roles.
+        """
+        with self.lock:
+            if version <= self.version:
+                return
+            self.version = version
+            self.partitions = partitions
+            self.save()
+
+        for topic, config in configs.items():
+            if topic in partitions:
+                self.broker.register_topic(topic, len(partitions[topic]), config)
+        self.apply_roles()
+
+    def apply_roles(self):
+        """Become leader or follower of every partition whose leadership changed since we last looked."""
+        for topic, states in list(self.partitions.items()):
+            for partition_id, state in enumerate(states):
+                if self.broker_id not in state["replicas"]:
+                    continue
+
+                key = (topic, partition_id)
+                role = (state["leader"], state["leader_epoch"])
+                if self.roles.get(key) == role:
+                    if key in self.leading:
+                        self.update_high_watermark(topic, partition_id)  # the ISR may have changed
+                    continue
+
+                self.roles[key] = role
+                if state["leader"] == self.broker_id:
+                    self.become_leader(topic, partition_id, state)
+                else:
+                    self.become_follower(topic, partition_id, state)
+
+    def become_leader(self, topic: str, partition_id: int, state: dict):
+        partition = self.broker.topics[topic][partition_id]
+        now = time.monotonic()
+        with self.lock:
+            # In-sync followers are assumed to be at our high watermark until
+            # they fetch; the others have to catch up first
+            self.followers[(topic, partition_id)] = {
+                replica: ({"offset": partition.high_watermark, "caught_up": now, "fetch_end": None}
+                          if replica in state["isr"] else {"offset": -1, "caught_up": 0.0, "fetch_end": None})
+                for replica in state["replicas"] if replica != self.broker_id
+            }
+        self.leading.add((topic, partition_id))
+        self.update_high_watermark(topic, partition_id)
+        print(f"  Leading {topic}-{partition_id} (epoch {state['leader_epoch']}, ISR {state['isr']})")
+
+    def become_follower(self, topic: str, partition_id: int, state: dict):
+        partition = self.broker.topics[topic][partition_id]
+        self.leading.discard((topic, partition_id))
+        with self.lock:
+            self.followers.pop((topic, partition_id), None)
+        partition.update_high_watermark(partition.high_watermark, replicated=True)
+
+        if state["leader"] < 0:
+            # No leader: keep everything, we may be the replica that gets elected
+            print(f"  {topic}-{partition_id} is offline")
+            return
+        partition.truncate_to(partition.high_watermark)
+        print(f"  Following {topic}-{partition_id} from broker {state['leader']}")
+
+    # ──────────────────────────────────────────────
+    # Controller
+    # ──────────────────────────────────────────────
+
+    def find_controller(self):
+        """
+        Heartbeat the controller, or find a new one if it stopped answering:
+        the live broker with the lowest id. A broker that was just started
+        first asks every peer, so it picks up the current controller and
+        metadata instead of acting on what it saved before going down.
+        """
+        if not self.synced:
+            for peer_id in self.peers:
+                try:
+                    controller_id, _ = self.heartbeat(peer_id)
+                except ConnectionError:
+                    continue
+                if controller_id >= 0 and self.controller_id < 0:
+                    self.controller_id = controller_id
+            self.synced = True
+            self.apply_roles()
+
+        if self.is_controller():
+            self.check_controllers()
+            return
+        if self.controller_id in self.peers:
+            try:
+                controller_id, _ = self.heartbeat(self.controller_id)
+            except ConnectionError:
+                print(f"  Lost the controller (broker {self.controller_id})")
+            else:
+                if controller_id in self.peers and controller_id != self.controller_id:
+                    # It stepped down in favour of another controller
+                    self.controller_id = controller_id
+                    print(f"  Controller is broker {controller_id}")
+                return
+
+        for broker_id in sorted(self.brokers):
+            if broker_id == self.broker_id:
+                self.become_controller()
+                return
+            try:
+                controller_id, _ = self.heartbeat(broker_id)
+            except ConnectionError:
+                continue
+            self.controller_id = controller_id if controller_id in self.peers else broker_id
+            print(f"  Controller is broker {self.controller_id}")
+            return
+
+    def heartbeat(self, peer_id: int) -> tuple:
+        """
+        Send a broker heartbeat, adopting any newer metadata it returns.
+        Returns the peer's controller and metadata version.
+        """
+        peer = self.peers[peer_id]
+        writer = peer.request(API_BROKER_HEARTBEAT)
+        writer.write_int32(self.broker_id).write_int64(self.version)
+
+        buf = peer.roundtrip(writer)
+        error_code = buf.read_int16()
+        controller_id = buf.read_int32()
+        version = buf.read_int64()
+        if buf.read_int8():
+            self.apply_metadata(*self.read_metadata(buf))
+        return controller_id, version
+
+    def check_controllers(self):
+        """
+        Step down if another broker acts as controller too. That happens
+        when brokers start together, before they can reach each other, or
+        when a restarted broker finds no peer in time. The controller with
+        the newer metadata keeps the role, the lower id on a tie, and the
+        other one takes over its metadata.
+        """
+        for peer_id in sorted(self.peers):
+            our_version = self.version
+            try:
+                controller_id, version = self.heartbeat(peer_id)
+            except ConnectionError:
+                continue
+            if controller_id != peer_id or (version, -peer_id) < (our_version, -self.broker_id):
+                continue
+
+            with self.controller_lock:
+                with self.lock:
+                    self.controller_id = peer_id
+                    self.version = -1  # so the next heartbeat brings its metadata
+            print(f"  Broker {peer_id} is the controller too; stepping down")
+            try:
+                self.heartbeat(peer_id)
+            except ConnectionError:
+                pass
+            return
+
+    def handle_heartbeat(self, buf: ByteBuffer) -> bytes:
+        """
+        BROKER_HEARTBEAT request payload:
+            [broker_id: 4][metadata_version: 8]
+        Response:
+            [error_code: 2][controller_id: 4][metadata_version: 8][has_metadata: 1][metadata]
+            metadata (see write_metadata) is included when ours is newer.
+        """
+        broker_id = buf.read_int32()
+        version = buf.read_int64()
+        self.last_seen[broker_id] = time.monotonic()
+
+        writer = ByteWriter()
+        writer.write_int16(ERR_NONE).write_int32(self.controller_id).write_int64(self.version)
+        if self.version > version:
+            writer.write_int8(1)
+            self.write_metadata(writer)
+        else:
+            writer.write_int8(0)
+        return writer.to_bytes()
+
+    def become_controller(self):
+        with self.controller_lock:
+            now = time.monotonic()
+            # Every broker gets a full session to check in before it is declared dead
+            self.last_seen = {peer_id: now for peer_id in self.peers}
+            self.controller_id = self.broker_id
+            self.broker.offsets.reload()
+            self.update_metadata(copy.deepcopy(self.partitions))
+        print(f"  Broker {self.broker_id} is now the controller")
+
+    def update_metadata(self, partitions: dict, configs: dict = None):
+        """Publish a new metadata version (controller only; hold controller_lock)."""
+        self.apply_metadata(self.version + 1, configs or {}, partitions)
+
+    def live_brokers(self) -> set:
+        now = time.monotonic()
+        return {self.broker_id} | {broker_id for broker_id, seen in self.last_seen.items()
+                                   if now - seen < BROKER_SESSION_TIMEOUT}
+
+    def elect_leaders(self):
+        """
+        Move leadership off brokers that stopped heartbeating, to the first
+        live replica in the ISR. A partition with no live ISR replica goes
+        offline (leader -1) until one comes back; replicas outside the ISR
+        may be missing acked records, so they are never elected.
+        """
+        with self.controller_lock:
+            alive = self.live_brokers()
+            partitions = copy.deepcopy(self.partitions)
+            changed = []
+            for topic, states in partitions.items():
+                for partition_id, state in enumerate(states):
+                    if state["leader"] in alive:
+                        continue
+                    candidates = [replica for replica in state["isr"] if replica in alive]
+                    if candidates:
+                        state["leader"] = candidates[0]
+                        state["isr"] = candidates
+                    elif state["leader"] >= 0:
+                        state["leader"] = -1
+                    else:
+                        continue
+                    state["leader_epoch"] += 1
+                    changed.append(f"{topic}-{partition_id} -> {state['leader']}")
+
+            if changed:
+                print(f"  Elected leaders: {', '.join(changed)}")
+                self.update_metadata(partitions)
+
+    def create_topic(self, name: str, num_partitions: int, config: dict) -> int:
+        """
+        Create a topic across the cluster. The controller assigns each
+        partition's replicas round-robin over the live brokers, starting one
+        broker further along for every topic so leadership spreads out;
+        other brokers forward the request to it. Returns an error code.
+        """
+        if not self.is_controller():
+            return self.forward_create_topic(name, num_partitions, config)
+
+        with self.controller_lock:
+            if name in self.partitions:
+                return ERR_NONE
+
+            brokers = sorted(self.live_brokers())
+            factor = min(config.get("replication_factor") or DEFAULT_REPLICATION_FACTOR, len(brokers))
+            start = len(self.partitions)
+            states = []
+            for partition_id in range(num_partitions):
+                replicas = [brokers[(start + partition_id + i) % len(brokers)] for i in range(factor)]
+                states.append({"leader": replicas[0], "leader_epoch": 0, "replicas": replicas, "isr": replicas})
+
+            partitions = copy.deepcopy(self.partitions)
+            partitions[name] = states
+            self.update_metadata(partitions, {name: config})
+        return ERR_NONE
+
+    def forward_create_topic(self, name: str, num_partitions: int, config: dict) -> int:
+        peer = self.peers.get(self.controller_id)
+        if peer is None:
+            return ERR_NOT_COORDINATOR
+
+        writer = peer.request(API_CREATE_TOPIC)
+        writer.write_string(name).write_int32(num_partitions)
+        write_config(writer, config)
+        try:
+            return peer.roundtrip(writer).read_int16()
+        except ConnectionError:
+            return ERR_NOT_COORDINATOR
+
+    def alter_isr(self, topic: str, partition_id: int, leader_epoch: int, isr: list) -> int:
+        """Change a partition's ISR on behalf of its leader (controller only). Returns an error code."""
+        with self.controller_lock:
+            partitions = copy.deepcopy(self.partitions)
+            states = partitions.get(topic)
+            if states is None:
+                return ERR_UNKNOWN_TOPIC
+            if partition_id >= len(states):
+                return ERR_UNKNOWN_PARTITION
+
+            state = states[partition_id]
+            if state["leader_epoch"] != leader_epoch:
+                return ERR_NOT_LEADER  # from a leader that has since been replaced
+            if state["isr"] != isr:
+                state["isr"] = isr
+                self.update_metadata(partitions)
+        return ERR_NONE
+
+    def handle_alter_isr(self, buf: ByteBuffer) -> bytes:
+        """
+        ALTER_ISR request payload:
+            [topic: string][partition: 4][leader_epoch: 4][num_isr: 4] then for each: [broker_id: 4]
+        Response:
+            [error_code: 2]
+            ERR_NOT_LEADER if leader_epoch is stale, ERR_NOT_COORDINATOR if
+            this broker isn't the controller.
+        """
+        topic = buf.read_string()
+        partition_id = buf.read_int32()
+        leader_epoch = buf.read_int32()
+        isr = [buf.read_int32() for _ in range(buf.read_int32())]
+
+        if not self.is_controller():
+            return ByteWriter().write_int16(ERR_NOT_COORDINATOR).to_bytes()
+        error_code = self.alter_isr(topic, partition_id, leader_epoch, isr)
+        return ByteWriter().write_int16(error_code).to_bytes()
+
+    # ──────────────────────────────────────────────
+    # Leader
+    # ──────────────────────────────────────────────
+
+    def follower_fetched(self, topic: str, partition_id: int, replica_id: int, offset: int, partition):
+        """
+        Record a follower's fetch offset, which is its log end, and move the
+        high watermark. A follower counts as caught up when it has
+        everything we had at its previous fetch (see check_followers).
+        """
+        key = (topic, partition_id)
+        now = time.monotonic()
+        with self.lock:
+            followers = self.followers.get(key)
+            if followers is None or replica_id not in followers:
+                return
+            follower = followers[replica_id]
+            follower["offset"] = offset
+            if offset >= partition.next_offset or (follower["fetch_end"] is not None
+                                                   and offset >= follower["fetch_end"]):
+                follower["caught_up"] = now
+            follower["fetch_end"] = partition.next_offset
+
+        self.update_high_watermark(topic, partition_id)
+
+    def update_high_watermark(self, topic: str, partition_id: int):
+        """Move a led partition's high watermark to the lowest log end in the ISR."""
+        partition = self.broker.topics[topic][partition_id]
+        with self.lock:
+            followers = self.followers.get((topic, partition_id), {})
+            in_sync = [followers[replica]["offset"] for replica in self.partitions[topic][partition_id]["isr"]
+                       if replica in followers]
+
+        # With no followers in sync the high watermark follows appends again
+        partition.update_high_watermark(min(in_sync + [partition.next_offset]), replicated=bool(in_sync))
+
+    def check_followers(self):
+        """
+        Keep the ISR of led partitions current: followers leave it once they
+        haven't caught up for REPLICA_LAG_TIME_MAX, and rejoin it once they
+        reach the high watermark.
+        """
+        now = time.monotonic()
+        for topic, partition_id in list(self.leading):
+            partition = self.broker.topics[topic][partition_id]
+            with self.lock:
+                followers = self.followers.get((topic, partition_id), {})
+                isr = self.partitions[topic][partition_id]["isr"]
+                new_isr = [replica for replica in isr if replica not in followers
+                           or now - followers[replica]["caught_up"] <= REPLICA_LAG_TIME_MAX]
+                new_isr += [replica for replica, follower in followers.items()
+                            if replica not in isr and follower["offset"] >= partition.high_watermark
+                            and now - follower["caught_up"] <= REPLICA_LAG_TIME_MAX]
+            if new_isr != isr:
+                self.change_isr(topic, partition_id, new_isr)
+
+    def change_isr(self, topic: str, partition_id: int, isr: list):
+        """Ask the controller to change a led partition's ISR; on success use it straight away."""
+        state = self.partitions[topic][partition_id]
+        if self.is_controller():
+            error_code = self.alter_isr(topic, partition_id, state["leader_epoch"], isr)
+        else:
+            peer = self.peers.get(self.controller_id)
+            if peer is None:
+                return
+            writer = peer.request(API_ALTER_ISR)
+            writer.write_string(topic).write_int32(partition_id).write_int32(state["leader_epoch"])
+            writer.write_int32(len(isr))
+            for replica in isr:
+                writer.write_int32(replica)
+            try:
+                error_code = peer.roundtrip(writer).read_int16()
+            except ConnectionError:
+                return
+
+        if error_code != ERR_NONE:
+            return
+        with self.lock:
+            state["isr"] = isr
+        print(f"  {topic}-{partition_id} ISR is now {isr}")
+        self.update_high_watermark(topic, partition_id)
+
+    # ──────────────────────────────────────────────
+    # Follower
+    # ──────────────────────────────────────────────
+
+    def followed_partitions(self, leader_id: int) -> dict:
+        """{(topic, partition): Partition} we replicate from broker leader_id, including the offsets log."""
+        followed = {}
+        for topic, states in list(self.partitions.items()):
+            for partition_id, state in enumerate(states):
+                if state["leader"] == leader_id and self.broker_id in state["replicas"] \
+                        and self.roles.get((topic, partition_id)) == (leader_id, state["leader_epoch"]):
+                    followed[(topic, partition_id)] = self.broker.topics[topic][partition_id]
+        if self.controller_id == leader_id:
+            followed[(OFFSETS_TOPIC, 0)] = self.broker.offsets.log
+        return followed
+
+    def fetch_loop(self, leader_id: int):
+        """
+        Background thread replicating every partition broker leader_id leads
+        for us, one long-polling FETCH at a time over a connection of its own.
+        """
+        peer = PeerClient(*self.brokers[leader_id], f"replica-{self.broker_id}")
+        while True:
+            followed = self.followed_partitions(leader_id)
+            if not followed:
+                time.sleep(CLUSTER_INTERVAL)
+                continue
+
+            writer = peer.request(API_FETCH)
+            writer.write_int32(self.broker_id)
+            writer.write_int32(REPLICA_FETCH_WAIT_MS).write_int32(1).write_int32(REPLICA_FETCH_MAX_BYTES)
+            topics = {}
+            for topic, partition_id in followed:
+                topics.setdefault(topic, []).append(partition_id)
+            writer.write_int32(len(topics))
+            for topic, partition_ids in topics.items():
+                writer.write_string(topic).write_int32(len(partition_ids))
+                for partition_id in partition_ids:
+                    writer.write_int32(partition_id)
+                    writer.write_int64(followed[(topic, partition_id)].next_offset)
+                    writer.write_int32(REPLICA_FETCH_PARTITION_BYTES)
+
+            try:
+                buf = peer.roundtrip(writer, REPLICA_FETCH_WAIT_MS / 1000 + PEER_TIMEOUT)
+            except ConnectionError:
+                time.sleep(CLUSTER_INTERVAL)
+                continue
+
+            stale = False
+            for _ in range(buf.read_int32()):
+                topic = buf.read_string()
+                for _ in range(buf.read_int32()):
+                    partition = followed[(topic, buf.read_int32())]
+                    error_code = buf.read_int16()
+                    high_watermark = buf.read_int64()
+                    records = buf.read_view()
+
+                    if error_code == ERR_NONE:
+                        partition.append_replicated(records)
+                        partition.update_high_watermark(high_watermark)
+                    elif error_code == ERR_OFFSET_OUT_OF_RANGE:
+                        # We have records the leader doesn't; it sent its log end
+                        partition.truncate_to(high_watermark)
+                    else:
+                        stale = True  # the leader moved; our metadata will catch up
+
+            if stale:
+                time.sleep(CLUSTER_INTERVAL)
@@ -0,0 +1,46 @@
+import lzma
+import zlib
+
+
+# Codec ids as stored in each record batch's attributes byte
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+
+class Codec:
+    """A named pair of compress/decompress functions over bytes."""
+
+    def __init__(self, codec_id: int, name: str, compress, decompress):
+        self.id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+CODECS = {}
+CODECS_BY_NAME = {}
+
+
+def register_codec(codec_id: int, name: str, compress, decompress):
+    """
+    Make a codec available to producers, the broker and consumers, e.g.:
+        register_codec(3, 'zstd', zstd.compress, zstd.decompress)
+    Every process that reads or writes such batches must register it.
+    """
+    codec = Codec(codec_id, name, compress, decompress)
+    CODECS[codec_id] = codec
+    CODECS_BY_NAME[name] = codec
+    return codec
+
+
+def get_codec(codec) -> Codec:
+    """Look up a codec by id or name. Raises KeyError for unknown codecs."""
+    if isinstance(codec, str):
+        return CODECS_BY_NAME[codec]
+    return CODECS[codec]
+
+
+register_codec(CODEC_NONE, 'none', bytes, bytes)
+register_codec(CODEC_ZLIB, 'zlib', zlib.compress, zlib.decompress)
+register_codec(CODEC_LZMA, 'lzma', lzma.compress, lzma.decompress)
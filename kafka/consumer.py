@@ -1,29 +1,69 @@
-import socket
-import time
 import threading
+import time
 from protocol import (
-    ByteBuffer, ByteWriter,
-    recv_framed, send_framed,
-    API_FETCH, API_JOIN_GROUP,
-    ERR_NONE,
+    ByteBuffer, ByteWriter, decode_batches,
+    API_FETCH, API_JOIN_GROUP, API_OFFSET_COMMIT, API_OFFSET_FETCH, API_LIST_OFFSETS,
+    API_HEARTBEAT, API_LEAVE_GROUP, API_METADATA, LATEST_TIMESTAMP, EARLIEST_TIMESTAMP,
+    ERR_NONE, ERR_UNKNOWN_MEMBER, ERR_ILLEGAL_GENERATION,
 )
+from client import ClusterMetadata, RETRY_BACKOFF, RETRIABLE_ERRORS
+
+
+def decode_utf8(value) -> str:
+    return value.decode('utf-8')
 
 
 class Consumer:
-    def __init__(self, host='localhost', port=9092, client_id='consumer-1'):
+    def __init__(self, host='localhost', port=9092, client_id='consumer-1',
+                 enable_auto_commit=True, auto_commit_interval_ms=5000,
+                 session_timeout_ms=10000, heartbeat_interval_ms=3000, assignor='range',
+                 retry_timeout_ms=30000, value_deserializer=decode_utf8):
+        """
+        host and port are any broker of the cluster. Group requests go to
+        the controller, which coordinates consumer groups, and fetches to
+        each partition's leader. Requests that fail because either moved
+        are retried on fresh metadata for up to retry_timeout_ms.
+        value_deserializer turns each fetched value's bytes into what
+        fetch() returns, e.g. schema.decode for schema-encoded events; by
+        default values are decoded as utf-8 strings.
+        """
         self.host = host
         self.port = port
         self.client_id = client_id
         self.correlation_id = 0
         self.lock = threading.Lock()
+        self.retry_timeout = retry_timeout_ms / 1000
+        self.value_deserializer = value_deserializer
 
-        # Connect to broker
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
+        # Group membership, set by join_group. When the group rebalances the
+        # heartbeat thread sets rejoin_needed, and the next fetch commits and
+        # joins again to pick up the new assignment.
+        self.group = None
+        self.subscription = []
+        self.generation = -1
+        self.assignment = []   # [(topic, partition)] owned in this generation
+        self.positions = {}    # (topic, partition) -> next offset to fetch
+        self.session_timeout_ms = session_timeout_ms
+        self.heartbeat_interval = heartbeat_interval_ms / 1000
+        self.assignor = assignor
+        self.rejoin_needed = False
+        self.closed = threading.Event()
+        self.heartbeat_thread = None
 
-        # Will be set after joining a group
-        self.assigned_partition = None
-        self.current_offset = 0
+        # Positions are committed to the broker every auto_commit_interval_ms
+        # (checked on fetch) and on close
+        self.enable_auto_commit = enable_auto_commit
+        self.auto_commit_interval = auto_commit_interval_ms / 1000
+        self.last_commit_time = time.time()
+        self.committed = {}    # (topic, partition) -> last committed offset
+
+        # Rotates the order partitions are listed in fetch requests
+        self.fetch_turn = 0
+
+        # Brokers and partition leaders, with a connection per broker
+        self.cluster = ClusterMetadata(host, port)
+        if not self.refresh_metadata():
+            raise ConnectionError(f"No broker reachable at {host}:{port}")
 
     def _next_correlation_id(self) -> int:
         with self.lock:
@@ -38,73 +78,405 @@ class Consumer:
         writer.write_string(self.client_id)
         return writer
 
-    def join_group(self, group: str, topic: str):
-        """Join a consumer group and get a partition assignment."""
+    def refresh_metadata(self) -> bool:
+        """Look up brokers and our subscribed topics' leaders. Returns False if no broker answered."""
+        return self.cluster.refresh(self._build_header(API_METADATA), self.subscription)
+
+    def _request(self, writer: ByteWriter, route) -> ByteBuffer:
+        """Send a request to the broker route() names, retrying on fresh metadata."""
+        return self.cluster.request(writer.buffer(), route, self.refresh_metadata, self.retry_timeout)
+
+    def _coordinator_request(self, writer: ByteWriter) -> ByteBuffer:
+        return self._request(writer, lambda: self.cluster.controller)
+
+    def join_group(self, group: str, topics):
+        """
+        Join a consumer group subscribed to one topic or a list of topics,
+        and start heartbeating. The broker assigns this member a share of
+        the subscribed partitions (see assigned_partitions).
+        """
+        self.group = group
+        self.subscription = [topics] if isinstance(topics, str) else list(topics)
+        self.refresh_metadata()
+
+        if not self._join():
+            self.group = None
+            return
+
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+            self.heartbeat_thread.start()
+
+    def _join(self) -> bool:
+        """Send JOIN_GROUP and take over the returned assignment. Returns False on error."""
         writer = self._build_header(API_JOIN_GROUP)
-        writer.write_string(group)
+        writer.write_string(self.group)
         writer.write_string(self.client_id)
+        writer.write_int32(self.session_timeout_ms)
+        writer.write_string(self.assignor)
+        writer.write_int32(len(self.subscription))
+        for topic in self.subscription:
+            writer.write_string(topic)
+
+        try:
+            buf = self._coordinator_request(writer)
+        except OSError as e:
+            print(f"Failed to join group: {e}")
+            return False
+
+        error_code = buf.read_int16()
+        if error_code != ERR_NONE:
+            print(f"Failed to join group: error {error_code}")
+            return False
+
+        generation = buf.read_int32()
+        assignment = []
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            for _ in range(buf.read_int32()):
+                assignment.append((topic, buf.read_int32()))
+
+        # Partitions we keep continue from our own position; new ones resume
+        # from the group's last committed offset
+        added = [tp for tp in assignment if tp not in self.positions]
+        committed = self.fetch_committed(added) if added else {}
+        if committed is None:
+            return False
+
+        self.generation = generation
+        self.rejoin_needed = False
+        self.positions = {tp: self.positions[tp] if tp in self.positions else max(committed[tp], 0)
+                          for tp in assignment}
+        self.committed = {tp: self.committed.get(tp, committed.get(tp)) for tp in assignment}
+        self.assignment = assignment
+        return True
+
+    def _heartbeat_loop(self):
+        """
+        Background thread keeping our group session alive over a connection
+        of its own to the coordinator, so long polls and slow processing
+        don't hold it up. When the coordinator moves or goes away, the
+        connection is reopened to the new one on fresh metadata.
+        """
+        connection = None
+        try:
+            while not self.closed.wait(self.heartbeat_interval):
+                if self.group is None or self.rejoin_needed:
+                    continue
+
+                writer = self._build_header(API_HEARTBEAT)
+                writer.write_string(self.group)
+                writer.write_string(self.client_id)
+                writer.write_int32(self.generation)
+
+                try:
+                    if connection is None:
+                        connection = self.cluster.connect(self.cluster.controller)
+                    error_code = connection.roundtrip(writer.buffer()).read_int16()
+                except OSError:
+                    error_code = None
+
+                if error_code is None or error_code in RETRIABLE_ERRORS:
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+                    self.refresh_metadata()
+                elif error_code != ERR_NONE:
+                    self.rejoin_needed = True
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _maybe_rejoin(self):
+        """
+        Join again once the heartbeat thread reports a rebalance. Progress
+        is committed first, while our generation is still current, so the
+        partitions' next owners continue where we stopped.
+        """
+        if not self.rejoin_needed:
+            return
+        uncommitted = self._uncommitted()
+        if self.enable_auto_commit and uncommitted:
+            self.commit(uncommitted)
+        self._join()
+
+    def assigned_partitions(self, topic: str) -> list:
+        return [partition for assigned_topic, partition in self.assignment if assigned_topic == topic]
+
+    def _group_by_topic(self, entries) -> dict:
+        topics = {}
+        for topic, partition in entries:
+            topics.setdefault(topic, []).append(partition)
+        return topics
+
+    def commit(self, offsets: dict = None):
+        """
+        Commit {(topic, partition): next_offset} for our group in one request.
+        With no argument, commits the current position in every assigned partition.
+        """
+        if self.group is None:
+            print("Not in a group. Join a group first.")
+            return
+
+        if offsets is None:
+            offsets = dict(self.positions)
+
+        writer = self._build_header(API_OFFSET_COMMIT)
+        writer.write_string(self.group)
+        writer.write_string(self.client_id)
+        writer.write_int32(self.generation)
+        topics = self._group_by_topic(offsets)
+        writer.write_int32(len(topics))
+        for topic, partitions in topics.items():
+            writer.write_string(topic)
+            writer.write_int32(len(partitions))
+            for partition in partitions:
+                writer.write_int32(partition)
+                writer.write_int64(offsets[(topic, partition)])
+
+        try:
+            buf = self._coordinator_request(writer)
+        except OSError as e:
+            print(f"Failed to commit offsets: {e}")
+            return
+
+        error_code = buf.read_int16()
+
+        if error_code in (ERR_ILLEGAL_GENERATION, ERR_UNKNOWN_MEMBER):
+            # The group moved on without us; these partitions may have a new owner
+            self.rejoin_needed = True
+        if error_code != ERR_NONE:
+            print(f"Failed to commit offsets: error {error_code}")
+            return
+
+        self.last_commit_time = time.time()
+        for tp, offset in offsets.items():
+            if tp in self.committed:
+                self.committed[tp] = offset
+
+    def fetch_committed(self, partitions) -> dict:
+        """
+        Look up our group's committed offsets for an iterable of
+        (topic, partition). Returns {(topic, partition): offset}, with -1 for
+        partitions the group has never committed, or None on error.
+        """
+        writer = self._build_header(API_OFFSET_FETCH)
+        writer.write_string(self.group)
+        topics = self._group_by_topic(partitions)
+        writer.write_int32(len(topics))
+        for topic, topic_partitions in topics.items():
+            writer.write_string(topic)
+            writer.write_int32(len(topic_partitions))
+            for partition in topic_partitions:
+                writer.write_int32(partition)
+
+        try:
+            buf = self._coordinator_request(writer)
+        except OSError as e:
+            print(f"Failed to fetch committed offsets: {e}")
+            return None
+
+        error_code = buf.read_int16()
+        if error_code != ERR_NONE:
+            print(f"Failed to fetch committed offsets: error {error_code}")
+            return None
+
+        committed = {}
+        for _ in range(buf.read_int32()):
+            topic = buf.read_string()
+            partition = buf.read_int32()
+            committed[(topic, partition)] = buf.read_int64()
+        return committed
+
+    def _uncommitted(self) -> dict:
+        return {tp: offset for tp, offset in self.positions.items() if offset != self.committed.get(tp)}
+
+    def _maybe_auto_commit(self):
+        if not self.enable_auto_commit or time.time() - self.last_commit_time < self.auto_commit_interval:
+            return
+        uncommitted = self._uncommitted()
+        if uncommitted:
+            self.commit(uncommitted)
+
+    def offset_for_time(self, topic: str, partition: int, timestamp_ms: int) -> int:
+        """
+        The first offset the broker appended at or after timestamp_ms, or the
+        log end offset if there is none. Also accepts LATEST_TIMESTAMP and
+        EARLIEST_TIMESTAMP. Returns -1 on error.
+        """
+        writer = self._build_header(API_LIST_OFFSETS)
         writer.write_string(topic)
+        writer.write_int32(partition)
+        writer.write_int64(timestamp_ms)
 
-        send_framed(self.sock, writer.to_bytes())
+        try:
+            buf = self._request(writer, lambda: self.cluster.leader(topic, partition))
+        except OSError as e:
+            print(f"Failed to look up offset: {e}")
+            return -1
 
-        response = recv_framed(self.sock)
-        buf = ByteBuffer(response)
-        correlation_id = buf.read_int32()
         error_code = buf.read_int16()
-        partition = buf.read_int32()
+        offset = buf.read_int64()
 
-        if error_code == ERR_NONE and partition >= 0:
-            self.assigned_partition = partition
-            pass
-        else:
-            print(f"Failed to join group: error {error_code}")
+        if error_code != ERR_NONE:
+            print(f"Failed to look up offset: error {error_code}")
+            return -1
+        return offset
+
+    def seek(self, topic: str, partition: int, offset: int):
+        """Continue fetching an assigned partition from offset."""
+        self.positions[(topic, partition)] = offset
+
+    def seek_to_time(self, timestamp_ms: int):
+        """
+        Continue every assigned partition from its first record appended at
+        or after timestamp_ms, e.g. to re-run the last two hours.
+        """
+        for topic, partition in self.assignment:
+            offset = self.offset_for_time(topic, partition, timestamp_ms)
+            if offset >= 0:
+                self.seek(topic, partition, offset)
 
-    def fetch(self, topic: str, max_records: int = 10) -> list:
-        """Fetch messages from the assigned partition."""
-        if self.assigned_partition is None:
+    def seek_to_beginning(self):
+        self.seek_to_time(EARLIEST_TIMESTAMP)
+
+    def seek_to_end(self):
+        self.seek_to_time(LATEST_TIMESTAMP)
+
+    def fetch(self, topic: str = None, max_bytes: int = 1024 * 1024,
+              max_wait_ms: int = 0, min_bytes: int = 1, max_partition_bytes: int = None) -> list:
+        """
+        Fetch messages from all our partitions of topic, or of every
+        subscribed topic when topic is None, in one request. max_bytes caps
+        the response and max_partition_bytes (default max_bytes) each
+        partition; the broker shares max_bytes fairly between partitions
+        with data. With max_wait_ms > 0 the broker holds the request until
+        at least min_bytes are available across them or the wait expires.
+        Returns (topic, partition, offset, key, value) tuples.
+        """
+        if self.group is None:
             print("Not assigned to any partition. Join a group first.")
             return []
 
-        writer = self._build_header(API_FETCH)
-        writer.write_string(topic)
-        writer.write_int32(self.assigned_partition)
-        writer.write_int64(self.current_offset)
-        writer.write_int32(max_records)
+        self._maybe_rejoin()
 
-        send_framed(self.sock, writer.to_bytes())
+        # Commit what previous fetches returned, now that the caller has
+        # come back for more (at-least-once)
+        self._maybe_auto_commit()
 
-        response = recv_framed(self.sock)
-        buf = ByteBuffer(response)
-        correlation_id = buf.read_int32()
-        error_code = buf.read_int16()
-        num_records = buf.read_int32()
+        fetching = [tp for tp in self.assignment if topic is None or tp[0] == topic]
+        if not fetching:
+            # The group has more members than partitions; wait for a rebalance
+            time.sleep(max_wait_ms / 1000)
+            return []
+
+        # Rotate the request order, so partitions the broker can't tell
+        # apart don't always get the larger share
+        self.fetch_turn = (self.fetch_turn + 1) % len(fetching)
+        fetching = fetching[self.fetch_turn:] + fetching[:self.fetch_turn]
+
+        # One request per partition leader, all sent before any is read so
+        # the brokers wait for data in parallel
+        leaders = {}
+        for tp in fetching:
+            leaders.setdefault(self.cluster.leader(*tp), []).append(tp)
+
+        sent = []
+        stale = False
+        for leader, leader_fetching in leaders.items():
+            writer = self._build_header(API_FETCH)
+            writer.write_int32(-1)  # replica_id: not a follower broker
+            writer.write_int32(max_wait_ms)
+            writer.write_int32(min_bytes)
+            writer.write_int32(max_bytes)
+            topics = self._group_by_topic(leader_fetching)
+            writer.write_int32(len(topics))
+            for fetch_topic, partitions in topics.items():
+                writer.write_string(fetch_topic)
+                writer.write_int32(len(partitions))
+                for partition in partitions:
+                    writer.write_int32(partition)
+                    writer.write_int64(self.positions[(fetch_topic, partition)])
+                    writer.write_int32(max_partition_bytes or max_bytes)
+
+            try:
+                connection = self.cluster.connection(leader)
+                connection.send(writer.buffer())
+                sent.append((leader, connection))
+            except OSError:
+                self.cluster.drop(leader)
+                stale = True
 
         records = []
-        for _ in range(num_records):
-            offset = buf.read_int64()
-            key = buf.read_string()
-            value = buf.read_bytes().decode('utf-8')
-            records.append((offset, key, value))
+        for leader, connection in sent:
+            try:
+                buf = connection.receive()
+            except OSError:
+                self.cluster.drop(leader)
+                stale = True
+                continue
+
+            for _ in range(buf.read_int32()):
+                fetch_topic = buf.read_string()
+                for _ in range(buf.read_int32()):
+                    partition = buf.read_int32()
+                    error_code = buf.read_int16()
+                    high_watermark = buf.read_int64()
+                    records_data = buf.read_view()
+
+                    if error_code in RETRIABLE_ERRORS:
+                        stale = True
+                        continue
+                    if error_code != ERR_NONE:
+                        print(f"Failed to fetch {fetch_topic}-{partition}: error {error_code}")
+                        continue
+
+                    position = self.positions[(fetch_topic, partition)]
+                    for offset, key, value in decode_batches(records_data, position):
+                        records.append((fetch_topic, partition, offset, key, self.value_deserializer(value)))
 
-            # Advance our offset past what we've read
-            self.current_offset = offset + 1
+                        # Advance our position past what we've read
+                        self.positions[(fetch_topic, partition)] = offset + 1
+
+        if stale:
+            # Some leaders moved or went away; look them up for the next fetch
+            if not sent:
+                time.sleep(RETRY_BACKOFF)
+            self.refresh_metadata()
 
         return records
 
-    def poll(self, topic: str, interval: float = 1.0):
-        """Continuously poll for new messages."""
-        print(f"Polling topic '{topic}' partition {self.assigned_partition}...")
+    def poll(self, topic: str = None, max_wait_ms: int = 500):
+        """Continuously long-poll for new messages."""
+        print(f"Polling {self.assignment}...")
         print("-" * 50)
 
         while True:
-            records = self.fetch(topic)
-            for offset, key, value in records:
-                print(f"  offset={offset} key={key} value={value}")
+            records = self.fetch(topic, max_wait_ms=max_wait_ms)
+            for topic_name, partition, offset, key, value in records:
+                print(f"  {topic_name}-{partition} offset={offset} key={key} value={value}")
+
+    def leave_group(self):
+        """Leave the group so our partitions are reassigned right away."""
+        writer = self._build_header(API_LEAVE_GROUP)
+        writer.write_string(self.group)
+        writer.write_string(self.client_id)
 
-            time.sleep(interval)
+        try:
+            self._coordinator_request(writer)
+        except OSError as e:
+            print(f"Failed to leave group: {e}")
+        self.group = None
+        self.assignment = []
 
     def close(self):
-        self.sock.close()
+        self.closed.set()
+        if self.group is not None:
+            uncommitted = self._uncommitted()
+            if self.enable_auto_commit and uncommitted:
+                self.commit(uncommitted)
+            self.leave_group()
+        self.cluster.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,292 @@
+import threading
+import time
+from protocol import (
+    ERR_NONE, ERR_UNKNOWN_TOPIC, ERR_UNKNOWN_MEMBER, ERR_ILLEGAL_GENERATION, ERR_INCONSISTENT_ASSIGNOR,
+    ERR_REBALANCE_IN_PROGRESS,
+)
+
+
+# ──────────────────────────────────────────────
+# Assignors
+#
+# Each takes {member: [topics]} and {topic: num_partitions} for every topic
+# the group subscribes to, and returns {member: [(topic, partition)]}.
+# Members are taken in id order, so every run gives the same result.
+# ──────────────────────────────────────────────
+
+def range_assignor(subscriptions: dict, partition_counts: dict) -> dict:
+    """
+    Per topic, split the partitions into contiguous ranges over the members
+    subscribed to it. The first (partitions % members) members get one extra.
+    """
+    assignment = {member: [] for member in subscriptions}
+    for topic in sorted(partition_counts):
+        members = sorted(member for member, topics in subscriptions.items() if topic in topics)
+        per_member, extra = divmod(partition_counts[topic], len(members))
+
+        start = 0
+        for i, member in enumerate(members):
+            count = per_member + (1 if i < extra else 0)
+            assignment[member].extend((topic, partition) for partition in range(start, start + count))
+            start += count
+    return assignment
+
+
+def round_robin_assignor(subscriptions: dict, partition_counts: dict) -> dict:
+    """
+    Deal every topic-partition in turn to the members, skipping members not
+    subscribed to its topic. Evens out groups that read several topics,
+    where range hands the extra partition of each topic to the same member.
+    """
+    assignment = {member: [] for member in subscriptions}
+    members = sorted(subscriptions)
+    turn = 0
+    for topic in sorted(partition_counts):
+        for partition in range(partition_counts[topic]):
+            while topic not in subscriptions[members[turn % len(members)]]:
+                turn += 1
+            assignment[members[turn % len(members)]].append((topic, partition))
+            turn += 1
+    return assignment
+
+
+ASSIGNORS = {
+    "range": range_assignor,
+    "roundrobin": round_robin_assignor,
+}
+
+
+# ──────────────────────────────────────────────
+# Coordinator
+# ──────────────────────────────────────────────
+
+class Group:
+    def __init__(self, name: str, assignor: str, lock):
+        self.name = name
+        self.assignor = assignor
+        self.generation = 0
+        self.members = {}     # consumer_id -> {"topics", "session_timeout", "last_heartbeat"}
+        self.assignment = {}  # consumer_id -> [(topic, partition)]
+
+        # While rebalancing: members that joined this round, and when the
+        # round ends without the ones that didn't
+        self.rebalancing = False
+        self.joined = set()
+        self.deadline = 0.0
+        self.changed = threading.Condition(lock)
+        self.listeners = set()  # called when a rebalance completes, for waiters not on a thread of their own
+
+
+class GroupCoordinator:
+    """
+    Tracks consumer group membership and decides partition ownership.
+
+    A change in membership (a new member or subscription, a leave, a member
+    whose session timed out) starts a rebalance. Members find out from
+    their heartbeats (ERR_REBALANCE_IN_PROGRESS), commit their progress and
+    join again; JOIN_GROUP blocks until every member has rejoined, or until
+    the longest session timeout has passed, after which the stragglers are
+    dropped. The coordinator then starts a new generation and assigns the
+    partitions with the group's assignor.
+
+    Until the rebalance completes everyone keeps their old partitions, so a
+    partition never has two owners. Offset commits must carry the current
+    generation, so a member that lost a partition can't overwrite its new
+    owner's progress.
+
+    Sessions are checked whenever the group is touched; live members
+    heartbeat every few seconds, so a dead one is noticed within about a
+    session timeout.
+    """
+
+    def __init__(self, topics: dict):
+        self.topics = topics  # the broker's topic -> partitions, for partition counts
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def join(self, group_name: str, consumer_id: str, topics: list,
+             session_timeout_ms: int, assignor: str):
+        """
+        Add or refresh a member, waiting for the rebalance to complete if
+        one is needed. Joining with an unchanged subscription while the
+        group is stable (a restarted consumer) returns the current
+        assignment straight away.
+        Returns (error_code, generation, [(topic, partition)]).
+        """
+        result, pending = self.begin_join(group_name, consumer_id, topics, session_timeout_ms, assignor)
+        if pending is None:
+            return result
+        return self.finish_join(*pending, consumer_id)
+
+    def begin_join(self, group_name: str, consumer_id: str, topics: list,
+                   session_timeout_ms: int, assignor: str) -> tuple:
+        """
+        The part of join that doesn't wait: add or refresh the member,
+        starting a rebalance if one is needed. Returns (join's result, None)
+        if the join is answered already, else (None, (group, generation))
+        for finish_join.
+        """
+        with self.lock:
+            if assignor not in ASSIGNORS:
+                return (ERR_INCONSISTENT_ASSIGNOR, -1, []), None
+            if any(topic not in self.topics for topic in topics):
+                return (ERR_UNKNOWN_TOPIC, -1, []), None
+
+            now = time.monotonic()
+            group = self.groups.get(group_name)
+            if group is None:
+                group = self.groups[group_name] = Group(group_name, assignor, self.lock)
+            else:
+                self._expire(group, now)
+                if not group.members:
+                    group.assignor = assignor  # an empty group takes on the new member's choice
+                elif assignor != group.assignor:
+                    return (ERR_INCONSISTENT_ASSIGNOR, -1, []), None
+
+            member = group.members.get(consumer_id)
+            group.members[consumer_id] = {
+                "topics": sorted(topics),
+                "session_timeout": session_timeout_ms / 1000,
+                "last_heartbeat": now,
+            }
+            if not group.rebalancing and member is not None and member["topics"] == sorted(topics):
+                return (ERR_NONE, group.generation, group.assignment[consumer_id]), None
+
+            if not group.rebalancing:
+                self._start_rebalance(group, now)
+            group.joined.add(consumer_id)
+
+            generation = group.generation
+            self._maybe_complete(group)
+            return None, (group, generation)
+
+    def finish_join(self, group: Group, generation: int, consumer_id: str, block: bool = True):
+        """
+        The rest of join: wait for the rebalance that begin_join saw
+        (generation) to complete, completing it at its deadline, and return
+        join's result. With block False it returns None instead of
+        waiting; group.listeners tell when to call it again.
+        """
+        with self.lock:
+            while group.generation == generation:
+                remaining = group.deadline - time.monotonic()
+                if remaining <= 0:
+                    self._complete(group)
+                    break
+                if not block:
+                    return None
+                group.changed.wait(remaining)
+
+            if consumer_id not in group.members:
+                return ERR_UNKNOWN_MEMBER, -1, []
+            return ERR_NONE, group.generation, group.assignment[consumer_id]
+
+    def heartbeat(self, group_name: str, consumer_id: str, generation: int) -> int:
+        """Keep a member's session alive. Returns an error code telling it whether to join again."""
+        with self.lock:
+            group = self.groups.get(group_name)
+            if group is None:
+                return ERR_UNKNOWN_MEMBER
+
+            now = time.monotonic()
+            self._expire(group, now)
+            member = group.members.get(consumer_id)
+            if member is None:
+                return ERR_UNKNOWN_MEMBER
+
+            member["last_heartbeat"] = now
+            if group.rebalancing:
+                return ERR_REBALANCE_IN_PROGRESS
+            if generation != group.generation:
+                return ERR_ILLEGAL_GENERATION
+            return ERR_NONE
+
+    def leave(self, group_name: str, consumer_id: str) -> int:
+        """Remove a member straight away, so its partitions move without waiting for its session to time out."""
+        with self.lock:
+            group = self.groups.get(group_name)
+            if group is None or consumer_id not in group.members:
+                return ERR_UNKNOWN_MEMBER
+
+            del group.members[consumer_id]
+            group.joined.discard(consumer_id)
+            print(f"  Group '{group_name}': {consumer_id} left")
+
+            if not group.rebalancing:
+                self._start_rebalance(group, time.monotonic())
+            self._maybe_complete(group)
+            return ERR_NONE
+
+    def check_commit(self, group_name: str, consumer_id: str, generation: int) -> int:
+        """
+        Whether a member may commit offsets for the group. Generation -1 is
+        a commit from outside group management (tools, manual assignment)
+        and is always accepted. During a rebalance the old generation is
+        still current, so members can commit before they rejoin.
+        """
+        if generation == -1:
+            return ERR_NONE
+
+        with self.lock:
+            group = self.groups.get(group_name)
+            if group is None:
+                return ERR_UNKNOWN_MEMBER
+
+            self._expire(group, time.monotonic())
+            if consumer_id not in group.members:
+                return ERR_UNKNOWN_MEMBER
+            if generation != group.generation:
+                return ERR_ILLEGAL_GENERATION
+            return ERR_NONE
+
+    def _expire(self, group: Group, now: float):
+        """Drop members whose session timed out, rebalancing if there were any."""
+        # Members waiting in join don't heartbeat; the round's deadline covers them
+        expired = [consumer_id for consumer_id, member in group.members.items()
+                   if consumer_id not in group.joined
+                   and now - member["last_heartbeat"] > member["session_timeout"]]
+        if not expired:
+            return
+
+        for consumer_id in expired:
+            del group.members[consumer_id]
+        print(f"  Group '{group.name}': session timed out for {', '.join(expired)}")
+
+        if not group.rebalancing:
+            self._start_rebalance(group, now)
+        self._maybe_complete(group)
+
+    def _start_rebalance(self, group: Group, now: float):
+        group.rebalancing = True
+        group.joined = set()
+        group.deadline = now + max((member["session_timeout"] for member in group.members.values()), default=0)
+
+    def _maybe_complete(self, group: Group):
+        if group.rebalancing and group.joined >= set(group.members):
+            self._complete(group)
+
+    def _complete(self, group: Group):
+        """Drop members that didn't rejoin in time, then assign partitions in a new generation."""
+        missing = [consumer_id for consumer_id in group.members if consumer_id not in group.joined]
+        for consumer_id in missing:
+            del group.members[consumer_id]
+        if missing:
+            print(f"  Group '{group.name}': {', '.join(missing)} did not rejoin in time")
+
+        now = time.monotonic()
+        for member in group.members.values():
+            member["last_heartbeat"] = now
+
+        group.generation += 1
+        subscriptions = {consumer_id: member["topics"] for consumer_id, member in group.members.items()}
+        subscribed = {topic for topics in subscriptions.values() for topic in topics}
+        partition_counts = {topic: len(self.topics[topic]) for topic in subscribed}
+        group.assignment = ASSIGNORS[group.assignor](subscriptions, partition_counts)
+
+        group.rebalancing = False
+        group.joined = set()
+        group.changed.notify_all()
+        for listener in list(group.listeners):
+            listener()
+        print(f"  Group '{group.name}' generation {group.generation}: "
+              f"{len(group.members)} members, {group.assignor} assignment")
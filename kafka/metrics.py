@@ -0,0 +1,151 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets per power of two are 2 ** SUB_BUCKET_BITS, so a
+# recorded value is kept to within 1/32 (~3%) of itself
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Largest value a histogram tells apart (microseconds: about 12 days);
+# larger ones land in the last bucket
+MAX_VALUE_BITS = 40
+
+# Quantiles reported for every histogram
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value: int) -> int:
+    """
+    Values below 2 * SUB_BUCKETS get a bucket each. Above that, every power
+    of two is split into SUB_BUCKETS buckets twice as wide as the previous
+    power's.
+    """
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_value(index: int) -> int:
+    """The highest value recorded in a bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    """
+    Counts of integer values in log-linear buckets, like HdrHistogram:
+    recording is O(1) with fixed memory, and quantiles are read back with
+    a bounded relative error rather than from stored samples.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (bucket_index((1 << MAX_VALUE_BITS) - 1) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def record(self, value: int):
+        index = min(bucket_index(value), len(self.counts) - 1)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> int:
+        """The value at quantile q (0..1) of everything recorded, or 0 if empty."""
+        with self.lock:
+            if not self.count:
+                return 0
+            rank = max(1, round(q * self.count))
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(bucket_value(index), self.max)
+        return self.max
+
+
+def escape_label_value(value) -> str:
+    """A label value as the plaintext format quotes it: backslash, double quote and newline escaped."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsWriter:
+    """
+    Builds the plaintext exposition format Prometheus scrapes, with the
+    samples of each metric grouped under its type line whatever order
+    they were written in:
+        # TYPE name type
+        name{label="value",...} number
+    """
+
+    def __init__(self):
+        self.families = {}  # name -> [type line, sample lines...]
+
+    def write(self, name: str, metric_type: str, value, sample_name: str = None, **labels):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = [f"# TYPE {name} {metric_type}"]
+        family.append(f"{sample_name or name}{self._labels(labels)} {value}")
+
+    def gauge(self, name: str, value, **labels):
+        self.write(name, "gauge", value, **labels)
+
+    def counter(self, name: str, value, **labels):
+        self.write(name, "counter", value, **labels)
+
+    def summary(self, name: str, histogram: Histogram, scale: float = 1.0, **labels):
+        """
+        A histogram as quantiles, _sum and _count, its values multiplied by
+        scale, plus its largest value as the gauge name_max.
+        """
+        for q in QUANTILES:
+            self.write(name, "summary", f"{histogram.quantile(q) * scale:g}", **labels, quantile=q)
+        self.write(name, "summary", f"{histogram.total * scale:g}", f"{name}_sum", **labels)
+        self.write(name, "summary", histogram.count, f"{name}_count", **labels)
+        self.gauge(f"{name}_max", f"{histogram.max * scale:g}", **labels)
+
+    def _labels(self, labels: dict) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+    def text(self) -> str:
+        return "".join(line + "\n" for family in self.families.values() for line in family)
+
+
+class MetricsServer:
+    """
+    An HTTP endpoint serving render() as plaintext on GET /metrics, for
+    Prometheus or curl. Runs on a daemon thread of its own.
+    """
+
+    def __init__(self, host: str, port: int, render):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes every few seconds would flood the broker's output
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address[:2]
+        print(f"Metrics at http://{host}:{port}/metrics")
@@ -0,0 +1,90 @@
+import threading
+from partition import Partition
+from protocol import INT64
+
+
+# Internal topic holding every group's committed offsets
+OFFSETS_TOPIC = "__consumer_offsets"
+
+# How many records to read at a time when replaying the offsets log
+REPLAY_CHUNK = 1000
+
+# The offsets log is compacted down to one record per key. Small segments
+# let the cleaner get to commits soon, keeping the replay at startup short.
+OFFSETS_CONFIG = {
+    "cleanup_policy": "compact",
+    "segment_bytes": 4 * 1024 * 1024,
+    "tail_cache_bytes": 0,  # only ever read once, at startup
+}
+
+
+def offset_key(group: str, topic: str, partition: int) -> str:
+    return f"{group}/{topic}/{partition}"
+
+
+class OffsetStore:
+    """
+    Committed consumer offsets, kept in memory and persisted to an internal
+    log.
+
+    Every commit appends one record per partition, keyed by
+    group/topic/partition, with the offset as its value. Only the latest
+    record for a key matters, so the log is compacted by the log cleaner. On
+    startup the log is replayed to rebuild the in-memory map.
+    """
+
+    def __init__(self, log_dir: str):
+        self.log = Partition(log_dir, OFFSETS_TOPIC, 0, OFFSETS_CONFIG)
+        self.offsets = {}  # (group, topic, partition) -> next offset to consume
+        self.lock = threading.Lock()
+
+        self._replay()
+
+    def _replay(self):
+        offset = 0
+        while offset < self.log.next_offset:
+            records = self.log.read(offset, REPLAY_CHUNK)
+            if not records:
+                break
+            for record_offset, key, value in records:
+                group, topic, partition = key.rsplit("/", 2)
+                self.offsets[(group, topic, int(partition))] = INT64.unpack(value)[0]
+            offset = records[-1][0] + 1
+
+    def reload(self):
+        """
+        Rebuild the map from the log, e.g. when this broker becomes the
+        cluster's controller and takes over commits replicated from the
+        previous one.
+        """
+        with self.lock:
+            self.offsets = {}
+            self._replay()
+
+    def commit(self, group: str, offsets: dict):
+        """
+        Durably commit {(topic, partition): offset} for a group, with one
+        write and one fsync for the whole batch.
+        """
+        records = [
+            (offset_key(group, topic, partition), INT64.pack(offset))
+            for (topic, partition), offset in offsets.items()
+        ]
+        if not records:
+            return
+
+        with self.lock:
+            base_offset = self.log.append_batch(records)
+            for (topic, partition), offset in offsets.items():
+                self.offsets[(group, topic, partition)] = offset
+
+        self.log.flush(base_offset + len(records))
+
+    def committed(self) -> dict:
+        """A copy of every committed offset: {(group, topic, partition): offset}."""
+        with self.lock:
+            return dict(self.offsets)
+
+    def fetch(self, group: str, topic: str, partition: int) -> int:
+        """The group's committed offset for a partition, or -1 if it has none."""
+        return self.offsets.get((group, topic, partition), -1)
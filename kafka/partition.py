@@ -1,61 +1,345 @@
+import bisect
 import os
+import shutil
 import threading
-from protocol import ByteWriter, ByteBuffer
+import time
+from operator import attrgetter
+from cache import TailCache
+from compression import CODEC_NONE, get_codec
+from protocol import (
+    INT64, BATCH_HEADER_SIZE, build_batch, encode_records, decode_records, decode_batches, read_batch_header,
+)
+from segment import LogSegment, DELETED_SUFFIX, segment_name
+
+
+# Per-partition file recording the last fsynced point of the active segment
+CHECKPOINT_FILE = "recovery-point"
+
+# Per-partition file with the last saved high watermark of a replicated partition
+HIGH_WATERMARK_FILE = "high-watermark"
+
+# Subdirectory where the log cleaner builds compacted segments before swapping them in
+CLEANING_DIR = "cleaning"
+
+# Files making up one segment
+SEGMENT_SUFFIXES = (".log", ".index", ".timeindex")
+
+segment_base = attrgetter("base_offset")
+
+DEFAULT_CONFIG = {
+    "segment_bytes": 64 * 1024 * 1024,     # roll the active segment past this size
+    "segment_ms": 7 * 24 * 3600 * 1000,    # ... or once it is this old
+    "index_interval_bytes": 4096,          # bytes of log between sparse index entries
+    "max_index_bytes": 10 * 1024 * 1024,   # preallocated size of the active index
+    "flush_messages": None,                # fsync after this many unflushed records (1 = always)
+    "flush_ms": None,                      # fsync unflushed records at least this often
+    "compression": "producer",             # codec name for stored batches, or keep the producer's
+    "cleanup_policy": "delete",            # "delete" old segments, or "compact" to the latest record per key
+    "retention_ms": 7 * 24 * 3600 * 1000,  # delete: drop sealed segments whose newest record is this old
+    "retention_bytes": None,               # delete: drop the oldest sealed segments beyond this log size
+    "min_cleanable_dirty_ratio": 0.5,      # compact: clean once this share of the sealed log is new
+    "tail_cache_bytes": 4 * 1024 * 1024,   # most recent batches kept in memory for tailing fetches
+    "replication_factor": None,            # cluster: replicas per partition (default: up to 3)
+    "min_insync_replicas": 1,              # cluster: in-sync replicas an acks=-1 produce needs
+}
+
+# Configs that may be None: those that default to it, and retention_ms
+# (None keeps segments whatever their age)
+NULLABLE_CONFIGS = {name for name, default in DEFAULT_CONFIG.items() if default is None} | {"retention_ms"}
+
+
+def parse_config_value(name: str, value: str):
+    """
+    A topic config value sent as a string (see cluster.write_config),
+    converted to the type of its DEFAULT_CONFIG entry; configs that
+    default to None take ints, and "None" unsets a nullable config.
+    Raises ValueError for unknown configs and values that don't convert.
+    """
+    if name not in DEFAULT_CONFIG:
+        raise ValueError(f"Unknown config '{name}'")
+    if value == "None":
+        if name not in NULLABLE_CONFIGS:
+            raise ValueError(f"Config '{name}' can't be None")
+        return None
+
+    default = DEFAULT_CONFIG[name]
+    if isinstance(default, str):
+        return value
+    if isinstance(default, float):
+        return float(value)
+    return int(value)
 
 
 class Partition:
     """
-    An append-only log file on disk.
+    An append-only log on disk, split into segments.
 
-    Each record on disk is stored as:
-        [record_size: 4 bytes][offset: 8 bytes][key_size: 2+N bytes][value_size: 4+M bytes]
+    The log is a sequence of segment files, each named by the first offset it
+    holds. Only the last (active) segment is written to; it is rolled once it
+    reaches segment_bytes or segment_ms. Each segment has a sparse,
+    memory-mapped offset index, so finding an offset is a binary search over
+    segment base offsets followed by a binary search over that segment's index
+    and a short forward scan. A parallel sparse time index does the same for
+    append timestamps (see offset_for_timestamp).
 
-    We also maintain an in-memory index: offset -> file position
-    so we can quickly seek to any offset without scanning the whole file.
+    On startup only the active segment is recovered, and only from its last
+    checkpointed recovery point: the part of the log that was fsynced before
+    the checkpoint was written is trusted as-is.
+
+    Sealed segments are removed or rewritten by the log cleaner (cleaner.py).
+    The segment list is replaced rather than mutated, so readers work from a
+    consistent snapshot without taking the lock.
+
+    Appends go straight to the OS page cache through the active segment's open
+    file; fsync happens according to the flush_messages / flush_ms policy, or
+    when a producer asks for a durable ack. Concurrent flush requests are
+    group-committed: one fsync covers every record written before it.
+
+    Consumers only read up to the high watermark. On a single broker that is
+    the log end; in a cluster (see cluster.py) a replicated partition's high
+    watermark is moved by the broker once the in-sync replicas have the
+    records.
     """
 
-    def __init__(self, log_dir: str, topic: str, partition_id: int):
+    def __init__(self, log_dir: str, topic: str, partition_id: int, config: dict = None):
         self.topic = topic
         self.partition_id = partition_id
+        self.config = {**DEFAULT_CONFIG, **(config or {})}
+
+        # Codec id every stored batch must use, or None to keep the producer's
+        compression = self.config["compression"]
+        self.codec = None if compression == "producer" else get_codec(compression).id
         self.next_offset = 0
+        self.last_timestamp = 0  # append timestamps (ms) never go backwards
+
+        # Offsets below the high watermark are committed: readable by
+        # consumers. Unless replicated, it follows every append.
+        self.high_watermark = 0
+        self.replicated = False
+        self.saved_high_watermark = None
         self.lock = threading.Lock()
 
+        # Recent batches, so consumers at the tail are served from memory
+        self.cache = TailCache(self.config["tail_cache_bytes"])
+
+        # Counted and announced on every append so long-polling fetches wake up
+        self.bytes_appended = 0
+        self.listeners = set()  # callbacks run after each append
+
+        # Traffic counters for metrics (bytes_appended counts bytes in).
+        # bytes_read is bumped without the lock, so may miss a concurrent read.
+        self.records_appended = 0
+        self.bytes_read = 0
+
+        # Offsets below flushed_offset have been fsynced
+        self.flush_lock = threading.Lock()
+        self.flushed_offset = 0
+        self.last_flush_time = time.time()
+
+        # Last fsynced point of the log, and the one saved in CHECKPOINT_FILE:
+        # (segment_base, position, next_offset, last_batch_position)
+        self.recovery_point = None
+        self.checkpointed = None
+
         self.path = os.path.join(log_dir, f"{topic}-{partition_id}")
         os.makedirs(self.path, exist_ok=True)
 
-        self.log_file = os.path.join(self.path, "log.bin")
-
-        self.index = {}
+        self.segments = []
+        self.deleted_segments = []  # (deleted_at, segment) awaiting file removal
 
         self._recover()
 
     def _recover(self):
-        """Read existing log file to rebuild index and find next offset."""
-        if not os.path.exists(self.log_file):
+        """Open existing segments and rebuild the active segment's index."""
+        for name in os.listdir(self.path):
+            if name.endswith(DELETED_SUFFIX):
+                os.remove(os.path.join(self.path, name))
+        self._finish_cleaning()
+
+        base_offsets = sorted(
+            int(name[:-len(".log")])
+            for name in os.listdir(self.path)
+            if name.endswith(".log")
+        )
+
+        for base_offset in base_offsets[:-1]:
+            self._add_segment(LogSegment(self.path, base_offset, self.config, active=False))
+
+        if base_offsets:
+            active = LogSegment(self.path, base_offsets[-1], self.config, active=True)
+            checkpoint = self._read_checkpoint()
+            if checkpoint is not None and checkpoint[0] == active.base_offset:
+                self.next_offset = active.recover(checkpoint[1:])
+            else:
+                self.next_offset = active.recover()
+
+            # Whatever survived is made durable, so it is the new recovery point
+            active.flush()
+            self.flushed_offset = self.next_offset
+            self.recovery_point = (active.base_offset, active.size,
+                                   active.next_offset, active.last_batch_position)
+            self.last_timestamp = active.max_timestamp
+            self._add_segment(active)
+            print(f"  Recovered {self.topic}-{self.partition_id}: {self.next_offset} records "
+                  f"in {len(self.segments)} segments")
+        else:
+            self._add_segment(LogSegment(self.path, 0, self.config, active=True))
+
+        self.high_watermark = self.next_offset
+        try:
+            with open(os.path.join(self.path, HIGH_WATERMARK_FILE)) as f:
+                self.saved_high_watermark = int(f.read())
+            self.high_watermark = min(self.saved_high_watermark, self.next_offset)
+        except (OSError, ValueError):
+            pass
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, CHECKPOINT_FILE)) as f:
+                return tuple(int(field) for field in f.read().split())
+        except (OSError, ValueError):
+            return None
+
+    def checkpoint(self):
+        """
+        Save the recovery point so the next startup only scans the log
+        written after it, and the high watermark of a replicated partition.
+        Called periodically by the broker and on close.
+        """
+        high_watermark = self.high_watermark
+        if self.replicated and high_watermark != self.saved_high_watermark:
+            path = os.path.join(self.path, HIGH_WATERMARK_FILE)
+            with open(path + ".tmp", 'w') as f:
+                f.write(str(high_watermark))
+            os.replace(path + ".tmp", path)
+            self.saved_high_watermark = high_watermark
+
+        recovery_point = self.recovery_point
+        if recovery_point is None or recovery_point == self.checkpointed:
             return
 
-        with open(self.log_file, 'rb') as f:
-            while True:
-                file_position = f.tell()
+        # Index entries before the recovery point must be on disk too
+        with self.lock:
+            if self.segments[-1].base_offset == recovery_point[0]:
+                self.segments[-1].index.flush()
+                self.segments[-1].time_index.flush()
 
-                # Try to read record size
-                size_bytes = f.read(4)
-                if len(size_bytes) < 4:
-                    break
+        path = os.path.join(self.path, CHECKPOINT_FILE)
+        with open(path + ".tmp", 'w') as f:
+            f.write(" ".join(str(field) for field in recovery_point))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.checkpointed = recovery_point
 
-                record_size = int.from_bytes(size_bytes, byteorder='big')
-                record_data = f.read(record_size)
-                if len(record_data) < record_size:
-                    break
+    def _finish_cleaning(self):
+        """
+        Resolve a compaction interrupted by a crash. A cleaned segment whose
+        original is still in place was never swapped in and is discarded.
+        Otherwise the swap had started: the cleaned segment is moved into
+        place and any original segments it covers are removed.
+        """
+        cleaning_dir = os.path.join(self.path, CLEANING_DIR)
+        if not os.path.isdir(cleaning_dir):
+            return
+
+        for name in os.listdir(cleaning_dir):
+            if not name.endswith(".log") or os.path.exists(os.path.join(self.path, name)):
+                continue
+
+            base_offset = int(name[:-len(".log")])
+            for suffix in SEGMENT_SUFFIXES:
+                file_name = segment_name(base_offset, suffix)
+                os.rename(os.path.join(cleaning_dir, file_name), os.path.join(self.path, file_name))
+
+            cleaned = LogSegment(self.path, base_offset, self.config, active=False)
+            end_offset = cleaned.end_offset()
+            cleaned.close()
+
+            for other in os.listdir(self.path):
+                if other.endswith(".log") and base_offset < int(other[:-len(".log")]) < end_offset:
+                    for suffix in SEGMENT_SUFFIXES:
+                        os.remove(os.path.join(self.path, segment_name(int(other[:-len(".log")]), suffix)))
+
+        shutil.rmtree(cleaning_dir)
+
+    def _add_segment(self, segment: LogSegment):
+        self.segments = self.segments + [segment]
+
+    def _segments_from(self, start_offset: int) -> list:
+        """
+        The segments that may hold start_offset or anything after it, from
+        one snapshot of the segment list. Offsets before the start of the log
+        resume at the earliest record.
+        """
+        segments = self.segments
+        i = bisect.bisect_right(segments, start_offset, key=segment_base) - 1
+        return segments[max(i, 0):]
 
-                # Parse just the offset from the record
-                buf = ByteBuffer(record_data)
-                offset = buf.read_int64()
+    def log_start_offset(self) -> int:
+        return self.segments[0].base_offset
 
-                self.index[offset] = file_position
-                self.next_offset = offset + 1
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
 
-        print(f"  Recovered {self.topic}-{self.partition_id}: {self.next_offset} records")
+    def sealed_segments(self) -> list:
+        """Every segment but the active one; these never change until removed."""
+        return self.segments[:-1]
+
+    def delete_segments(self, segments: list):
+        """
+        Remove sealed segments from the log. Their files are renamed out of
+        the way at once and deleted later by delete_old_files, so fetches
+        already reading them can finish.
+        """
+        with self.lock:
+            self.cache.discard_before(self._end_of(segments[-1]))
+            self.segments = [segment for segment in self.segments if segment not in segments]
+            for segment in segments:
+                segment.mark_deleted()
+                self.deleted_segments.append((time.time(), segment))
+
+    def replace_segments(self, segments: list, cleaned_dir: str):
+        """
+        Swap a run of sealed segments for the compacted segment the cleaner
+        built in cleaned_dir, named after the first segment's base offset.
+        Originals are renamed first and the first one first, so a crash at
+        any point is resolved by _finish_cleaning.
+        """
+        base_offset = segments[0].base_offset
+        with self.lock:
+            self.cache.discard_before(self._end_of(segments[-1]))
+            for segment in segments:
+                segment.mark_deleted()
+                self.deleted_segments.append((time.time(), segment))
+
+            for suffix in SEGMENT_SUFFIXES:
+                name = segment_name(base_offset, suffix)
+                os.rename(os.path.join(cleaned_dir, name), os.path.join(self.path, name))
+
+            cleaned = LogSegment(self.path, base_offset, self.config, active=False)
+            position = self.segments.index(segments[0])
+            remaining = [segment for segment in self.segments if segment not in segments]
+            self.segments = remaining[:position] + [cleaned] + remaining[position:]
+
+    def _end_of(self, segment: LogSegment) -> int:
+        """The offset after a sealed segment: the next segment's base offset."""
+        return self.segments[self.segments.index(segment) + 1].base_offset
+
+    def delete_old_files(self, delay: float):
+        """Delete files of segments removed from the log more than delay seconds ago."""
+        cutoff = time.time() - delay
+        with self.lock:
+            expired = [segment for deleted_at, segment in self.deleted_segments if deleted_at <= cutoff]
+            self.deleted_segments = [(deleted_at, segment) for deleted_at, segment in self.deleted_segments
+                                     if deleted_at > cutoff]
+        for segment in expired:
+            segment.delete()
+
+    def _roll(self):
+        """Seal the active segment and start a new one at next_offset."""
+        self.segments[-1].close_active()
+        self._add_segment(LogSegment(self.path, self.next_offset, self.config, active=True))
 
     def append(self, key: str, value: bytes) -> int:
         """
@@ -63,26 +347,185 @@ class Partition:
         Thread-safe via lock since multiple connections might produce
         to the same partition.
         """
+        return self.append_batch([(key, value)])
+
+    def append_batch(self, records: list) -> int:
+        """
+        Append a list of (key, value) records as one batch, with one lock
+        acquisition and one write. Records get consecutive offsets; returns
+        the first one.
+        """
+        codec = self.codec if self.codec is not None else CODEC_NONE
+        payload = get_codec(codec).compress(encode_records(records))
+        return self.append_encoded(codec, len(records), payload)
+
+    def append_encoded(self, codec: int, record_count: int, payload: bytes) -> int:
+        """
+        Append a batch payload that is already encoded, and possibly compressed
+        by the producer. It is stored as-is unless the topic pins a different
+        codec, in which case it is recompressed. Returns the base offset.
+        """
+        if self.codec is not None and codec != self.codec:
+            records = decode_records(get_codec(codec).decompress(payload), record_count)
+            codec = self.codec
+            payload = get_codec(codec).compress(encode_records(records))
+
+        batch = build_batch(0, record_count, codec, payload)
+
         with self.lock:
-            offset = self.next_offset
+            base_offset = self.next_offset
+            INT64.pack_into(batch, 4, base_offset)
+
+            # Broker append time, kept monotonic so the time index stays sorted
+            timestamp = max(int(time.time() * 1000), self.last_timestamp)
+            INT64.pack_into(batch, 17, timestamp)
+            self._append(base_offset, record_count, timestamp, batch)
+
+        self._appended()
+        return base_offset
+
+    def append_replicated(self, data) -> int:
+        """
+        Append record batches fetched from this partition's leader as they
+        are, keeping the leader's offsets and timestamps. Batches the log
+        already has are skipped, and so is a batch cut off at the end of
+        data; the next fetch starts from the new log end. Returns the number
+        of records appended.
+        """
+        view = memoryview(data)
+        position = 0
+        appended = 0
+
+        with self.lock:
+            while len(view) - position >= BATCH_HEADER_SIZE:
+                batch_size, base_offset, record_count, _, timestamp = read_batch_header(view, position)
+                end = position + 4 + batch_size
+                if end > len(view) or base_offset > self.next_offset:
+                    break
+                if base_offset == self.next_offset:
+                    self._append(base_offset, record_count, timestamp, bytes(view[position:end]))
+                    appended += record_count
+                position = end
+
+        if appended:
+            self._appended()
+        return appended
+
+    def _append(self, base_offset: int, record_count: int, timestamp: int, batch: bytes):
+        """Write a batch at the log end, rolling first if needed. Caller holds the lock."""
+        self.last_timestamp = max(timestamp, self.last_timestamp)
+
+        if self.segments[-1].should_roll(len(batch)):
+            self._roll()
 
-            # Build the record bytes
-            writer = ByteWriter()
-            writer.write_int64(offset)
-            writer.write_string(key)
-            writer.write_bytes(value)
-            record_bytes = writer.to_bytes()
+        segment = self.segments[-1]
+        segment.append(base_offset, record_count, timestamp, batch)
+        self.cache.append(base_offset, record_count, batch)
+        self.next_offset = base_offset + record_count
+        if not self.replicated:
+            self.high_watermark = self.next_offset
 
-            with open(self.log_file, 'ab') as f:
-                file_position = f.tell()
-                f.write(len(record_bytes).to_bytes(4, byteorder='big'))
-                f.write(record_bytes)
+        self.bytes_appended += len(batch)
+        self.records_appended += record_count
 
-            # Update in-memory index
-            self.index[offset] = file_position
-            self.next_offset = offset + 1
+    def _appended(self):
+        """Wake listeners and apply the flush_messages policy after an append."""
+        for listener in list(self.listeners):
+            listener()
+
+        flush_messages = self.config["flush_messages"]
+        if flush_messages and self.next_offset - self.flushed_offset >= flush_messages:
+            self.flush()
+
+    def update_high_watermark(self, offset: int, replicated: bool = None):
+        """
+        Move the high watermark of a replicated partition forward (never past
+        the log end), waking fetches and acks=-1 produces waiting on it. If
+        replicated is given it is set in the same step; a partition that stops
+        being replicated has its high watermark follow the log end again.
+        """
+        with self.lock:
+            if replicated is not None:
+                self.replicated = replicated
+            if not self.replicated:
+                offset = self.next_offset
+            offset = min(offset, self.next_offset)
+            if offset <= self.high_watermark:
+                return
+            self.high_watermark = offset
+
+        for listener in list(self.listeners):
+            listener()
+
+    def truncate_to(self, offset: int):
+        """
+        Drop every record at or after offset (from the start of the batch
+        holding it), e.g. records a replica got from a leader it no longer
+        follows that the new leader may not have. The segment holding offset
+        becomes the active one again.
+        """
+        with self.lock:
+            if offset >= self.next_offset:
+                return
+
+            segments = self.segments
+            keep = [segment for segment in segments if segment.base_offset < offset] or segments[:1]
+            for segment in segments[len(keep):]:
+                segment.mark_deleted()
+                self.deleted_segments.append((time.time(), segment))
+
+            active = keep[-1]
+            if active is not segments[-1]:
+                active.close()
+                active = LogSegment(self.path, active.base_offset, self.config, active=True)
+            self.next_offset = active.truncate_to(offset)
+            self.segments = keep[:-1] + [active]
+
+            self.cache.clear()
+            self.high_watermark = min(self.high_watermark, self.next_offset)
+            self.flushed_offset = min(self.flushed_offset, self.next_offset)
+            self.recovery_point = (active.base_offset, active.size,
+                                   active.next_offset, active.last_batch_position)
+        print(f"  Truncated {self.topic}-{self.partition_id} to offset {self.next_offset}")
+
+    def flush(self, upto_offset: int = None):
+        """
+        fsync the log until every offset below upto_offset (default: everything
+        appended so far) is durable. Callers that queue up behind an in-progress
+        fsync usually find their records already covered by it.
+        """
+        with self.flush_lock:
+            if upto_offset is not None and self.flushed_offset >= upto_offset:
+                return
 
-            return offset
+            with self.lock:
+                target = self.next_offset
+                if self.flushed_offset >= target:
+                    return
+                # Rolled segments are synced when sealed, so only the active
+                # one can hold unflushed records. Dup the fd so a concurrent
+                # roll can close the segment while we sync.
+                active = self.segments[-1]
+                fd = os.dup(active.file.fileno())
+                recovery_point = (active.base_offset, active.size,
+                                  active.next_offset, active.last_batch_position)
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            self.flushed_offset = target
+            self.recovery_point = recovery_point
+            self.last_flush_time = time.time()
+
+    def maybe_flush(self):
+        """Apply the time-based flush policy. Called periodically by the broker."""
+        flush_ms = self.config["flush_ms"]
+        if flush_ms is None or self.flushed_offset >= self.next_offset:
+            return
+        if time.time() - self.last_flush_time >= flush_ms / 1000:
+            self.flush()
 
     def read(self, start_offset: int, max_records: int = 10) -> list:
         """
@@ -91,33 +534,127 @@ class Partition:
         """
         records = []
 
-        if not os.path.exists(self.log_file):
-            return records
+        if start_offset >= self.next_offset:
+            return records  # Nothing to read
 
-        with open(self.log_file, 'rb') as f:
-            # Use index to jump directly to the right position
-            if start_offset in self.index:
-                f.seek(self.index[start_offset])
-            elif start_offset >= self.next_offset:
-                return records  # Nothing to read
-            else:
-                return records  # Offset not found (maybe compacted)
+        batches = self.cache.read(start_offset, self.cache.max_bytes, start_offset + max_records)
+        if batches is not None:
+            for batch in batches:
+                records.extend(decode_batches(batch, start_offset))
+            return records[:max_records]
 
-            for _ in range(max_records):
-                size_bytes = f.read(4)
-                if len(size_bytes) < 4:
-                    break
+        for segment in self._segments_from(start_offset):
+            records.extend(segment.read(start_offset, max_records - len(records)))
+            if len(records) >= max_records:
+                break
+
+        return records
+
+    def read_region(self, start_offset: int, max_bytes: int, end_offset: int = None):
+        """
+        The on-disk bytes of records from start_offset, up to max_bytes and
+        stopping before the batch at end_offset (a batch boundary such as the
+        high watermark). Recent batches come from the tail cache as bytes;
+        older ones as a FileRegion for zero-copy sending. Returns None if
+        there is nothing to read.
+        """
+        with self.lock:
+            end_offset = self.next_offset if end_offset is None else min(end_offset, self.next_offset)
+            if start_offset >= end_offset:
+                return None
+
+            batches = self.cache.read(start_offset, max_bytes, end_offset)
+            if batches is not None:
+                data = batches[0] if len(batches) == 1 else b''.join(batches)
+                self.bytes_read += len(data)
+                return data
+
+            for segment in self._segments_from(start_offset):
+                region = segment.read_region(start_offset, max_bytes)
+                if region is not None:
+                    if end_offset < self.next_offset:
+                        end_position, _ = segment.find_position(end_offset)
+                        region.count = min(region.count, end_position - region.offset)
+                    self.bytes_read += region.count
+                    return region
+
+        return None
+
+    def offset_for_timestamp(self, timestamp: int) -> int:
+        """
+        The first offset appended at or after timestamp (ms), or the log end
+        offset if every record is older. Segments are ordered by time, so this
+        is a search over segments, then over one segment's time index.
+        """
+        segments = self.segments
+        # The active segment may still be empty, so only sealed ones are bisected
+        i = bisect.bisect_left(segments, timestamp, hi=len(segments) - 1, key=attrgetter("max_timestamp"))
+        for segment in segments[i:]:
+            offset = segment.offset_for_timestamp(timestamp)
+            if offset is not None:
+                return offset
+        return self.next_offset
+
+    def bytes_available(self, start_offset: int, limit: int) -> int:
+        """Bytes of log from start_offset to the end, counting no further than limit."""
+        with self.lock:
+            if start_offset >= self.next_offset:
+                return 0
 
-                record_size = int.from_bytes(size_bytes, byteorder='big')
-                record_data = f.read(record_size)
-                if len(record_data) < record_size:
+            cached = self.cache.bytes_from(start_offset)
+            if cached is not None:
+                return cached
+
+            available = 0
+            for segment in self._segments_from(start_offset):
+                if available == 0:
+                    position, _ = segment.find_position(start_offset)
+                    available += segment.size - position
+                else:
+                    available += segment.size
+                if available >= limit:
                     break
 
-                buf = ByteBuffer(record_data)
-                offset = buf.read_int64()
-                key = buf.read_string()
-                value = buf.read_bytes()
+        return available
+
+    def close(self):
+        self.flush()
+        self.checkpoint()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            for _, segment in self.deleted_segments:
+                segment.delete()
+            self.deleted_segments = []
 
-                records.append((offset, key, value))
 
-        return records
+class LazyPartitions:
+    """
+    The partitions of one topic, each opened (and recovered) the first time
+    it is used, so a broker with many partitions starts without touching
+    their logs. Indexes like a list of Partition.
+    """
+
+    def __init__(self, log_dir: str, topic: str, num_partitions: int, config: dict = None):
+        self.log_dir = log_dir
+        self.topic = topic
+        self.config = config
+        self.partitions = [None] * num_partitions
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.partitions)
+
+    def __getitem__(self, partition_id: int) -> Partition:
+        partition = self.partitions[partition_id]
+        if partition is None:
+            with self.lock:
+                partition = self.partitions[partition_id]
+                if partition is None:
+                    partition = Partition(self.log_dir, self.topic, partition_id, self.config)
+                    self.partitions[partition_id] = partition
+        return partition
+
+    def loaded(self) -> list:
+        """Partitions opened so far."""
+        return [partition for partition in self.partitions if partition is not None]
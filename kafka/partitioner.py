@@ -0,0 +1,41 @@
+def murmur2(data: bytes) -> int:
+    """
+    32-bit murmur2 hash, bit-for-bit the same as Kafka's Java client, so a key
+    maps to the same partition in every process and across restarts
+    (unlike Python's per-process randomized hash()).
+    """
+    length = len(data)
+    seed = 0x9747b28c
+    m = 0x5bd1e995
+    r = 24
+
+    h = (seed ^ length) & 0xffffffff
+
+    for i in range(0, length - length % 4, 4):
+        k = int.from_bytes(data[i:i + 4], byteorder='little')
+        k = (k * m) & 0xffffffff
+        k ^= k >> r
+        k = (k * m) & 0xffffffff
+        h = (h * m) & 0xffffffff
+        h ^= k
+
+    tail = length % 4
+    base = length - tail
+    if tail == 3:
+        h ^= data[base + 2] << 16
+    if tail >= 2:
+        h ^= data[base + 1] << 8
+    if tail >= 1:
+        h ^= data[base]
+        h = (h * m) & 0xffffffff
+
+    h ^= h >> 13
+    h = (h * m) & 0xffffffff
+    h ^= h >> 15
+
+    return h
+
+
+def default_partitioner(key: str, num_partitions: int) -> int:
+    """Pick a partition for a key. Any callable with this signature can replace it."""
+    return (murmur2(key.encode('utf-8')) & 0x7fffffff) % num_partitions
@@ -1,24 +1,64 @@
 import socket
 import threading
+import time
+from concurrent.futures import Future, wait
 from protocol import (
     ByteBuffer, ByteWriter,
-    recv_framed, send_framed,
-    API_PRODUCE, API_CREATE_TOPIC,
+    recv_framed, send_framed, encode_records, INT32,
+    API_PRODUCE, API_PRODUCE_BATCH, API_CREATE_TOPIC, API_METADATA,
     ERR_NONE,
 )
+from client import ClusterMetadata, RETRY_BACKOFF, RETRIABLE_ERRORS
+from compression import get_codec
+from partitioner import default_partitioner
+
+
+def encode_utf8(value: str) -> bytes:
+    return value.encode('utf-8')
+
+
+def record_size(key: str, value: bytes) -> int:
+    """The bytes a record takes in a batch, as counted against buffer_memory."""
+    return 2 + len(key.encode('utf-8')) + 4 + len(value)
 
 
 class Producer:
-    def __init__(self, host='localhost', port=9092, client_id='producer-1'):
+    def __init__(self, host='localhost', port=9092, client_id='producer-1', acks=1,
+                 compression='none', partitioner=default_partitioner, retry_timeout_ms=30000,
+                 value_serializer=encode_utf8):
+        """
+        acks controls how durable a send is before the broker answers:
+            0  = don't wait for the broker at all
+            1  = written to the partition leader's log
+            -1 = fsynced to disk, and in a cluster copied by the in-sync replicas
+        compression names the codec batches are compressed with before sending
+        (see compression.py); the broker stores them compressed.
+        partitioner(key, num_partitions) picks each record's partition on the
+        client, using partition counts from the broker's metadata.
+        value_serializer turns each value passed to send() into bytes, e.g.
+        an event schema's encode (see schema.py); by default values are
+        strings sent as utf-8.
+        host and port are any broker of the cluster; records go straight to
+        their partition's leader. Sends that fail because leadership moved
+        or a broker went down are retried on fresh metadata for up to
+        retry_timeout_ms.
+        """
         self.host = host
         self.port = port
         self.client_id = client_id
+        self.acks = acks
+        self.codec = get_codec(compression)
+        self.partitioner = partitioner
+        self.value_serializer = value_serializer
+        self.retry_timeout = retry_timeout_ms / 1000
+        self.metadata = {}  # topic -> number of partitions
         self.correlation_id = 0
         self.lock = threading.Lock()
 
-        # Connect to broker
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
+        # Brokers and partition leaders, with a connection per broker
+        self.cluster = ClusterMetadata(host, port)
+        if not self.refresh_metadata([]):
+            raise ConnectionError(f"No broker reachable at {host}:{port}")
 
     def _next_correlation_id(self) -> int:
         with self.lock:
@@ -34,38 +74,73 @@ class Producer:
         writer.write_string(self.client_id)
         return writer
 
-    def create_topic(self, topic: str, num_partitions: int):
-        """Ask the broker to create a topic."""
+    def _request(self, writer: ByteWriter, route, topics: list) -> ByteBuffer:
+        """Send a request to the broker route() names, retrying on fresh metadata for topics."""
+        return self.cluster.request(writer.buffer(), route, lambda: self.refresh_metadata(topics),
+                                    self.retry_timeout)
+
+    def create_topic(self, topic: str, num_partitions: int, config: dict = None):
+        """Ask the controller to create a topic, optionally overriding its partition config."""
+        config = config or {}
         writer = self._build_header(API_CREATE_TOPIC)
         writer.write_string(topic)
         writer.write_int32(num_partitions)
+        writer.write_int32(len(config))
+        for name, value in config.items():
+            writer.write_string(name)
+            writer.write_string(str(value))
 
-        send_framed(self.sock, writer.to_bytes())
-
-        # Read response
-        response = recv_framed(self.sock)
-        buf = ByteBuffer(response)
-        correlation_id = buf.read_int32()
+        buf = self._request(writer, lambda: self.cluster.controller, [])
         error_code = buf.read_int16()
 
         if error_code == ERR_NONE:
-            pass
+            self.refresh_metadata([topic])
+            self.metadata.setdefault(topic, num_partitions)
         else:
             print(f"Failed to create topic: error {error_code}")
 
+    def refresh_metadata(self, topics: list) -> bool:
+        """
+        Fetch brokers, partition counts and leaders for the given topics (all
+        of them when empty). Returns False if no broker answered.
+        """
+        if not self.cluster.refresh(self._build_header(API_METADATA), topics):
+            return False
+        for topic, leaders in self.cluster.leaders.items():
+            self.metadata[topic] = len(leaders)
+        return True
+
+    def partition_for(self, topic: str, key: str) -> int:
+        """
+        The partition a key belongs to. Returns -1 for topics the broker
+        doesn't know, which it will then reject.
+        """
+        if topic not in self.metadata:
+            self.refresh_metadata([topic])
+        if topic not in self.metadata:
+            return -1
+        return self.partitioner(key, self.metadata[topic])
+
     def send(self, topic: str, key: str, value: str):
-        """Send a message to the broker."""
+        """Send a message to its partition's leader."""
+        partition = self.partition_for(topic, key)
         writer = self._build_header(API_PRODUCE)
+        writer.write_int16(self.acks)
         writer.write_string(topic)
+        writer.write_int32(partition)
         writer.write_string(key)
-        writer.write_bytes(value.encode('utf-8'))
+        writer.write_bytes(self.value_serializer(value))
 
-        send_framed(self.sock, writer.to_bytes())
+        if self.acks == 0:
+            leader = self.cluster.leader(topic, partition)
+            try:
+                self.cluster.connection(leader).send(writer.buffer())
+            except OSError as e:
+                self.cluster.drop(leader)
+                print(f"Failed to send: {e}")
+            return
 
-        # Read response
-        response = recv_framed(self.sock)
-        buf = ByteBuffer(response)
-        correlation_id = buf.read_int32()
+        buf = self._request(writer, lambda: self.cluster.leader(topic, partition), [topic])
         error_code = buf.read_int16()
         partition = buf.read_int32()
         offset = buf.read_int64()
@@ -75,10 +150,422 @@ class Producer:
         else:
             print(f"Failed to send: error {error_code}")
 
+    def _write_batches(self, writer: ByteWriter, batches: dict):
+        """
+        Write PRODUCE_BATCH entries for {(topic, partition): [(key, value bytes)]},
+        grouped by topic. Returns the (topic, partition) keys in the order the
+        broker will answer them.
+        """
+        by_topic = {}
+        for topic, partition in batches:
+            by_topic.setdefault(topic, []).append(partition)
+
+        order = []
+        writer.write_int16(self.acks)
+        writer.write_int32(len(by_topic))
+        for topic, partitions in by_topic.items():
+            writer.write_string(topic)
+            writer.write_int32(len(partitions))
+            for partition in partitions:
+                records = batches[(topic, partition)]
+                writer.write_int32(partition)
+                writer.write_int8(self.codec.id)
+                writer.write_int32(len(records))
+                writer.write_bytes(self.codec.compress(encode_records(records)))
+                order.append((topic, partition))
+
+        return order
+
+    def _by_leader(self, targets) -> dict:
+        """Group (topic, partition) targets by partition leader: {leader: [target]}."""
+        leaders = {}
+        for target in targets:
+            leaders.setdefault(self.cluster.leader(*target), []).append(target)
+        return leaders
+
+    def send_batch(self, records: list) -> list:
+        """
+        Send many messages with one request per partition leader.
+
+        records is a list of (topic, key, value) tuples. They are grouped into
+        one batch per partition, each appended by the broker with a single
+        write. The requests to all leaders are sent before any response is
+        read. Returns a list of (partition, offset) per record in the same
+        order, or None if acks == 0.
+        """
+        targets = [(topic, self.partition_for(topic, key)) for topic, key, _ in records]
+
+        batches = {}
+        for target, (_, key, value) in zip(targets, records):
+            batches.setdefault(target, []).append((key, self.value_serializer(value)))
+
+        results = {}
+        deadline = time.monotonic() + self.retry_timeout
+        while True:
+            sent = []
+            for leader, leader_targets in self._by_leader(batches).items():
+                writer = self._build_header(API_PRODUCE_BATCH)
+                order = self._write_batches(writer, {target: batches[target] for target in leader_targets})
+                try:
+                    connection = self.cluster.connection(leader)
+                    connection.send(writer.buffer())
+                    sent.append((leader, connection, order))
+                except OSError:
+                    self.cluster.drop(leader)
+
+            if self.acks == 0:
+                return None
+
+            for leader, connection, order in sent:
+                try:
+                    buf = connection.receive()
+                except OSError:
+                    self.cluster.drop(leader)
+                    continue
+
+                num_entries = buf.read_int32()
+                for topic, partition in order:
+                    error_code = buf.read_int16()
+                    offsets = [(buf.read_int32(), buf.read_int64()) for _ in range(buf.read_int32())]
+                    if error_code in RETRIABLE_ERRORS:
+                        continue
+                    if error_code != ERR_NONE:
+                        print(f"Failed to send batch to '{topic}' partition {partition}: error {error_code}")
+                    results[(topic, partition)] = iter(offsets)
+                    del batches[(topic, partition)]
+
+            if not batches or time.monotonic() >= deadline:
+                break
+            time.sleep(RETRY_BACKOFF)
+            self.refresh_metadata(sorted({topic for topic, _ in batches}))
+
+        for topic, partition in batches:
+            print(f"Failed to send batch to '{topic}' partition {partition}: no leader reachable")
+        return [next(results[target], None) if target in results else None for target in targets]
+
+    def close(self):
+        self.cluster.close()
+
+
+
+class Pipeline:
+    """
+    An AsyncProducer's connection to one broker, with up to max_in_flight
+    requests outstanding. A receiver thread matches each response to its
+    request by correlation_id. When the connection breaks, every
+    outstanding request's callback gets None instead of a response.
+    """
+
+    def __init__(self, host: str, port: int, max_in_flight: int):
+        self.sock = socket.create_connection((host, port))
+        self.in_flight = {}  # correlation_id -> callback(response ByteBuffer, or None)
+        self.slots = threading.Semaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.broken = False
+
+        self.receiver = threading.Thread(target=self._run_receiver, daemon=True)
+        self.receiver.start()
+
+    def send(self, writer: ByteWriter, callback=None):
+        """
+        Send a request, waiting for a free in-flight slot first. Without a
+        callback no response is expected (acks=0). Raises ConnectionError
+        if the request could not be sent and its callback won't be called.
+        """
+        correlation_id, = INT32.unpack_from(writer.data, 4)
+        if callback is not None:
+            self.slots.acquire()
+        with self.lock:
+            if self.broken:
+                raise ConnectionError("Connection to broker lost")
+            if callback is not None:
+                self.in_flight[correlation_id] = callback
+
+        try:
+            send_framed(self.sock, writer.buffer())
+        except OSError:
+            with self.lock:
+                # Unless the receiver already handed the callback its None
+                failed_here = callback is None or self.in_flight.pop(correlation_id, None) is not None
+            if failed_here:
+                raise
+
+    def _run_receiver(self):
+        try:
+            while True:
+                response = recv_framed(self.sock)
+                buf = ByteBuffer(response)
+                correlation_id = buf.read_int32()
+
+                with self.lock:
+                    callback = self.in_flight.pop(correlation_id, None)
+                if callback is None:
+                    raise ConnectionError(f"Unexpected correlation id {correlation_id}")
+
+                callback(buf)
+                self.slots.release()
+        except OSError:
+            with self.lock:
+                self.broken = True
+                callbacks = list(self.in_flight.values())
+                self.in_flight.clear()
+            for callback in callbacks:
+                callback(None)
+                self.slots.release()
+
     def close(self):
         self.sock.close()
 
 
+class AsyncProducer(Producer):
+    """
+    A pipelined producer. send() only queues the record and returns a Future
+    that resolves to (partition, offset) once the broker acks it.
+
+    Records are accumulated per topic-partition until a batch reaches
+    batch_size bytes or has waited linger_ms, then sent by a background
+    sender thread as one PRODUCE_BATCH request per partition leader. Each
+    leader gets a Pipeline with up to max_in_flight requests outstanding.
+    Batches whose leader moved or couldn't be reached are queued again and
+    sent on fresh metadata; each record is retried until retry_timeout_ms
+    after it was sent.
+    Queued records may use at most buffer_memory bytes; beyond that send()
+    blocks for up to max_block_ms.
+    """
+
+    def __init__(self, host='localhost', port=9092, client_id='producer-1', acks=1,
+                 compression='none', partitioner=default_partitioner, batch_size=16384,
+                 linger_ms=5, buffer_memory=32 * 1024 * 1024, max_in_flight=5,
+                 max_block_ms=60000, retry_timeout_ms=30000, value_serializer=encode_utf8):
+        super().__init__(host, port, client_id, acks, compression, partitioner, retry_timeout_ms,
+                         value_serializer)
+        self.batch_size = batch_size
+        self.linger_ms = linger_ms
+        self.buffer_memory = buffer_memory
+        self.max_block_ms = max_block_ms
+
+        # Accumulator: (topic, partition) -> {"records": [(key, value, future, deadline)], "bytes": n,
+        #                                     "created": t, "retry_at": t}
+        self.cond = threading.Condition()
+        self.batches = {}
+        self.buffered_bytes = 0
+        self.incomplete = set()
+        self.flushing = 0
+        self.closed = False
+        self.metadata_stale = False
+
+        # One pipelined connection per leader: broker_id -> Pipeline
+        self.max_in_flight = max_in_flight
+        self.pipelines = {}
+
+        self.sender = threading.Thread(target=self._run_sender, daemon=True)
+        self.sender.start()
+
+    # ──────────────────────────────────────────────
+    # Public API
+    # ──────────────────────────────────────────────
+
+    def send(self, topic: str, key: str, value: str) -> Future:
+        """Queue a message. Returns a Future of (partition, offset)."""
+        value = self.value_serializer(value)
+        size = record_size(key, value)
+        future = Future()
+        deadline = time.monotonic() + self.max_block_ms / 1000
+        target = (topic, self.partition_for(topic, key))
+
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("Producer is closed")
+
+            # Backpressure: wait for acks to free buffer memory
+            while self.buffered_bytes > 0 and self.buffered_bytes + size > self.buffer_memory:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No buffer memory after {self.max_block_ms} ms")
+                self.cond.wait(remaining)
+
+            now = time.monotonic()
+            batch = self.batches.get(target)
+            new_batch = batch is None
+            if new_batch:
+                batch = self.batches[target] = {"records": [], "bytes": 0, "created": now, "retry_at": 0.0}
+
+            batch["records"].append((key, value, future, now + self.retry_timeout))
+            batch["bytes"] += size
+            self.buffered_bytes += size
+            self.incomplete.add(future)
+
+            # A new batch gives the sender a linger deadline to wait for
+            if new_batch or batch["bytes"] >= self.batch_size:
+                self.cond.notify_all()
+
+        return future
+
+    def send_batch(self, records: list) -> list:
+        """Queue a list of (topic, key, value) tuples. Returns their Futures."""
+        return [self.send(topic, key, value) for topic, key, value in records]
+
+    def flush(self):
+        """Send everything queued so far and wait until it is acknowledged."""
+        with self.cond:
+            pending = list(self.incomplete)
+            self.flushing += 1
+            self.cond.notify_all()
+
+        try:
+            wait(pending)
+        finally:
+            with self.cond:
+                self.flushing -= 1
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.sender.join()
+        for pipeline in self.pipelines.values():
+            pipeline.close()
+        self.cluster.close()
+
+    # ──────────────────────────────────────────────
+    # Sender thread
+    # ──────────────────────────────────────────────
+
+    def _send_time(self, batch: dict) -> float:
+        """When a batch is due: once it has lingered, and not before a retry's backoff ends."""
+        return max(batch["created"] + self.linger_ms / 1000, batch["retry_at"])
+
+    def _ready_batches(self, now: float) -> list:
+        return [
+            target for target, batch in self.batches.items()
+            if now >= batch["retry_at"] and (
+                self.flushing or self.closed
+                or batch["bytes"] >= self.batch_size
+                or now >= self._send_time(batch))
+        ]
+
+    def _run_sender(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    ready = self._ready_batches(now)
+                    if ready:
+                        break
+                    if self.closed:
+                        return
+
+                    # Sleep until the next batch is due
+                    timeout = None
+                    if self.batches:
+                        timeout = max(0.0, min(map(self._send_time, self.batches.values())) - now)
+                    self.cond.wait(timeout)
+
+                drained = {target: self.batches.pop(target) for target in ready}
+
+            self._send_batches(drained)
+
+    def _pipeline(self, broker_id: int) -> Pipeline:
+        pipeline = self.pipelines.get(broker_id)
+        if pipeline is None or pipeline.broken:
+            if pipeline is not None:
+                pipeline.close()
+            address = self.cluster.brokers.get(broker_id)
+            if address is None:
+                raise ConnectionError(f"No known broker {broker_id}")
+            pipeline = self.pipelines[broker_id] = Pipeline(*address, self.max_in_flight)
+        return pipeline
+
+    def _send_batches(self, drained: dict):
+        """Send drained batches for any number of topic-partitions as one PRODUCE_BATCH per leader."""
+        if self.metadata_stale:
+            self.metadata_stale = False
+            self.refresh_metadata(sorted({topic for topic, _ in drained}))
+
+        for leader, targets in self._by_leader(drained).items():
+            leader_drained = {target: drained[target] for target in targets}
+            writer = self._build_header(API_PRODUCE_BATCH)
+            batches = {target: [(key, value) for key, value, _, _ in batch["records"]]
+                       for target, batch in leader_drained.items()}
+            order = self._write_batches(writer, batches)
+
+            try:
+                pipeline = self._pipeline(leader)
+                if self.acks == 0:
+                    pipeline.send(writer)
+                    for batch in leader_drained.values():
+                        self._complete(batch, [(None, None)] * len(batch["records"]))
+                else:
+                    pipeline.send(writer, lambda buf, leader_drained=leader_drained, order=order:
+                                  self._handle_produce_response(leader_drained, order, buf))
+            except OSError as e:
+                for target, batch in leader_drained.items():
+                    self._retry(target, batch, e)
+
+    def _handle_produce_response(self, drained: dict, order: list, buf: ByteBuffer):
+        """Resolve or requeue the batches of one PRODUCE_BATCH. buf is None if the connection broke."""
+        if buf is None:
+            for target, batch in drained.items():
+                self._retry(target, batch, ConnectionError("Connection to broker lost"))
+            return
+
+        num_entries = buf.read_int32()
+        for topic, partition in order:
+            batch = drained[(topic, partition)]
+            error_code = buf.read_int16()
+            results = [(buf.read_int32(), buf.read_int64()) for _ in range(buf.read_int32())]
+            if error_code in RETRIABLE_ERRORS:
+                error = RuntimeError(f"Produce to '{topic}' partition {partition} failed: error {error_code}")
+                self._retry((topic, partition), batch, error)
+            elif error_code != ERR_NONE:
+                error = RuntimeError(f"Produce to '{topic}' partition {partition} failed: error {error_code}")
+                self._complete(batch, None, error)
+            else:
+                self._complete(batch, results)
+
+    def _retry(self, target: tuple, batch: dict, error: Exception):
+        """
+        Queue a batch again, ahead of anything queued for its partition
+        since, to be sent after RETRY_BACKOFF on fresh metadata. Records
+        whose retry deadline has passed fail with error instead. Queued
+        records keep their own deadlines when the batch takes them in.
+        """
+        now = time.monotonic()
+        expired = [record for record in batch["records"] if now >= record[3]]
+        if expired:
+            expired_bytes = sum(record_size(key, value) for key, value, _, _ in expired)
+            self._complete({"records": expired, "bytes": expired_bytes}, None, error)
+            batch["records"] = [record for record in batch["records"] if now < record[3]]
+            batch["bytes"] -= expired_bytes
+            if not batch["records"]:
+                return
+
+        with self.cond:
+            self.metadata_stale = True
+            queued = self.batches.get(target)
+            if queued is not None:
+                batch["records"] += queued["records"]
+                batch["bytes"] += queued["bytes"]
+            batch["retry_at"] = now + RETRY_BACKOFF
+            self.batches[target] = batch
+            self.cond.notify_all()
+
+    def _complete(self, batch: dict, results: list, error: Exception = None):
+        """Resolve a batch's futures and release its buffer memory."""
+        for i, (_, _, future, _) in enumerate(batch["records"]):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[i])
+
+        with self.cond:
+            self.buffered_bytes -= batch["bytes"]
+            for _, _, future, _ in batch["records"]:
+                self.incomplete.discard(future)
+            self.cond.notify_all()
+
+
 if __name__ == '__main__':
     producer = Producer()
 
@@ -1,61 +1,149 @@
+import os
+import struct
+from compression import CODEC_NONE, get_codec
+
+
 # API Keys - what type of request is this
 API_PRODUCE = 0
 API_FETCH = 1
 API_JOIN_GROUP = 2
 API_CREATE_TOPIC = 3
+API_PRODUCE_BATCH = 4
+API_METADATA = 5
+API_OFFSET_COMMIT = 6
+API_OFFSET_FETCH = 7
+API_LIST_OFFSETS = 8
+API_HEARTBEAT = 9
+API_LEAVE_GROUP = 10
+API_BROKER_HEARTBEAT = 11  # broker to controller (see cluster.py)
+API_ALTER_ISR = 12         # partition leader to controller
+API_METRICS = 13           # admin: the broker's metrics as plaintext (see metrics.py)
+
+# Names of the API keys, as used in metrics labels
+API_NAMES = {
+    API_PRODUCE: "produce",
+    API_FETCH: "fetch",
+    API_JOIN_GROUP: "join_group",
+    API_CREATE_TOPIC: "create_topic",
+    API_PRODUCE_BATCH: "produce_batch",
+    API_METADATA: "metadata",
+    API_OFFSET_COMMIT: "offset_commit",
+    API_OFFSET_FETCH: "offset_fetch",
+    API_LIST_OFFSETS: "list_offsets",
+    API_HEARTBEAT: "heartbeat",
+    API_LEAVE_GROUP: "leave_group",
+    API_BROKER_HEARTBEAT: "broker_heartbeat",
+    API_ALTER_ISR: "alter_isr",
+    API_METRICS: "metrics",
+}
 
 # Error codes
 ERR_NONE = 0
 ERR_UNKNOWN_TOPIC = 1
 ERR_UNKNOWN_PARTITION = 2
 ERR_NO_GROUP = 3
+ERR_UNSUPPORTED_CODEC = 4
+ERR_UNKNOWN_MEMBER = 5       # not (or no longer) in the group: join again
+ERR_ILLEGAL_GENERATION = 6   # the group rebalanced since: join again
+ERR_INCONSISTENT_ASSIGNOR = 7
+ERR_REBALANCE_IN_PROGRESS = 8  # commit what you have, then join again
+ERR_NOT_LEADER = 9            # this broker doesn't lead the partition: refresh metadata
+ERR_OFFSET_OUT_OF_RANGE = 10  # a replica fetched past the leader's log end
+ERR_NOT_ENOUGH_REPLICAS = 11  # acks=-1 could not be met by the in-sync replicas
+ERR_NOT_COORDINATOR = 12      # group requests go to the controller: refresh metadata
+ERR_INVALID_CONFIG = 13       # a topic config is unknown or its value has the wrong type
+ERR_INTERNAL_TOPIC = 14       # internal topics, like the offsets log, are written by brokers alone
+
+# Special timestamps for LIST_OFFSETS
+LATEST_TIMESTAMP = -1    # the log end offset
+EARLIEST_TIMESTAMP = -2  # the log start offset
+
+
+# Precompiled big-endian field codecs
+INT8 = struct.Struct('>B')
+INT16 = struct.Struct('>h')
+INT32 = struct.Struct('>i')
+INT64 = struct.Struct('>q')
+FRAME_SIZE = struct.Struct('>I')
+
+# Length prefixes are unsigned: strings up to 65535 bytes, bytes up to 4 GiB.
+# Only fields that may be -1 (acks, partitions, offsets) need the signed codecs.
+STRING_LENGTH = struct.Struct('>H')
+BYTES_LENGTH = struct.Struct('>I')
+
+# Most buffers one sendmsg call may take (IOV_MAX is 1024 on Linux)
+SENDMSG_MAX_BUFFERS = 1024
+
+# Messages up to this size are copied into one buffer rather than scatter-written
+COALESCE_BYTES = 16 * 1024
 
 
 class ByteBuffer:
-    """Reads fields from a byte buffer, tracking position automatically."""
+    """
+    Reads fields from a byte buffer, tracking position automatically.
 
-    def __init__(self, data: bytes):
+    data may be bytes, a bytearray or a memoryview. Fixed-size fields are
+    unpacked in place with struct; read_view returns a zero-copy slice for
+    large payloads, valid as long as the underlying buffer is.
+    """
+
+    def __init__(self, data):
         self.data = data
+        self.view = memoryview(data)
         self.position = 0
 
     def read_int8(self) -> int:
-        value = self.data[self.position]
+        value = self.view[self.position]
         self.position += 1
         return value
 
     def read_int16(self) -> int:
-        value = int.from_bytes(self.data[self.position:self.position + 2], byteorder='big')
+        value, = INT16.unpack_from(self.data, self.position)
         self.position += 2
         return value
 
     def read_int32(self) -> int:
-        value = int.from_bytes(self.data[self.position:self.position + 4], byteorder='big')
+        value, = INT32.unpack_from(self.data, self.position)
         self.position += 4
         return value
 
     def read_int64(self) -> int:
-        value = int.from_bytes(self.data[self.position:self.position + 8], byteorder='big')
+        value, = INT64.unpack_from(self.data, self.position)
         self.position += 8
         return value
 
     def read_string(self) -> str:
-        length = self.read_int16()
-        value = self.data[self.position:self.position + length].decode('utf-8')
+        length, = STRING_LENGTH.unpack_from(self.data, self.position)
+        self.position += 2
+        value = self.view[self.position:self.position + length].tobytes().decode('utf-8')
         self.position += length
         return value
 
     def read_bytes(self) -> bytes:
-        length = self.read_int32()
-        value = self.data[self.position:self.position + length]
+        """A length-prefixed value, copied out so it outlives the buffer."""
+        return bytes(self.read_view())
+
+    def read_view(self) -> memoryview:
+        """A length-prefixed value as a zero-copy view into the buffer."""
+        length, = BYTES_LENGTH.unpack_from(self.data, self.position)
+        self.position += 4
+        value = self.view[self.position:self.position + length]
         self.position += length
         return value
 
-    def remaining(self) -> bytes:
-        return self.data[self.position:]
+    def remaining(self) -> memoryview:
+        return self.view[self.position:]
 
 
 class ByteWriter:
-    """Builds a byte buffer by appending fields."""
+    """
+    Builds a byte buffer by appending fields.
+
+    to_bytes() returns a copy. buffer() hands out the underlying bytearray
+    instead, for requests and responses sent as soon as they are built:
+    the writer must not be written to, nor the buffer changed, while it is
+    in use.
+    """
 
     def __init__(self):
         self.data = bytearray()
@@ -65,55 +153,321 @@ class ByteWriter:
         return self
 
     def write_int16(self, value: int):
-        self.data.extend(value.to_bytes(2, byteorder='big'))
+        self.data += INT16.pack(value)
         return self
 
     def write_int32(self, value: int):
-        self.data.extend(value.to_bytes(4, byteorder='big'))
+        self.data += INT32.pack(value)
         return self
 
     def write_int64(self, value: int):
-        self.data.extend(value.to_bytes(8, byteorder='big'))
+        self.data += INT64.pack(value)
         return self
 
     def write_string(self, value: str):
         encoded = value.encode('utf-8')
-        self.write_int16(len(encoded))
-        self.data.extend(encoded)
+        self.data += STRING_LENGTH.pack(len(encoded))
+        self.data += encoded
         return self
 
     def write_bytes(self, value: bytes):
-        self.write_int32(len(value))
-        self.data.extend(value)
+        self.data += BYTES_LENGTH.pack(len(value))
+        self.data += value
         return self
 
     def to_bytes(self) -> bytes:
         return bytes(self.data)
 
+    def buffer(self) -> bytearray:
+        return self.data
+
+
+def read_request_header(buf: ByteBuffer):
+    """
+    Request header:
+        [api_key: 2][api_version: 2][correlation_id: 4][client_id: string]
+    """
+    api_key = buf.read_int16()
+    api_version = buf.read_int16()
+    correlation_id = buf.read_int32()
+    client_id = buf.read_string()
+    return api_key, api_version, correlation_id, client_id
+
+
+def build_response(correlation_id: int, response_body) -> list:
+    """
+    Prefix a handler's response body with the correlation id.
+    Returns a list of parts (bytes or FileRegion), or None if the request
+    expects no response.
+    """
+    if response_body is None:
+        return None  # fire-and-forget request, nothing to send back
+
+    header = ByteWriter().write_int32(correlation_id).to_bytes()
+    if isinstance(response_body, list):
+        return [header] + response_body
+    return [header, response_body]
+
+
+# A record batch, laid out identically on disk and in FETCH responses:
+#     [batch_size: 4][base_offset: 8][record_count: 4][codec: 1][timestamp: 8][records]
+# batch_size counts the bytes after itself. records is the codec-compressed
+# form of record_count x [key: string][value: bytes]; record i has offset
+# base_offset + i. timestamp is the broker's append time in ms, shared by
+# every record in the batch and never decreasing along a partition.
+BATCH_HEADER = struct.Struct('>iqiBq')
+BATCH_HEADER_SIZE = BATCH_HEADER.size
+
+
+def encode_records(records: list) -> bytes:
+    """Serialize (key, value) records into an uncompressed batch payload."""
+    writer = ByteWriter()
+    for key, value in records:
+        writer.write_string(key)
+        writer.write_bytes(value)
+    return writer.buffer()
+
+
+def decode_records(payload: bytes, record_count: int) -> list:
+    """Parse an uncompressed batch payload into (key, value) records."""
+    buf = ByteBuffer(payload)
+    return [(buf.read_string(), buf.read_bytes()) for _ in range(record_count)]
+
+
+def build_batch(base_offset: int, record_count: int, codec: int, payload: bytes,
+                timestamp: int = 0) -> bytearray:
+    """Frame an already encoded (and possibly compressed) payload as a batch."""
+    batch = bytearray(BATCH_HEADER.pack(BATCH_HEADER_SIZE - 4 + len(payload),
+                                        base_offset, record_count, codec, timestamp))
+    batch += payload
+    return batch
+
+
+def encode_batch(base_offset: int, records: list, codec: int = CODEC_NONE) -> bytearray:
+    """Serialize and compress (key, value) records into one batch."""
+    payload = get_codec(codec).compress(encode_records(records))
+    return build_batch(base_offset, len(records), codec, payload)
+
+
+def read_batch_header(data, position: int = 0):
+    """Returns (batch_size, base_offset, record_count, codec, timestamp) of the batch at position."""
+    return BATCH_HEADER.unpack_from(data, position)
+
+
+def decode_batches(data: bytes, min_offset: int = 0) -> list:
+    """
+    Parse a run of record batches, decompressing each one. A truncated batch
+    at the end is ignored, as are records below min_offset (a fetch returns
+    the whole batch containing its start offset).
+    Returns (offset, key, value) tuples.
+    """
+    records = []
+    position = 0
+    view = memoryview(data)
+
+    while len(data) - position >= BATCH_HEADER_SIZE:
+        batch_size, base_offset, record_count, codec, _ = BATCH_HEADER.unpack_from(data, position)
+        end = position + 4 + batch_size
+        if end > len(data):
+            break
+
+        payload = get_codec(codec).decompress(view[position + BATCH_HEADER_SIZE:end])
+        for i, (key, value) in enumerate(decode_records(payload, record_count)):
+            if base_offset + i >= min_offset:
+                records.append((base_offset + i, key, value))
+        position = end
+
+    return records
+
+
+class FileRegion:
+    """
+    A byte range of an open file that goes into a response as-is. The
+    network layer streams it to the socket with os.sendfile, so the bytes
+    never pass through Python. Owns fd and closes it once sent.
+    """
+
+    def __init__(self, fd: int, offset: int, count: int):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def read(self) -> bytes:
+        """Copy the region into memory, for transports that can't sendfile."""
+        return os.pread(self.fd, self.count, self.offset)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
 
 def frame_message(data: bytes) -> bytes:
     """Wrap data with a 4-byte length prefix for TCP framing."""
-    return len(data).to_bytes(4, byteorder='big') + data
+    return FRAME_SIZE.pack(len(data)) + data
 
 
-def recv_exact(sock, num_bytes: int) -> bytes:
-    """Read exactly num_bytes from socket, looping if TCP splits the data."""
-    data = b''
-    while len(data) < num_bytes:
-        chunk = sock.recv(num_bytes - len(data))
-        if not chunk:
+def recv_into_exact(sock, view: memoryview):
+    """Fill view from the socket, looping if TCP splits the data."""
+    received = sock.recv_into(view)
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
             raise ConnectionError("Connection closed")
-        data += chunk
+        received += count
+    if len(view) and received == 0:
+        raise ConnectionError("Connection closed")
+
+
+def recv_exact(sock, num_bytes: int):
+    """
+    Read exactly num_bytes from socket. Small reads that arrive whole come
+    straight from recv; anything else fills one preallocated buffer.
+    """
+    if num_bytes <= COALESCE_BYTES:
+        data = sock.recv(num_bytes)
+        if len(data) == num_bytes:
+            return data
+        chunks = [data]
+        remaining = num_bytes - len(data)
+        while remaining:
+            chunk = sock.recv(remaining)
+            if not chunk:
+                raise ConnectionError("Connection closed")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    data = bytearray(num_bytes)
+    recv_into_exact(sock, memoryview(data))
     return data
 
 
-def recv_framed(sock) -> bytes:
-    """Read one length-prefixed message from socket."""
-    size_bytes = recv_exact(sock, 4)
-    message_size = int.from_bytes(size_bytes, byteorder='big')
+def recv_framed(sock):
+    """Read one length-prefixed message from socket into a buffer of its own."""
+    message_size, = FRAME_SIZE.unpack(recv_exact(sock, 4))
     return recv_exact(sock, message_size)
 
 
+class FrameReader:
+    """
+    Reads length-prefixed messages through one reusable buffer, grown as
+    needed. Each recv_into takes whatever the socket has, so small
+    messages usually cost one syscall and pipelined ones share a syscall.
+
+    Messages are returned as memoryviews into the buffer that are only
+    valid until the next read(), for loops that are done with a message
+    before reading the next one.
+    """
+
+    def __init__(self, initial_size: int = 64 * 1024):
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0    # end of received data
+
+    def _fill(self, sock, needed: int):
+        """Receive until at least needed unread bytes are buffered."""
+        if self.start + needed > len(self.buffer):
+            # Move the unread bytes to the front, into a bigger buffer if
+            # the message would not fit otherwise
+            unread = self.end - self.start
+            if needed > len(self.buffer):
+                buffer = bytearray(max(needed, 2 * len(self.buffer)))
+                buffer[:unread] = self.view[self.start:self.end]
+                self.buffer, self.view = buffer, memoryview(buffer)
+            else:
+                self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unread
+
+        while self.end - self.start < needed:
+            count = sock.recv_into(self.view[self.end:])
+            if count == 0:
+                raise ConnectionError("Connection closed")
+            self.end += count
+
+    def read(self, sock) -> memoryview:
+        if self.end - self.start < 4:
+            self._fill(sock, 4)
+        message_size, = FRAME_SIZE.unpack_from(self.buffer, self.start)
+
+        if self.end - self.start < 4 + message_size:
+            self._fill(sock, 4 + message_size)
+
+        start = self.start + 4
+        self.start = start + message_size
+        return self.view[start:self.start]
+
+
+def sendmsg_all(sock, buffers: list):
+    """
+    Write buffers back to back. Small messages are joined into one sendall,
+    which is cheaper than scatter bookkeeping; larger ones go out with
+    sendmsg without copying, resuming after partial writes.
+    """
+    total = sum(map(len, buffers))
+    if total <= COALESCE_BYTES:
+        sock.sendall(b''.join(buffers))
+        return
+
+    sent = sock.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
+    if sent == total:
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while True:
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if not buffers:
+            return
+        if sent:
+            buffers[0] = buffers[0][sent:]
+        sent = sock.sendmsg(buffers[:SENDMSG_MAX_BUFFERS])
+        if sent == 0:
+            raise ConnectionError("Connection closed")
+
+
 def send_framed(sock, data: bytes):
     """Send a length-prefixed message over socket."""
-    sock.sendall(frame_message(data))
+    if len(data) <= COALESCE_BYTES:
+        sock.sendall(FRAME_SIZE.pack(len(data)) + data)
+    else:
+        sendmsg_all(sock, [FRAME_SIZE.pack(len(data)), data])
+
+
+def send_framed_parts(sock, parts: list):
+    """
+    Send a length-prefixed message made of bytes and FileRegion parts.
+    Runs of byte parts go out in one scatter sendmsg; file regions go
+    through os.sendfile straight from the page cache.
+    """
+    total = sum(len(part) for part in parts)
+    pending = [FRAME_SIZE.pack(total)]
+
+    try:
+        for part in parts:
+            if not isinstance(part, FileRegion):
+                pending.append(part)
+                continue
+
+            if pending:
+                sendmsg_all(sock, pending)
+                pending = []
+
+            offset, remaining = part.offset, part.count
+            while remaining > 0:
+                sent = os.sendfile(sock.fileno(), part.fd, offset, remaining)
+                if sent == 0:
+                    raise ConnectionError("Connection closed")
+                offset += sent
+                remaining -= sent
+
+        if pending:
+            sendmsg_all(sock, pending)
+    finally:
+        for part in parts:
+            if isinstance(part, FileRegion):
+                part.close()
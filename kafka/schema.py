@@ -0,0 +1,225 @@
+import json
+import struct
+
+
+# First byte of every schema-encoded value. JSON values start with '{', so
+# records written before a topic switched encodings still decode.
+MAGIC = 0xB1
+
+# Enum code for a value missing from the field's dictionary; the value is
+# then stored inline with the strings
+ENUM_INLINE = 0xFF
+
+HEADER = struct.Struct('>BB')  # [magic: 1][schema_id: 1]
+STRING_LENGTH = struct.Struct('>H')
+
+# Fixed-size field types and their struct codes
+FIXED_TYPES = {
+    "int32": "i",
+    "int64": "q",
+    "float64": "d",
+    "bool": "?",
+    "enum": "B",
+}
+
+
+class Schema:
+    """
+    The binary layout of one event type:
+        [magic: 1][schema_id: 1][fixed part][strings]
+    The fixed part is one struct, so it decodes with a single unpack: the
+    numeric and bool fields, then a one-byte code per enum field, then the
+    byte length of each string field. Enum fields are strings from a
+    dictionary declared with the schema; their code is the index in it.
+    The string fields follow as utf-8, back to back, and after them any
+    enum value missing from its dictionary, as [length: 2][utf-8].
+
+    fields is a list of (name, type) or, for enums, (name, "enum", values).
+    """
+
+    def __init__(self, schema_id: int, name: str, fields: list):
+        self.id = schema_id
+        self.name = name
+        for field in fields:
+            if field[1] not in FIXED_TYPES and field[1] != "string":
+                raise ValueError(f"Unknown type '{field[1]}' for field {field[0]}")
+
+        self.numeric_fields = [field[0] for field in fields if field[1] in FIXED_TYPES and field[1] != "enum"]
+        self.enum_fields = [field[0] for field in fields if field[1] == "enum"]
+        self.string_fields = [field[0] for field in fields if field[1] == "string"]
+        self.fields = self.numeric_fields + self.enum_fields + self.string_fields
+
+        numeric_codes = ''.join(FIXED_TYPES[field[1]] for field in fields if field[0] in self.numeric_fields)
+        self.fixed = struct.Struct('>' + numeric_codes + 'B' * len(self.enum_fields) + 'H' * len(self.string_fields))
+
+        # Per enum field, in order: code -> value, and value -> code
+        self.enum_values = [list(field[2]) for field in fields if field[1] == "enum"]
+        self.enum_codes = [{value: code for code, value in enumerate(values)} for values in self.enum_values]
+        for name, values in zip(self.enum_fields, self.enum_values):
+            if len(values) >= ENUM_INLINE:
+                raise ValueError(f"Enum {name} has more than {ENUM_INLINE - 1} values")
+        self.enum_plan = list(zip(self.enum_fields, self.enum_values))
+        self.strings_start = HEADER.size + self.fixed.size
+
+    def encode(self, values: dict) -> bytes:
+        """Encode a dict (or Record) holding every field of the schema."""
+        fixed = [values[name] for name in self.numeric_fields]
+        inline = []
+        for name, codes in zip(self.enum_fields, self.enum_codes):
+            code = codes.get(values[name], ENUM_INLINE)
+            if code == ENUM_INLINE:
+                inline.append(values[name].encode('utf-8'))
+            fixed.append(code)
+
+        strings = [values[name].encode('utf-8') for name in self.string_fields]
+        fixed += map(len, strings)
+
+        parts = [HEADER.pack(MAGIC, self.id), self.fixed.pack(*fixed)] + strings
+        for value in inline:
+            parts += [STRING_LENGTH.pack(len(value)), value]
+        return b''.join(parts)
+
+    def decode(self, data) -> 'Record':
+        """A record over encoded data; it is only decoded when first read."""
+        return Record(self, data)
+
+    def decode_fields(self, data) -> dict:
+        values = self.fixed.unpack_from(data, HEADER.size)
+        fields = dict(zip(self.numeric_fields, values))
+
+        i = len(self.numeric_fields)
+        inline = []
+        for name, enum_values in self.enum_plan:
+            code = values[i]
+            if code == ENUM_INLINE:
+                inline.append(name)
+            else:
+                fields[name] = enum_values[code]
+            i += 1
+
+        position = self.strings_start
+        for name in self.string_fields:
+            end = position + values[i]
+            fields[name] = str(data[position:end], 'utf-8')
+            position = end
+            i += 1
+
+        for name in inline:
+            length, = STRING_LENGTH.unpack_from(data, position)
+            position += STRING_LENGTH.size
+            fields[name] = str(data[position:position + length], 'utf-8')
+            position += length
+        return fields
+
+
+class Record(dict):
+    """
+    An event decoded lazily from its encoded bytes: a dict of the schema's
+    fields that is only filled in when first read, so records a consumer
+    skips cost nothing and fields read again cost a plain dict lookup.
+    Keys assigned before then are kept over the decoded fields, e.g. a tag
+    with the record's source topic. Code that reads dicts from C, like
+    json.dumps, sees it empty until it was read; use to_dict().
+    """
+
+    __slots__ = ('schema', 'data')
+
+    def __init__(self, schema: Schema, data):
+        super().__init__()
+        self.schema = schema
+        self.data = data
+
+    def _decode(self):
+        fields = self.schema.decode_fields(self.data)
+        self.data = None
+        if dict.__len__(self):
+            fields.update(dict.copy(self))
+        dict.update(self, fields)
+
+    def __missing__(self, name):
+        if self.data is None:
+            raise KeyError(name)
+        self._decode()
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        if self.data is not None:
+            self._decode()
+        return dict.get(self, name, default)
+
+    def __contains__(self, name) -> bool:
+        if self.data is not None:
+            self._decode()
+        return dict.__contains__(self, name)
+
+    def __len__(self) -> int:
+        if self.data is not None:
+            self._decode()
+        return dict.__len__(self)
+
+    def __iter__(self):
+        if self.data is not None:
+            self._decode()
+        return dict.__iter__(self)
+
+    def keys(self):
+        if self.data is not None:
+            self._decode()
+        return dict.keys(self)
+
+    def values(self):
+        if self.data is not None:
+            self._decode()
+        return dict.values(self)
+
+    def items(self):
+        if self.data is not None:
+            self._decode()
+        return dict.items(self)
+
+    def to_dict(self) -> dict:
+        if self.data is not None:
+            self._decode()
+        return dict.copy(self)
+
+    def __eq__(self, other) -> bool:
+        return self.to_dict() == other
+
+    def __repr__(self) -> str:
+        return f"{self.schema.name}{self.to_dict()}"
+
+
+SCHEMAS = {}
+SCHEMAS_BY_NAME = {}
+
+
+def register_schema(schema_id: int, name: str, fields: list) -> Schema:
+    """
+    Make an event schema available to producers and consumers, e.g.:
+        register_schema(1, 'transaction', [("amount", "int64"), ...])
+    Every process that reads or writes such values must register it with
+    the same id and fields.
+    """
+    if not 0 <= schema_id < 256:
+        raise ValueError(f"Schema id {schema_id} out of range")
+    schema = Schema(schema_id, name, fields)
+    SCHEMAS[schema_id] = schema
+    SCHEMAS_BY_NAME[name] = schema
+    return schema
+
+
+def get_schema(schema) -> Schema:
+    """Look up a schema by id or name. Raises KeyError for unknown schemas."""
+    if isinstance(schema, str):
+        return SCHEMAS_BY_NAME[schema]
+    return SCHEMAS[schema]
+
+
+def decode(data):
+    """
+    Value deserializer for consumers: a Record for schema-encoded values,
+    whatever schema wrote them, or a dict for JSON ones.
+    """
+    if data[0] != MAGIC:
+        return json.loads(bytes(data))
+    return SCHEMAS[data[1]].decode(data)
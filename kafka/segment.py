@@ -0,0 +1,507 @@
+import mmap
+import os
+import struct
+import time
+from protocol import BATCH_HEADER, INT32, FileRegion, decode_batches
+
+
+# Offset index entry on disk: [relative_offset: 4][file_position: 4]
+INDEX_ENTRY = struct.Struct('>II')
+
+# Time index entry on disk: [timestamp: 8][relative_offset: 4]
+TIME_INDEX_ENTRY = struct.Struct('>qI')
+
+# How much log to pread at a time when walking record headers
+SCAN_CHUNK_BYTES = 8192
+
+# Suffix of segment files removed from the log but not yet deleted
+DELETED_SUFFIX = ".deleted"
+
+
+def segment_name(base_offset: int, suffix: str) -> str:
+    """Segment files are named by their zero-padded base offset."""
+    return f"{base_offset:020d}{suffix}"
+
+
+class SparseIndex:
+    """
+    A sparse, memory-mapped index for one log segment.
+
+    Only every ~index_interval_bytes of log gets an entry, so the index stays
+    tiny. Entries are fixed-size and sorted, which lets lookups binary search
+    directly over the mmap without loading anything into Python objects.
+
+    The active segment's index file is preallocated to max_bytes and trimmed
+    to its real size when the segment is rolled.
+    """
+
+    ENTRY = INDEX_ENTRY
+
+    def __init__(self, path: str, base_offset: int, max_bytes: int, writable: bool):
+        self.path = path
+        self.base_offset = base_offset
+        self.max_entries = max_bytes // self.ENTRY.size
+        self.writable = writable
+        self.mmap = None
+        self.entries = 0
+
+        if writable:
+            with open(self.path, 'a+b') as f:
+                existing = f.tell()
+                f.truncate(self.max_entries * self.ENTRY.size)
+                self.mmap = mmap.mmap(f.fileno(), 0)
+            self.entries = self._count_valid(existing // self.ENTRY.size)
+        elif os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.entries = self._count_valid(len(self.mmap) // self.ENTRY.size)
+
+    def _entry(self, n: int):
+        return self.ENTRY.unpack_from(self.mmap, n * self.ENTRY.size)
+
+    def _count_leading(self, predicate, entries: int = None) -> int:
+        """Binary search for the number of leading entries satisfying predicate."""
+        lo, hi = 0, self.entries if entries is None else entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if predicate(self._entry(mid)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _count_valid(self, slots: int) -> int:
+        """
+        Count real entries in a possibly preallocated file. The first field
+        of every entry is positive (see subclasses), so the zero padding
+        after the last entry is found by binary search.
+        """
+        return self._count_leading(lambda entry: entry[0] > 0, slots)
+
+    def is_full(self) -> bool:
+        return self.entries >= self.max_entries
+
+    def _append(self, *fields):
+        self.ENTRY.pack_into(self.mmap, self.entries * self.ENTRY.size, *fields)
+        self.entries += 1
+
+    def _truncate_entries(self, entries: int):
+        """Keep the first entries, zeroing the rest so they are not counted again on reopen."""
+        self.mmap[entries * self.ENTRY.size:self.entries * self.ENTRY.size] = \
+            bytes((self.entries - entries) * self.ENTRY.size)
+        self.entries = entries
+
+    def reset(self):
+        self._truncate_entries(0)
+
+    def flush(self):
+        if self.mmap is not None and self.writable:
+            self.mmap.flush()
+
+    def close(self):
+        """Unmap the index, trimming a writable index down to its entries."""
+        if self.mmap is not None:
+            if self.writable:
+                self.mmap.flush()
+            self.mmap.close()
+            self.mmap = None
+        if self.writable:
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.entries * self.ENTRY.size)
+
+
+class OffsetIndex(SparseIndex):
+    """
+    Maps offsets to log positions. Entries never point at the segment's
+    first record, so relative offsets are always positive.
+    """
+
+    ENTRY = INDEX_ENTRY
+
+    def append(self, offset: int, position: int):
+        self._append(offset - self.base_offset, position)
+
+    def lookup(self, offset: int):
+        """
+        Find the last indexed (offset, position) at or before the given offset.
+        Falls back to the start of the segment.
+        """
+        target = offset - self.base_offset
+        n = self._count_leading(lambda entry: entry[0] <= target)
+        if n == 0:
+            return self.base_offset, 0
+
+        relative_offset, position = self._entry(n - 1)
+        return self.base_offset + relative_offset, position
+
+    def last_position(self) -> int:
+        """Log position of the last entry, or 0 if the index is empty."""
+        return self._entry(self.entries - 1)[1] if self.entries else 0
+
+    def truncate_to(self, position: int):
+        """Drop entries pointing at or past position."""
+        self._truncate_entries(self._count_leading(lambda entry: entry[1] < position))
+
+
+class TimeIndex(SparseIndex):
+    """
+    Maps append timestamps (ms) to offsets. Timestamps never decrease along
+    the log and each entry's is strictly greater than the previous one's.
+    A sealed segment's last entry holds its largest timestamp.
+    """
+
+    ENTRY = TIME_INDEX_ENTRY
+
+    def append(self, timestamp: int, offset: int):
+        self._append(timestamp, offset - self.base_offset)
+
+    def last_timestamp(self) -> int:
+        return self._entry(self.entries - 1)[0] if self.entries else 0
+
+    def lookup(self, timestamp: int) -> int:
+        """
+        An offset whose batch is older than timestamp, as late as the index
+        allows: the records from timestamp onwards all come after it. Falls
+        back to the start of the segment.
+        """
+        n = self._count_leading(lambda entry: entry[0] < timestamp)
+        if n == 0:
+            return self.base_offset
+        return self.base_offset + self._entry(n - 1)[1]
+
+    def truncate_to(self, offset: int):
+        """Drop entries for offset and later."""
+        target = offset - self.base_offset
+        self._truncate_entries(self._count_leading(lambda entry: entry[1] < target))
+
+
+class LogSegment:
+    """
+    One slice of a partition's log: a .log file holding records from
+    base_offset onwards, plus its sparse .index and .timeindex files.
+
+    The log is a sequence of record batches (see protocol.build_batch):
+        [batch_size: 4][base_offset: 8][record_count: 4][codec: 1][timestamp: 8][records]
+
+    This is exactly the layout of a FETCH response, so fetches can stream
+    byte ranges of the file straight to the socket. Batches stay compressed
+    on disk; only consumers decompress them.
+    """
+
+    def __init__(self, path: str, base_offset: int, config: dict, active: bool):
+        self.base_offset = base_offset
+        self.config = config
+        self.log_file = os.path.join(path, segment_name(base_offset, ".log"))
+        self.index = OffsetIndex(
+            os.path.join(path, segment_name(base_offset, ".index")),
+            base_offset,
+            config["max_index_bytes"],
+            writable=active,
+        )
+        self.time_index = TimeIndex(
+            os.path.join(path, segment_name(base_offset, ".timeindex")),
+            base_offset,
+            config["max_index_bytes"],
+            writable=active,
+        )
+
+        if not os.path.exists(self.log_file):
+            open(self.log_file, 'wb').close()
+            self.created_at = time.time()
+        else:
+            self.created_at = os.path.getmtime(self.log_file)
+
+        self.size = os.path.getsize(self.log_file)
+        self.next_offset = base_offset
+        self.last_batch_position = 0
+        self.bytes_since_last_index = 0
+
+        # Largest append timestamp (ms) in the segment. For a sealed segment
+        # it is the last time index entry; recover() sets it for the active one.
+        self.max_timestamp = self.time_index.last_timestamp()
+        self.max_timestamp_offset = base_offset
+
+        # The active segment keeps its log open for the lifetime of the
+        # segment. Unbuffered: each append is already a single write.
+        self.file = open(self.log_file, 'ab', buffering=0) if active else None
+        self.read_fd = None
+
+    def recover(self, checkpoint: tuple = None) -> int:
+        """
+        Rebuild this segment's indexes from the log, dropping any partially
+        written batch at the tail. Returns the next offset.
+
+        checkpoint is a (position, next_offset, last_batch_position) recorded
+        after an fsync. If it still matches the log, the log and indexes
+        before position are trusted and only the tail after it is scanned.
+        """
+        if checkpoint is not None and self._matches(*checkpoint):
+            valid_size, self.next_offset, self.last_batch_position = checkpoint
+            self.index.truncate_to(valid_size)
+            self.time_index.truncate_to(self.next_offset)
+            self.bytes_since_last_index = valid_size - self.index.last_position()
+        else:
+            valid_size = 0
+            self.index.reset()
+            self.time_index.reset()
+            self.bytes_since_last_index = 0
+
+        with open(self.log_file, 'rb') as f:
+            f.seek(valid_size)
+            while True:
+                header = f.read(BATCH_HEADER.size)
+                if len(header) < BATCH_HEADER.size:
+                    break
+
+                batch_size, base_offset, record_count, _, timestamp = BATCH_HEADER.unpack(header)
+                if len(f.read(batch_size + 4 - BATCH_HEADER.size)) < batch_size + 4 - BATCH_HEADER.size:
+                    break
+
+                self._maybe_index(base_offset, valid_size, timestamp)
+                self._track_timestamp(base_offset, timestamp)
+                self.last_batch_position = valid_size
+                valid_size += 4 + batch_size
+                self.bytes_since_last_index += 4 + batch_size
+                self.next_offset = base_offset + record_count
+
+        if valid_size < self.size:
+            with open(self.log_file, 'r+b') as f:
+                f.truncate(valid_size)
+        self.size = valid_size
+
+        return self.next_offset
+
+    def truncate_to(self, offset: int) -> int:
+        """
+        Drop the batch holding offset and everything after it, then rebuild
+        the indexes from what is left. Active segments only. Returns the
+        next offset.
+        """
+        position, _ = self.find_position(offset)
+        self.file.truncate(position)
+        self.size = position
+
+        self.next_offset = self.base_offset
+        self.last_batch_position = 0
+        self.max_timestamp = 0
+        self.max_timestamp_offset = self.base_offset
+        self.recover()
+        self.flush()
+        return self.next_offset
+
+    def _matches(self, position: int, next_offset: int, last_batch_position: int) -> bool:
+        """
+        Check a checkpoint against the log: its last batch must end at
+        position and at next_offset. Timestamps never decrease, so that batch
+        also holds the largest timestamp so far.
+        """
+        if position == 0:
+            return next_offset == self.base_offset
+        if position > self.size or last_batch_position >= position:
+            return False
+
+        with open(self.log_file, 'rb') as f:
+            f.seek(last_batch_position)
+            header = f.read(BATCH_HEADER.size)
+        if len(header) < BATCH_HEADER.size:
+            return False
+
+        batch_size, base_offset, record_count, _, timestamp = BATCH_HEADER.unpack(header)
+        if last_batch_position + 4 + batch_size != position or base_offset + record_count != next_offset:
+            return False
+
+        self._track_timestamp(base_offset, timestamp)
+        return True
+
+    def _track_timestamp(self, offset: int, timestamp: int):
+        if timestamp > self.max_timestamp:
+            self.max_timestamp = timestamp
+            self.max_timestamp_offset = offset
+
+    def _maybe_index(self, offset: int, position: int, timestamp: int):
+        if self.bytes_since_last_index >= self.config["index_interval_bytes"]:
+            self.index.append(offset, position)
+            if timestamp > self.time_index.last_timestamp():
+                self.time_index.append(timestamp, offset)
+            self.bytes_since_last_index = 0
+
+    def should_roll(self, batch_size: int) -> bool:
+        if self.size == 0:
+            return False
+        if self.size + batch_size > self.config["segment_bytes"]:
+            return True
+        if time.time() - self.created_at >= self.config["segment_ms"] / 1000:
+            return True
+        return self.index.is_full() or self.time_index.is_full()
+
+    def append(self, base_offset: int, record_count: int, timestamp: int, batch: bytes):
+        """Write one encoded batch with a single write() on the open log file."""
+        self._maybe_index(base_offset, self.size, timestamp)
+
+        self.file.write(batch)
+
+        self._track_timestamp(base_offset, timestamp)
+        self.last_batch_position = self.size
+        self.size += len(batch)
+        self.bytes_since_last_index += len(batch)
+        self.next_offset = base_offset + record_count
+
+    def flush(self):
+        """fsync the log so everything appended so far survives a crash."""
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def _reader(self) -> int:
+        """A read-only fd shared by all fetches of this segment, opened lazily."""
+        if self.read_fd is None:
+            self.read_fd = os.open(self.log_file, os.O_RDONLY)
+        return self.read_fd
+
+    def _headers(self, position: int):
+        """
+        Walk batch headers from position, reading the log in chunks. Yields
+        (position, batch_size, base_offset, record_count, timestamp) with
+        batch_size including its own 4 bytes.
+        """
+        fd = self._reader()
+        end = self.size
+        chunk_start, chunk = position, b''
+
+        while position < end:
+            rel = position - chunk_start
+            if rel + BATCH_HEADER.size > len(chunk):
+                chunk_start, rel = position, 0
+                chunk = os.pread(fd, SCAN_CHUNK_BYTES, position)
+                if len(chunk) < BATCH_HEADER.size:
+                    return
+
+            batch_size, base_offset, record_count, _, timestamp = BATCH_HEADER.unpack_from(chunk, rel)
+            yield position, 4 + batch_size, base_offset, record_count, timestamp
+            position += 4 + batch_size
+
+    def find_position(self, offset: int):
+        """
+        Locate the batch holding offset, or the first one after it. Jumps to
+        the nearest indexed position, then walks batch headers forward.
+        Returns (position, batch_size) or (self.size, 0) if there is none.
+        """
+        _, position = self.index.lookup(offset)
+        for position, batch_size, base_offset, record_count, _ in self._headers(position):
+            if base_offset + record_count > offset:
+                return position, batch_size
+        return self.size, 0
+
+    def offset_for_timestamp(self, timestamp: int):
+        """
+        The first offset appended at or after timestamp (ms), or None if every
+        record in this segment is older. A time index lookup narrows the
+        search to one index interval of batch headers.
+        """
+        if timestamp > self.max_timestamp:
+            return None
+
+        _, position = self.index.lookup(self.time_index.lookup(timestamp))
+        for _, _, base_offset, _, batch_timestamp in self._headers(position):
+            if batch_timestamp >= timestamp:
+                return base_offset
+        return None
+
+    def read_region(self, start_offset: int, max_bytes: int):
+        """
+        The byte range of batches from the one holding start_offset, up to
+        max_bytes (but always at least that whole batch). The range may end
+        partway through a batch; readers drop the incomplete tail. Returns a
+        FileRegion or None if this segment has nothing at or after start_offset.
+        """
+        position, first_batch_size = self.find_position(start_offset)
+        end = self.size
+        if position >= end:
+            return None
+
+        end = min(end, position + max(max_bytes, first_batch_size))
+        return FileRegion(os.dup(self._reader()), position, end - position)
+
+    def batches(self, position: int = 0):
+        """Yield each stored batch from position onwards as bytes, through the shared fd."""
+        fd = self._reader()
+        end = self.size
+
+        while position + 4 <= end:
+            batch_size = 4 + INT32.unpack(os.pread(fd, 4, position))[0]
+            batch = os.pread(fd, batch_size, position)
+            if len(batch) < batch_size:
+                break
+            yield batch
+            position += batch_size
+
+    def read(self, start_offset: int, max_records: int) -> list:
+        """
+        Read up to max_records starting at start_offset, decompressing as
+        needed. Returns (offset, key, value) tuples.
+        """
+        records = []
+        position, _ = self.find_position(start_offset)
+
+        for batch in self.batches(position):
+            records.extend(decode_batches(batch, start_offset))
+            if len(records) >= max_records:
+                break
+
+        return records[:max_records]
+
+    def end_offset(self) -> int:
+        """The offset after this segment's last record, walking headers from the last index entry."""
+        next_offset = self.base_offset
+        for _, _, base_offset, record_count, _ in self._headers(self.index.last_position()):
+            next_offset = base_offset + record_count
+        return next_offset
+
+    def close_active(self):
+        """
+        Seal this segment: sync and close its log, record its largest
+        timestamp in the time index, trim both indexes and reopen them
+        read-only.
+        """
+        self.flush()
+        self.file.close()
+        self.file = None
+
+        if self.max_timestamp > self.time_index.last_timestamp():
+            self.time_index.append(self.max_timestamp, self.max_timestamp_offset)
+
+        self.index.close()
+        self.time_index.close()
+        self.index = OffsetIndex(self.index.path, self.base_offset,
+                                 self.config["max_index_bytes"], writable=False)
+        self.time_index = TimeIndex(self.time_index.path, self.base_offset,
+                                    self.config["max_index_bytes"], writable=False)
+
+    def files(self) -> list:
+        return [self.log_file, self.index.path, self.time_index.path]
+
+    def mark_deleted(self):
+        """
+        Rename this segment's files out of the log. Open fds and the index
+        mmaps stay valid, so in-flight reads finish; delete() removes the files.
+        """
+        for path in self.files():
+            os.rename(path, path + DELETED_SUFFIX)
+        self.log_file += DELETED_SUFFIX
+        self.index.path += DELETED_SUFFIX
+        self.time_index.path += DELETED_SUFFIX
+
+    def delete(self):
+        self.close()
+        for path in self.files():
+            os.remove(path)
+
+    def close(self):
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            self.read_fd = None
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        self.index.close()
+        self.time_index.close()
@@ -0,0 +1,219 @@
+import sys, os, socket, threading, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'kafka'))
+
+from protocol import (
+    ByteBuffer, ByteWriter, FrameReader,
+    recv_framed, send_framed, decode_batches, encode_batch, read_request_header,
+)
+
+# Micro-benchmarks for the wire codec, comparing the struct/memoryview
+# implementation in protocol.py with the previous int.from_bytes / slicing /
+# bytes-concatenation one, reproduced below as the baseline.
+
+
+# ──────────────────────────────────────────────
+# Baseline: the previous codec
+# ──────────────────────────────────────────────
+
+class OldByteBuffer:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read_int16(self):
+        value = int.from_bytes(self.data[self.position:self.position + 2], byteorder='big', signed=True)
+        self.position += 2
+        return value
+
+    def read_int32(self):
+        value = int.from_bytes(self.data[self.position:self.position + 4], byteorder='big', signed=True)
+        self.position += 4
+        return value
+
+    def read_int64(self):
+        value = int.from_bytes(self.data[self.position:self.position + 8], byteorder='big', signed=True)
+        self.position += 8
+        return value
+
+    def read_string(self):
+        length = self.read_int16()
+        value = self.data[self.position:self.position + length].decode('utf-8')
+        self.position += length
+        return value
+
+    def read_bytes(self):
+        length = self.read_int32()
+        value = self.data[self.position:self.position + length]
+        self.position += length
+        return value
+
+
+class OldByteWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write_int16(self, value):
+        self.data.extend(value.to_bytes(2, byteorder='big', signed=True))
+        return self
+
+    def write_int32(self, value):
+        self.data.extend(value.to_bytes(4, byteorder='big', signed=True))
+        return self
+
+    def write_int64(self, value):
+        self.data.extend(value.to_bytes(8, byteorder='big', signed=True))
+        return self
+
+    def to_bytes(self):
+        return bytes(self.data)
+
+
+def old_recv_exact(sock, num_bytes):
+    data = b''
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def old_recv_framed(sock):
+    size_bytes = old_recv_exact(sock, 4)
+    return old_recv_exact(sock, int.from_bytes(size_bytes, byteorder='big'))
+
+
+def old_send_framed(sock, data):
+    sock.sendall(len(data).to_bytes(4, byteorder='big') + data)
+
+
+# ──────────────────────────────────────────────
+# Benchmarks
+# ──────────────────────────────────────────────
+
+def timed(fn, repeat=5):
+    """Best of repeat runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, old, new, unit_count, unit):
+    print(f"  {name:<38} old {unit_count / old:>12,.0f} {unit}/s   "
+          f"new {unit_count / new:>12,.0f} {unit}/s   x{old / new:.2f}")
+
+
+def produce_request(writer_class):
+    """A PRODUCE_BATCH-shaped request: header plus 100 partition entries."""
+    writer = writer_class()
+    writer.write_int16(4).write_int16(1).write_int32(7)
+    for partition in range(100):
+        writer.write_int32(partition).write_int32(100).write_int64(1_000_000 + partition)
+    return writer.to_bytes()
+
+
+def bench_writer(n=2000):
+    old = timed(lambda: [produce_request(OldByteWriter) for _ in range(n)])
+    new = timed(lambda: [produce_request(ByteWriter) for _ in range(n)])
+    report("encode 300-field request", old, new, n, "req")
+
+
+def bench_reader(n=2000):
+    data = bytes(produce_request(ByteWriter))
+
+    def parse(buffer_class):
+        for _ in range(n):
+            buf = buffer_class(data)
+            buf.read_int16(), buf.read_int16(), buf.read_int32()
+            for _ in range(100):
+                buf.read_int32(), buf.read_int32(), buf.read_int64()
+
+    old = timed(lambda: parse(OldByteBuffer))
+    new = timed(lambda: parse(ByteBuffer))
+    report("decode 300-field request", old, new, n, "req")
+
+
+def bench_fetch_response(n=200):
+    """Client side: pull a 1 MiB records blob out of a fetch response and decode it."""
+    records = [(f"customer_{i}", b'{"amount": 1234, "merchant": "store"}' * 4) for i in range(100)]
+    batches = b''.join(bytes(encode_batch(i * 100, records)) for i in range(64))
+    response = bytes(ByteWriter().write_int32(1).write_int16(0).write_int64(6400)
+                     .write_bytes(batches).to_bytes())
+
+    def old_parse():
+        for _ in range(n):
+            buf = OldByteBuffer(response)
+            buf.read_int32(), buf.read_int16(), buf.read_int64()
+            decode_batches(buf.read_bytes())
+
+    def new_parse():
+        for _ in range(n):
+            buf = ByteBuffer(response)
+            buf.read_int32(), buf.read_int16(), buf.read_int64()
+            decode_batches(buf.read_view())
+
+    old = timed(old_parse, repeat=3)
+    new = timed(new_parse, repeat=3)
+    report(f"decode {len(batches) // 1024} KiB fetch response", old, new, n, "resp")
+
+
+def bench_request_header(n=100000):
+    """Broker side: the header every request starts with."""
+    data = bytes(ByteWriter().write_int16(1).write_int16(1).write_int32(42)
+                 .write_string('consumer-1').write_string('transactions').to_bytes())
+
+    def old_parse():
+        for _ in range(n):
+            buf = OldByteBuffer(data)
+            buf.read_int16(), buf.read_int16(), buf.read_int32(), buf.read_string()
+
+    def new_parse():
+        for _ in range(n):
+            read_request_header(ByteBuffer(data))
+
+    old = timed(old_parse)
+    new = timed(new_parse)
+    report("decode request header", old, new, n, "req")
+
+
+def bench_socket(message_size, count):
+    """Round-trip framed messages over a socketpair: sender thread, receiving caller."""
+    payload = os.urandom(message_size)
+
+    def run(send, recv):
+        a, b = socket.socketpair()
+        sender = threading.Thread(target=lambda: [send(a, payload) for _ in range(count)])
+        start = time.perf_counter()
+        sender.start()
+        for _ in range(count):
+            recv(b)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        a.close()
+        b.close()
+        return elapsed
+
+    frames = FrameReader()
+    old = min(run(old_send_framed, old_recv_framed) for _ in range(3))
+    new = min(run(send_framed, recv_framed) for _ in range(3))
+    reused = min(run(send_framed, frames.read) for _ in range(3))
+
+    size = f"{message_size // 1024} KiB" if message_size >= 1024 else f"{message_size} B"
+    report(f"framed {size} messages, own buffer", old, new, count, "msg")
+    report(f"framed {size} messages, FrameReader", old, reused, count, "msg")
+
+
+if __name__ == '__main__':
+    print("Broker side")
+    bench_request_header()
+    bench_reader()
+    bench_writer()
+    bench_socket(200, 20000)
+
+    print("Client side")
+    bench_fetch_response()
+    bench_socket(1024 * 1024, 100)
+    bench_socket(8 * 1024 * 1024, 10)
@@ -0,0 +1,242 @@
+import sys, os, random, threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fraud'))
+
+import rule_engine
+from rule_engine import RuleEngine
+
+# Parity check of the compiled, indexed and reordering rule engine in
+# rule_engine.py against the original interpreter, reproduced below as the
+# baseline. Wherever the baseline returns, evaluate and evaluate_batch must
+# return the same rules and not raise; that includes missing fields, which
+# the baseline only compares when every earlier condition held.
+
+
+# ──────────────────────────────────────────────
+# Baseline: the original interpreter
+# ──────────────────────────────────────────────
+
+class BaselineRuleEngine:
+    def __init__(self, rules):
+        self.rules = rules
+
+    def _check_condition(self, actual, op, expected):
+        if op == "==":
+            return actual == expected
+        elif op == "!=":
+            return actual != expected
+        elif op == ">":
+            return actual > expected
+        elif op == ">=":
+            return actual >= expected
+        elif op == "<":
+            return actual < expected
+        elif op == "<=":
+            return actual <= expected
+        return False
+
+    def evaluate(self, transaction, features):
+        fired = []
+
+        for rule_name, conditions in self.rules.items():
+            all_true = True
+
+            for condition in conditions:
+                if condition["source"] == "features":
+                    actual = features.get(condition["field"], 0)
+                else:
+                    actual = transaction.get(condition["field"])
+
+                if not self._check_condition(actual, condition["op"], condition["value"]):
+                    all_true = False
+                    break
+
+            if all_true:
+                fired.append(rule_name)
+
+        return fired
+
+
+# ──────────────────────────────────────────────
+# Random rules and events
+# ──────────────────────────────────────────────
+
+TXN_TYPES = ["debit", "credit", "cashout", "transfer"]
+FEATURES = ["count_txn_1h", "sum_txn_1h", "unique_ben_24h", "account_age_days"]
+
+
+def random_condition(rng):
+    kind = rng.random()
+    if kind < 0.35:
+        return {"field": "txn_type", "source": "transaction", "op": rng.choice(["==", "!="]), "value": rng.choice(TXN_TYPES)}
+    if kind < 0.6:
+        return {"field": "amount", "source": "transaction", "op": rng.choice([">", ">=", "<", "<="]),
+                "value": rng.choice([1000, 5000, 10000, 30000])}
+    if kind < 0.75:
+        # Only some transactions have it, so it must stay guarded
+        return {"field": "ext", "source": "transaction", "op": rng.choice([">", "<="]), "value": 3}
+    return {"field": rng.choice(FEATURES), "source": "features", "op": rng.choice([">", ">=", "<", "==", "!="]),
+            "value": rng.randint(0, 20)}
+
+
+def random_rules(rng):
+    rules = {}
+    for i in range(rng.randint(1, 12)):
+        conditions = [random_condition(rng) for _ in range(rng.randint(0, 4))]
+        # Guard every ext test with a txn_type equality, as rules for fields
+        # only some transaction types carry do
+        if any(condition["field"] == "ext" for condition in conditions):
+            conditions.insert(0, {"field": "txn_type", "source": "transaction", "op": "==", "value": "transfer"})
+        rules[f"rule_{i}"] = conditions
+    return rules
+
+
+def random_transaction(rng):
+    transaction = {"txn_type": rng.choice(TXN_TYPES), "amount": rng.choice([0, 999, 1000, 5000, 7000, 10000, 30001])}
+    if transaction["txn_type"] == "transfer":
+        transaction["ext"] = rng.randint(0, 6)
+    return transaction
+
+
+def random_features(rng):
+    return {name: rng.randint(0, 20) for name in FEATURES if rng.random() < 0.9}
+
+
+def baseline_result(baseline, transaction, features):
+    try:
+        return baseline.evaluate(transaction, features)
+    except TypeError:
+        return TypeError
+
+
+def check(rounds=100, seed=1):
+    rng = random.Random(seed)
+    checked = batches = 0
+    for _ in range(rounds):
+        rules = random_rules(rng)
+        baseline = BaselineRuleEngine(rules)
+        engine = RuleEngine(rules)
+
+        for _ in range(20):
+            transactions = [random_transaction(rng) for _ in range(rng.randint(1, 40))]
+            features = [random_features(rng) for _ in transactions]
+            expected = [baseline_result(baseline, t, f) for t, f in zip(transactions, features)]
+
+            for transaction, row_features, fired in zip(transactions, features, expected):
+                if fired is not TypeError:
+                    assert engine.evaluate(transaction, row_features) == fired, (rules, transaction, row_features)
+                    checked += 1
+
+            if TypeError not in expected:
+                assert engine.evaluate_batch(transactions, features) == expected, rules
+                batches += 1
+
+    return checked, batches
+
+
+def check_sampled_missing_field():
+    """A range test on a field most transactions lack, behind a condition they fail."""
+    rules = {"credit_ext": [
+        {"field": "txn_type", "source": "transaction", "op": "==", "value": "credit"},
+        {"field": "ext", "source": "transaction", "op": ">", "value": 3},
+    ]}
+    engine = RuleEngine(rules)
+    transaction = {"txn_type": "cashout", "amount": 100}
+    for _ in range(rule_engine.SAMPLE_EVERY * rule_engine.REORDER_EVERY * 2):
+        assert engine.evaluate(transaction, {}) == []
+    assert engine.evaluate_batch([transaction] * rule_engine.SAMPLE_EVERY * 2, [{}] * rule_engine.SAMPLE_EVERY * 2) \
+        == [[]] * rule_engine.SAMPLE_EVERY * 2
+    return engine.samples
+
+
+def check_mixed_types(rounds=50, seed=3):
+    """Fields whose values mix types across rows: ints with strings, numbers with None, ints with floats."""
+    rng = random.Random(seed)
+    channels = [1, 2, "1", "2", None, True]
+    batches = 0
+    for _ in range(rounds):
+        rules = {}
+        for i in range(rng.randint(1, 6)):
+            rules[f"rule_{i}"] = [
+                {"field": "channel", "source": "transaction", "op": rng.choice(["==", "!="]), "value": rng.choice(channels)},
+                {"field": "amount", "source": "transaction", "op": rng.choice([">", "<="]), "value": rng.choice([1, 1.5, 5000])},
+                {"field": "account_type", "source": "features", "op": "==", "value": rng.choice([0, "unknown", "personal"])},
+            ][:rng.randint(1, 3)]
+        baseline = BaselineRuleEngine(rules)
+        engine = RuleEngine(rules)
+
+        transactions = [{"channel": rng.choice(channels), "amount": rng.choice([0, 1, 1.5, 2.5, 5000, True])}
+                        for _ in range(rng.randint(1, 40))]
+        features = [{"account_type": rng.choice(["unknown", "personal"])} if rng.random() < 0.7 else {}
+                    for _ in transactions]
+        expected = [baseline.evaluate(t, f) for t, f in zip(transactions, features)]
+        assert engine.evaluate_batch(transactions, features) == expected, rules
+        batches += 1
+    return batches
+
+
+def check_special_values():
+    """Rule names that aren't identifiers, and values whose repr isn't valid Python, like inf and nan."""
+    nan, inf = float("nan"), float("inf")
+    rules = {
+        "name\nfired.append('injected')": [{"field": "amount", "source": "transaction", "op": "<", "value": inf}],
+        "above_nan": [{"field": "amount", "source": "transaction", "op": ">", "value": nan}],
+        "not_nan": [{"field": "amount", "source": "transaction", "op": "!=", "value": nan},
+                    {"field": "amount", "source": "transaction", "op": ">", "value": -inf}],
+        "between": [{"field": "amount", "source": "transaction", "op": ">=", "value": 5},
+                    {"field": "amount", "source": "transaction", "op": "<", "value": nan}],
+    }
+    baseline = BaselineRuleEngine(rules)
+    engine = RuleEngine(rules)
+    transactions = [{"amount": amount} for amount in (-inf, 0, 5, 10, inf)]
+    expected = [baseline.evaluate(transaction, {}) for transaction in transactions]
+    assert [engine.evaluate(transaction, {}) for transaction in transactions] == expected
+    assert engine.evaluate_batch(transactions, [{}] * len(transactions)) == expected
+    return len(rules)
+
+
+def check_threads(threads=4, rounds=50, seed=2):
+    """One engine shared by several threads, as start_consumers.py shares it, reordering all the while."""
+    rng = random.Random(seed)
+    errors = []
+    for _ in range(rounds):
+        rules = random_rules(rng)
+        baseline = BaselineRuleEngine(rules)
+        engine = RuleEngine(rules)
+        work = []
+        for _ in range(threads):
+            transactions = [random_transaction(rng) for _ in range(400)]
+            features = [random_features(rng) for _ in transactions]
+            work.append([(t, f, baseline_result(baseline, t, f)) for t, f in zip(transactions, features)])
+
+        def run(rows):
+            for transaction, row_features, fired in rows:
+                if fired is TypeError:
+                    continue
+                try:
+                    if engine.evaluate(transaction, row_features) != fired:
+                        errors.append((rules, transaction, row_features))
+                except Exception as e:
+                    errors.append((rules, transaction, row_features, e))
+
+        workers = [threading.Thread(target=run, args=(rows,)) for rows in work]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert not errors, errors[0]
+    return rounds * threads * 400
+
+
+if __name__ == '__main__':
+    print(f"Missing field behind a failed condition: {check_sampled_missing_field()} samples, no errors")
+    print(f"Matched the baseline on {check_mixed_types()} batches with mixed-type fields")
+    print(f"Matched the baseline on {check_special_values()} rules with odd names and inf/nan values")
+
+    # Sample and reorder constantly, so every order the engine can pick is checked
+    rule_engine.SAMPLE_EVERY = 1
+    rule_engine.REORDER_EVERY = 1
+    checked, batches = check()
+    print(f"Matched the baseline on {checked} transactions and {batches} batches")
+
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    print(f"Matched the baseline on {check_threads()} transactions from threads sharing an engine")
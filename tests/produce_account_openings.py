@@ -1,14 +1,16 @@
-import sys, os, json, time
+import sys, os, time
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'kafka'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fraud'))
 
 import numpy as np
 from producer import Producer
+from events import ACCOUNT_OPENING
 
 rng = np.random.default_rng(77)
 
 customers = [f"cust_{i:04d}" for i in range(100)]
 
-producer = Producer(client_id='account-producer')
+producer = Producer(client_id='account-producer', value_serializer=ACCOUNT_OPENING.encode)
 sent = 0
 
 print("Producing account openings at ~1/sec")
@@ -27,7 +29,7 @@ try:
             "timestamp": int(time.time()),
         }
 
-        producer.send('account-opening', customer, json.dumps(event))
+        producer.send('account-opening', customer, event)
         sent += 1
 
         if sent % 10 == 0:
@@ -1,14 +1,16 @@
-import sys, os, json, time
+import sys, os, time
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'kafka'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fraud'))
 
 import numpy as np
 from producer import Producer
+from events import CARD_ISSUE
 
 rng = np.random.default_rng(55)
 
 customers = [f"cust_{i:04d}" for i in range(100)]
 
-producer = Producer(client_id='card-producer')
+producer = Producer(client_id='card-producer', value_serializer=CARD_ISSUE.encode)
 sent = 0
 
 print("Producing card issues at ~0.5/sec")
@@ -28,7 +30,7 @@ try:
             "timestamp": int(time.time()),
         }
 
-        producer.send('card-issue', customer, json.dumps(event))
+        producer.send('card-issue', customer, event)
         sent += 1
 
         if sent % 10 == 0:
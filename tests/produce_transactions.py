@@ -1,8 +1,10 @@
-import sys, os, json, time
+import sys, os, time
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'kafka'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fraud'))
 
 import numpy as np
-from producer import Producer
+from producer import AsyncProducer
+from events import TRANSACTION
 
 rng = np.random.default_rng(42)
 
@@ -11,7 +13,8 @@ fraudsters = set(rng.choice(customers, size=5, replace=False))
 beneficiaries = [f"ben_{i:04d}" for i in range(200)]
 txn_types = ["debit", "credit", "cashout", "transfer"]
 
-producer = Producer(client_id='txn-producer')
+producer = AsyncProducer(client_id='txn-producer', linger_ms=20,
+                         value_serializer=TRANSACTION.encode)
 sent = 0
 
 print(f"Producing transactions at ~10/sec")
@@ -40,7 +43,7 @@ try:
             "timestamp": int(time.time()),
         }
 
-        producer.send('transactions', customer, json.dumps(txn))
+        producer.send('transactions', customer, txn)
         sent += 1
 
         if sent % 50 == 0:
@@ -5,18 +5,27 @@ from broker import Broker
 
 DATA_DIR = './broker_data'
 
+# Metrics for scraping at http://localhost:9100/metrics
+METRICS_PORT = 9100
+
+# 'threaded' (one thread per connection) or 'asyncio' (one event loop)
+MODE = sys.argv[1] if len(sys.argv) > 1 else 'threaded'
+
 if os.path.exists(DATA_DIR):
     shutil.rmtree(DATA_DIR)
 
-broker = Broker(log_dir=DATA_DIR)
+broker = Broker(log_dir=DATA_DIR, metrics_port=METRICS_PORT)
 
 broker.create_topic('transactions', num_partitions=4)
-broker.create_topic('account-opening', num_partitions=2)
-broker.create_topic('card-issue', num_partitions=2)
+# Enrichment topics are keyed by customer and only the latest event per
+# customer matters, so they are compacted rather than expired
+broker.create_topic('account-opening', num_partitions=2, config={"cleanup_policy": "compact"})
+broker.create_topic('card-issue', num_partitions=2, config={"cleanup_policy": "compact"})
 
 print()
 
 try:
-    broker.start()
+    broker.start(mode=MODE)
 except KeyboardInterrupt:
+    broker.close()
     print("\nBroker stopped.")
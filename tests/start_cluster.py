@@ -0,0 +1,46 @@
+import sys, os, threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'kafka'))
+
+from broker import Broker
+
+# Every broker of the cluster: run one process per id,
+#   python tests/start_cluster.py 0
+#   python tests/start_cluster.py 1
+#   python tests/start_cluster.py 2
+# Data is kept across restarts, so a stopped broker can rejoin and catch up.
+CLUSTER = {
+    0: ('localhost', 9092),
+    1: ('localhost', 9093),
+    2: ('localhost', 9094),
+}
+
+BROKER_ID = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+MODE = sys.argv[2] if len(sys.argv) > 2 else 'threaded'
+DATA_DIR = f'./broker_data/broker-{BROKER_ID}'
+
+# Each broker's metrics are at http://localhost:<9100 + id>/metrics
+METRICS_PORT = 9100 + BROKER_ID
+
+# Seconds to give the other brokers to start before topics are assigned to them
+CREATE_TOPICS_DELAY = 3
+
+
+def create_topics():
+    # Creating a topic that exists is a no-op, so this is safe on restart
+    broker.create_topic('transactions', num_partitions=4)
+    broker.create_topic('account-opening', num_partitions=2, config={"cleanup_policy": "compact"})
+    broker.create_topic('card-issue', num_partitions=2, config={"cleanup_policy": "compact"})
+
+
+host, port = CLUSTER[BROKER_ID]
+broker = Broker(host=host, port=port, log_dir=DATA_DIR, broker_id=BROKER_ID, cluster=CLUSTER,
+                metrics_port=METRICS_PORT)
+
+if BROKER_ID == 0:
+    threading.Timer(CREATE_TOPICS_DELAY, create_topics).start()
+
+try:
+    broker.start(mode=MODE)
+except KeyboardInterrupt:
+    broker.close()
+    print("\nBroker stopped.")
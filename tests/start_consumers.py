@@ -1,8 +1,10 @@
-import sys, os, json, time, threading
+import sys, os, time, threading
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'kafka'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'fraud'))
 
 from consumer import Consumer
+from schema import decode
+import events  # registers the event schemas
 from fraud_engine import FraudEngine
 
 FEATURE_CONFIGS = [
@@ -67,48 +69,31 @@ enrichment_stats = {"accounts": 0, "cards": 0}
 
 
 
-def consume_account_openings():
-    consumer = Consumer(client_id='account-enrichment')
-    consumer.join_group('account-enrichment', 'account-opening')
-    print(f"[account-enrichment] partition {consumer.assigned_partition}")
+def consume_enrichment():
+    # One consumer reads both enrichment topics, all partitions in one fetch
+    consumer = Consumer(client_id='enrichment', value_deserializer=decode)
+    consumer.join_group('enrichment', ['account-opening', 'card-issue'])
+    print(f"[enrichment] partitions {consumer.assignment}")
 
     while True:
-        records = consumer.fetch('account-opening', max_records=50)
-        for offset, key, value in records:
-            event = json.loads(value)
-            event["_source"] = "account-opening"  # tag so feature store routes correctly
+        records = consumer.fetch(max_bytes=64 * 1024, max_wait_ms=500)
+        for topic, partition, offset, key, event in records:
+            event["_source"] = topic  # tag so feature store routes correctly
             engine.update(event)
-            enrichment_stats["accounts"] += 1
-        if not records:
-            time.sleep(0.3)
-
-
-
-def consume_card_issues():
-    consumer = Consumer(client_id='card-enrichment')
-    consumer.join_group('card-enrichment', 'card-issue')
-    print(f"[card-enrichment] partition {consumer.assigned_partition}")
-
-    while True:
-        records = consumer.fetch('card-issue', max_records=50)
-        for offset, key, value in records:
-            event = json.loads(value)
-            event["_source"] = "card-issue"
-            engine.update(event)
-            enrichment_stats["cards"] += 1
-        if not records:
-            time.sleep(0.3)
+            if topic == 'account-opening':
+                enrichment_stats["accounts"] += 1
+            else:
+                enrichment_stats["cards"] += 1
 
 
 
 def consume_transactions(consumer_id):
-    consumer = Consumer(client_id=consumer_id)
+    consumer = Consumer(client_id=consumer_id, value_deserializer=decode)
     consumer.join_group('fraud-engine', 'transactions')
-    partition = consumer.assigned_partition
-    print(f"[{consumer_id}] partition {partition}")
+    print(f"[{consumer_id}] partitions {consumer.assigned_partitions('transactions')}")
 
     stats[consumer_id] = {
-        "partition": partition,
+        "partitions": consumer.assigned_partitions('transactions'),
         "processed": 0,
         "blocked": 0,
         "approved": 0,
@@ -117,11 +102,10 @@ def consume_transactions(consumer_id):
 
     while True:
         try:
-            records = consumer.fetch('transactions', max_records=50)
-            for offset, key, value in records:
-                txn = json.loads(value)
-                decision, fired_rules, features = engine.process(txn)
-
+            records = consumer.fetch('transactions', max_bytes=64 * 1024, max_wait_ms=500)
+            stats[consumer_id]["partitions"] = consumer.assigned_partitions('transactions')  # changes on rebalance
+            transactions = [txn for topic, partition, offset, key, txn in records]
+            for decision, fired_rules, features in engine.process_batch(transactions):
                 s = stats[consumer_id]
                 s["processed"] += 1
                 if decision == "BLOCK":
@@ -130,9 +114,6 @@ def consume_transactions(consumer_id):
                         s["rules_fired"][rule] = s["rules_fired"].get(rule, 0) + 1
                 else:
                     s["approved"] += 1
-
-            if not records:
-                time.sleep(0.2)
         except ConnectionError:
             print(f"[{consumer_id}] Lost connection")
             break
@@ -145,20 +126,20 @@ def print_stats():
     print()
     print(f"  Enriched: {enrichment_stats['accounts']} accounts, {enrichment_stats['cards']} cards")
     print()
-    print(f"  {'Consumer':<22} {'Part':>4} {'Processed':>10} {'Blocked':>8} {'Approved':>9}")
-    print(f"  {'─'*22} {'─'*4} {'─'*10} {'─'*8} {'─'*9}")
+    print(f"  {'Consumer':<22} {'Parts':>8} {'Processed':>10} {'Blocked':>8} {'Approved':>9}")
+    print(f"  {'─'*22} {'─'*8} {'─'*10} {'─'*8} {'─'*9}")
 
     for cid, s in sorted(stats.items()):
-        print(f"  {cid:<22} {s['partition']:>4} {s['processed']:>10} {s['blocked']:>8} {s['approved']:>9}")
+        print(f"  {cid:<22} {','.join(map(str, s['partitions'])):>8} {s['processed']:>10} {s['blocked']:>8} {s['approved']:>9}")
         total_p += s["processed"]
         total_b += s["blocked"]
         total_a += s["approved"]
         for rule, count in s["rules_fired"].items():
             all_rules[rule] = all_rules.get(rule, 0) + count
 
-    print(f"  {'─'*22} {'─'*4} {'─'*10} {'─'*8} {'─'*9}")
+    print(f"  {'─'*22} {'─'*8} {'─'*10} {'─'*8} {'─'*9}")
     pct = (total_b / total_p * 100) if total_p > 0 else 0
-    print(f"  {'TOTAL':<22} {'':>4} {total_p:>10} {total_b:>8} {total_a:>9}  ({pct:.1f}% blocked)")
+    print(f"  {'TOTAL':<22} {'':>8} {total_p:>10} {total_b:>8} {total_a:>9}  ({pct:.1f}% blocked)")
 
     if all_rules:
         print(f"\n  Rules fired:")
@@ -172,14 +153,13 @@ if __name__ == '__main__':
     print("STARTING CONSUMERS")
     print("=" * 60)
 
-    threading.Thread(target=consume_account_openings, daemon=True).start()
-    threading.Thread(target=consume_card_issues, daemon=True).start()
+    threading.Thread(target=consume_enrichment, daemon=True).start()
 
     for i in range(4):
         threading.Thread(target=consume_transactions, args=(f'fraud-consumer-{i}',), daemon=True).start()
 
     print()
-    print("6 consumers running. Ctrl+C to stop.")
+    print("5 consumers running. Ctrl+C to stop.")
     print("=" * 60)
 
     try: